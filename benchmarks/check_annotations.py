@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""Compares check_annotations' scanner with the PyVCF parser it replaced
+
+Writes a synthetic annotated VCF and counts the annotation errors in it
+with both, checking that they agree."""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+from collections import Counter
+
+import vcf
+
+from snpEffWrapper.wrapper import annotation_error_map, count_annotation_errors
+
+def write_annotated_vcf(output_file, records, samples, error_rate, seed=1):
+  rng = random.Random(seed)
+  errors = sorted(annotation_error_map)
+  print("##fileformat=VCFv4.1", file=output_file)
+  print('##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations: \'Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | Transcript_BioType | Rank | HGVS.c | HGVS.p | cDNA.pos / cDNA.length | CDS.pos / CDS.length | AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO\' ">', file=output_file)
+  print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">', file=output_file)
+  print("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                   "INFO", "FORMAT"] +
+                  ["sample_%s" % i for i in range(samples)]), file=output_file)
+  genotypes = "\t".join(["0", "1"] * (samples // 2) + ["0"] * (samples % 2))
+  for position in range(1, records + 1):
+    error = rng.choice(errors) if rng.random() < error_rate else ''
+    annotation = "A|missense_variant|MODERATE|gene_%s|gene_%s|transcript|tx_%s|protein_coding|1/1|c.%sC>A|p.Pro5His|%s/900|%s/900|5/300||%s" % (
+      position // 1000, position // 1000, position // 1000, position, position,
+      position, error)
+    print("CHROM1\t%s\t.\tC\tA\t50\tPASS\tDP=10;ANN=%s\tGT\t%s" %
+          (position, annotation, genotypes), file=output_file)
+
+def pyvcf_count_annotation_errors(annotated_vcf):
+  """The PyVCF based check which count_annotation_errors replaced"""
+  error_counter = Counter()
+  annotated_vcf.seek(0)
+  header_regex = re.compile("^##.*$")
+  modified_vcf = (line for line in annotated_vcf if not header_regex.match(line))
+  for record in vcf.Reader(modified_vcf):
+    annotations = ','.join(record.INFO['ANN'])
+    error_counter.update({error: 1 for error in annotation_error_map
+                          if error in annotations})
+  return error_counter
+
+def best_time(function, annotated_vcf, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    result = function(annotated_vcf)
+    times.append(time.perf_counter() - start)
+  return min(times), result
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--records', type=int, default=100000,
+                      help="Number of records in the VCF (default: 100000)")
+  parser.add_argument('--samples', type=int, default=10,
+                      help="Number of samples in the VCF (default: 10)")
+  parser.add_argument('--error-rate', type=float, default=0.01,
+                      help="Proportion of records with an error (default: 0.01)")
+  parser.add_argument('--repeat', type=int, default=3,
+                      help="Report the best of this many runs (default: 3)")
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_arguments()
+  with tempfile.NamedTemporaryFile(mode='w+', prefix='benchmark_',
+                                   suffix='.vcf') as annotated_vcf:
+    write_annotated_vcf(annotated_vcf, args.records, args.samples,
+                        args.error_rate)
+    annotated_vcf.flush()
+    size = os.path.getsize(annotated_vcf.name)
+    scanner_time, scanner_counts = best_time(count_annotation_errors,
+                                             annotated_vcf, args.repeat)
+    pyvcf_time, pyvcf_counts = best_time(pyvcf_count_annotation_errors,
+                                         annotated_vcf, args.repeat)
+  if scanner_counts != pyvcf_counts:
+    raise ValueError("Counts differ: scanner %s, PyVCF %s" % (scanner_counts,
+                                                                pyvcf_counts))
+  print("%s records, %.1f MB, %s records with errors" %
+        (args.records, size / 1024**2, sum(scanner_counts.values())))
+  print("scanner: %.3fs (%.0f records/s)" % (scanner_time,
+                                             args.records / scanner_time))
+  print("PyVCF:   %.3fs (%.0f records/s)" % (pyvcf_time,
+                                             args.records / pyvcf_time))
+  print("speedup: %.1fx" % (pyvcf_time / scanner_time))
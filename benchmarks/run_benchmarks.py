@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""Benchmarks each stage of snpEffWrapper on a synthetic dataset
+
+Generates a reference and VCF (see synthetic.py), times each stage of the
+wrapper on them and runs snpEffBuildAndRun end to end with stub_snpeff.py
+standing in for Java and SnpEff.  The timings are written to a JSON file;
+give the file from an earlier version with --compare to see which stages
+have got slower."""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from synthetic import add_dataset_arguments, dataset_parameters, write_dataset
+
+from snpEffWrapper.compression import OutputOptions
+from snpEffWrapper.summary import AnnotationSummary
+from snpEffWrapper.wrapper import (AnnotationError, annotated_vcf_output, check_annotations,
+                                   check_contigs, create_config_file, get_gff_contigs,
+                                   get_vcf_contigs, scan_annotated_lines)
+
+RESULTS_VERSION = 1
+CODING_TABLE = 'default: Standard' # The same as coding_table below, in YAML
+
+def time_stage(function, repeat, setup=None):
+  """Runs function repeat times, returning the time each run took"""
+  times = []
+  for i in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return times
+
+def summarise(times, records=None):
+  ordered = sorted(times)
+  result = {
+    'times': [round(t, 6) for t in times],
+    'best': round(ordered[0], 6),
+    'median': round(ordered[len(ordered) // 2], 6)
+  }
+  if records:
+    result['records_per_second'] = round(records / ordered[0], 1)
+  return result
+
+def _remove_gff_index(gff_filename):
+  index_filename = "%s.index.json" % gff_filename
+  if os.path.isfile(index_filename):
+    os.remove(index_filename)
+
+def _copy_through(vcf_filename, output_filename, output_options=None):
+  with open(output_filename, 'w') as output_vcf, \
+       open(vcf_filename, 'r') as vcf_file:
+    with annotated_vcf_output(output_vcf,
+                              output_options=output_options) as output_file:
+      for line in vcf_file:
+        output_file.write(line)
+
+def _run_end_to_end(gff_filename, vcf_filename, output_filename, work_dir,
+                    threads):
+  env = dict(os.environ)
+  for name in ['SNPEFF_WRAPPER_SERVER', 'SNPEFF_WRAPPER_CACHE_DIR']:
+    env.pop(name, None)
+  env.update({
+    'PYTHONPATH': os.pathsep.join([REPO_DIR] + [path for path in [env.get('PYTHONPATH')] if path]),
+    'SNPEFF_WRAPPER_PROBE_CACHE': '',
+    'SNPEFF_WRAPPER_RESOURCE_HISTORY': ''
+  })
+  snpeff_exec = os.path.join(work_dir, 'snpEff.jar')
+  if not os.path.isfile(snpeff_exec):
+    open(snpeff_exec, 'w').close()
+  scratch_dir = os.path.join(work_dir, 'scratch')
+  command = [sys.executable, os.path.join(REPO_DIR, 'scripts', 'snpEffBuildAndRun'),
+             '--java-exec', os.path.join(BENCHMARK_DIR, 'stub_snpeff.py'),
+             '--snpeff-exec', snpeff_exec,
+             '--coding-table', CODING_TABLE,
+             '--scratch-dir', scratch_dir,
+             '--threads', str(threads),
+             '-o', output_filename, gff_filename, vcf_filename]
+  try:
+    subprocess.check_output(command, env=env, stderr=subprocess.STDOUT)
+  except subprocess.CalledProcessError as e:
+    print(e.output.decode('utf-8', 'replace'), file=sys.stderr)
+    raise
+
+def run_benchmarks(work_dir, args):
+  gff_filename, vcf_filename, annotated_filename = write_dataset(work_dir,
+                                                                 annotated=True,
+                                                                 **dataset_parameters(args))
+  output_filename = os.path.join(work_dir, 'output.vcf')
+  coding_table = {'default': 'Standard'}
+  records = args.variants
+  stages = {}
+
+  def benchmark(name, function, setup=None, records=None):
+    logging.info("Benchmarking %s", name)
+    stages[name] = summarise(time_stage(function, args.repeat, setup), records)
+
+  with open(gff_filename, 'r') as gff_file:
+    benchmark('get_gff_contigs',
+              lambda: get_gff_contigs(gff_file),
+              setup=lambda: _remove_gff_index(gff_filename))
+    benchmark('get_gff_contigs_indexed', lambda: get_gff_contigs(gff_file))
+    gff_contigs = get_gff_contigs(gff_file)
+  with open(vcf_filename, 'r') as vcf_file:
+    benchmark('get_vcf_contigs', lambda: get_vcf_contigs(vcf_file),
+              records=records)
+    vcf_contigs = get_vcf_contigs(vcf_file)
+  benchmark('check_contigs',
+            lambda: check_contigs(vcf_contigs, gff_contigs, coding_table))
+  config_dir = tempfile.mkdtemp(dir=work_dir, prefix='config_')
+  benchmark('create_config_file',
+            lambda: create_config_file(config_dir, 'reference', vcf_contigs,
+                                       coding_table))
+
+  def check():
+    with open(annotated_filename, 'r') as annotated_vcf:
+      try:
+        check_annotations(annotated_vcf)
+      except AnnotationError:
+        pass # Expected if --error-rate is set
+  benchmark('check_annotations', check, records=records)
+
+  def scan_with_summary():
+    with open(annotated_filename, 'r') as annotated_vcf:
+      for line in scan_annotated_lines(annotated_vcf, Counter(),
+                                       summary=AnnotationSummary()):
+        pass
+  benchmark('scan_with_summary', scan_with_summary, records=records)
+  benchmark('annotated_vcf_output',
+            lambda: _copy_through(annotated_filename, output_filename),
+            records=records)
+  benchmark('annotated_vcf_output_bgzip',
+            lambda: _copy_through(annotated_filename, output_filename + '.gz',
+                                  OutputOptions(True, args.compression_threads, True)),
+            records=records)
+  benchmark('end_to_end',
+            lambda: _run_end_to_end(gff_filename, vcf_filename, output_filename,
+                                    work_dir, args.threads),
+            setup=lambda: _remove_gff_index(gff_filename), records=records)
+  return {
+    'gff_bytes': os.path.getsize(gff_filename),
+    'vcf_bytes': os.path.getsize(vcf_filename),
+    'annotated_vcf_bytes': os.path.getsize(annotated_filename)
+  }, stages
+
+def _git_commit():
+  try:
+    output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                     stderr=subprocess.DEVNULL)
+    return output.decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _package_version():
+  try:
+    import pkg_resources
+    return pkg_resources.get_distribution('snpEffWrapper').version
+  except Exception:
+    return None
+
+def compare_results(previous, current, tolerance):
+  """Prints how each stage's best time changed, returning the stages which got slower"""
+  if previous.get('parameters') != current['parameters']:
+    print("WARNING: the results being compared used different parameters")
+  slower = []
+  print("%-28s %12s %12s %8s" % ('stage', 'previous (s)', 'current (s)', 'change'))
+  for name, stage in sorted(current['stages'].items()):
+    if name not in previous.get('stages', {}):
+      print("%-28s %12s %12.4f %8s" % (name, '-', stage['best'], 'new'))
+      continue
+    previous_best = previous['stages'][name]['best']
+    ratio = stage['best'] / previous_best if previous_best > 0 else 1.0
+    flag = ''
+    if ratio > 1 + tolerance:
+      slower.append(name)
+      flag = ' SLOWER'
+    print("%-28s %12.4f %12.4f %+7.1f%%%s" % (name, previous_best, stage['best'],
+                                            (ratio - 1) * 100, flag))
+  return slower
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description=__doc__)
+  add_dataset_arguments(parser)
+  parser.add_argument('--repeat', type=int, default=3,
+                      help="Run each stage this many times (default: %(default)s)")
+  parser.add_argument('--threads', type=int, default=1,
+                      help="--threads for the end to end run (default: %(default)s)")
+  parser.add_argument('--compression-threads', type=int, default=2,
+                      help="Threads compressing bgzipped output (default: %(default)s)")
+  parser.add_argument('--output', type=str, default='benchmark_results.json',
+                      help="Where to write the results (default: %(default)s)")
+  parser.add_argument('--compare', type=argparse.FileType('r'),
+                      help="Results from an earlier run to compare with")
+  parser.add_argument('--tolerance', type=float, default=0.1,
+                      help="Stages more than this much slower than in --compare fail the run (default: %(default)s)")
+  parser.add_argument('--work-dir', type=str,
+                      help="Where to write the dataset and outputs (default: a temporary directory which is deleted)")
+  parser.add_argument('--debug', action='store_true', default=False)
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_arguments()
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+  previous = json.load(args.compare) if args.compare is not None else None
+  work_dir = args.work_dir or tempfile.mkdtemp(prefix='snpEffWrapper_benchmark_')
+  os.makedirs(work_dir, exist_ok=True)
+  try:
+    inputs, stages = run_benchmarks(work_dir, args)
+  finally:
+    if args.work_dir is None:
+      shutil.rmtree(work_dir)
+  results = {
+    'results_version': RESULTS_VERSION,
+    'package_version': _package_version(),
+    'git_commit': _git_commit(),
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpu_count': os.cpu_count(),
+    'parameters': dict(dataset_parameters(args), repeat=args.repeat,
+                       threads=args.threads,
+                       compression_threads=args.compression_threads),
+    'inputs': inputs,
+    'stages': stages
+  }
+  with open(args.output, 'w') as output_file:
+    json.dump(results, output_file, indent=2, sort_keys=True)
+  print("Wrote results to %s" % args.output)
+  for name, stage in sorted(stages.items()):
+    print("%-28s %10.4fs" % (name, stage['best']))
+  if previous is not None:
+    print()
+    if compare_results(previous, results, args.tolerance):
+      sys.exit(1)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""A stand-in for `java -jar snpEff.jar` which needs neither Java nor SnpEff
+
+Pass it to snpEffBuildAndRun as --java-exec (any file will do for
+--snpeff-exec).  It answers `-version` like Java 7 and SnpEff 4.1, `build`
+indexes the genes and sequences in the GFF of the database and `ann` gives
+each record of the VCF an ANN field from that index, with the same errors
+SnpEff reports for unknown contigs, positions past the end of a contig and
+REF bases which don't match the reference.  It is much faster than SnpEff so
+benchmarks with it measure the wrapper's own overhead.
+
+STUB_SNPEFF_STARTUP_SECONDS adds a delay to each command, to model the JVM
+starting up, and STUB_JAVA_VERSION changes the version of Java reported."""
+
+import bisect
+import json
+import os
+import re
+import sys
+import time
+
+from synthetic import ANN_HEADER
+
+SNPEFF_VERSION = "SnpEff\t4.1l\t2015-10-03"
+PREDICTOR_FILENAME = 'snpEffectPredictor.json'
+
+def read_config(config_filename):
+  config = {}
+  with open(config_filename, 'r') as config_file:
+    for line in config_file:
+      match = re.match('^\\s*([^#=:\\s]+)\\s*[=:]\\s*(.*?)\\s*$', line)
+      if match is not None:
+        config[match.group(1)] = match.group(2)
+  return config
+
+def parse_snpeff_arguments(arguments):
+  """Splits SnpEff's arguments into options (with their values) and positionals"""
+  options_with_values = {'-c', '-stats', '-config', '-dataDir'}
+  options = {}
+  positionals = []
+  arguments = iter(arguments)
+  for argument in arguments:
+    if argument in options_with_values:
+      options[argument] = next(arguments)
+    elif argument.startswith('-') and argument != '-':
+      options[argument] = True
+    else:
+      positionals.append(argument)
+  return options, positionals
+
+def genome_dir(options, genome):
+  config = read_config(options['-c'])
+  data_dir = config.get('data.dir', os.path.dirname(options['-c']))
+  return os.path.join(data_dir, genome)
+
+def read_gff(gff_filename):
+  """Reads the genes and the sequences from a GFF with a ##FASTA section"""
+  genes = {}
+  sequences = {}
+  line = ''
+  with open(gff_filename, 'r') as gff_file:
+    for line in gff_file:
+      if line.startswith('##FASTA') or line.startswith('>'):
+        break
+      if line[0] == '#' or line.strip() == '':
+        continue
+      fields = line.rstrip('\n').split('\t')
+      if fields[2] != 'gene':
+        continue
+      attributes = dict(attribute.split('=', 1) for attribute in fields[8].split(';')
+                        if '=' in attribute)
+      genes.setdefault(fields[0], []).append([int(fields[3]), int(fields[4]),
+                                              attributes.get('ID', '.')])
+    name = line[1:].strip() if line.startswith('>') else None
+    sequence = []
+    for line in gff_file:
+      if line.startswith('>'):
+        if name is not None:
+          sequences[name] = ''.join(sequence)
+        name = line[1:].strip().split()[0]
+        sequence = []
+      else:
+        sequence.append(line.strip())
+    if name is not None:
+      sequences[name] = ''.join(sequence)
+  for contig_genes in genes.values():
+    contig_genes.sort()
+  return genes, sequences
+
+def build(options, positionals):
+  database_dir = genome_dir(options, positionals[0])
+  genes, sequences = read_gff(os.path.join(database_dir, 'genes.gff'))
+  with open(os.path.join(database_dir, PREDICTOR_FILENAME), 'w') as predictor_file:
+    json.dump({'genes': genes, 'sequences': sequences}, predictor_file)
+  if '-verbose' in options:
+    print("Built a database of %s genes on %s contigs" %
+          (sum(len(contig_genes) for contig_genes in genes.values()),
+           len(sequences)), file=sys.stderr)
+  return 0
+
+def annotate_record(fields, genes, gene_starts, sequences):
+  contig, position, ref, alt = fields[0], int(fields[1]), fields[3], fields[4]
+  errors = ''
+  effect, impact, gene_id = 'intergenic_region', 'MODIFIER', ''
+  sequence = sequences.get(contig)
+  if sequence is None:
+    errors = 'ERROR_CHROMOSOME_NOT_FOUND'
+  elif position > len(sequence):
+    errors = 'ERROR_OUT_OF_CHROMOSOME_RANGE'
+  elif sequence[position-1:position-1+len(ref)].upper() != ref.upper():
+    errors = 'WARNING_REF_DOES_NOT_MATCH_GENOME'
+  if contig in genes:
+    i = bisect.bisect_right(gene_starts[contig], position) - 1
+    if i >= 0 and genes[contig][i][1] >= position:
+      effect, impact, gene_id = 'missense_variant', 'MODERATE', genes[contig][i][2]
+  annotation = "%s|%s|%s|%s|%s|transcript|%s|protein_coding|1/1|c.%s%s>%s|||||%s" % (
+    alt.split(',')[0], effect, impact, gene_id, gene_id, gene_id, position, ref,
+    alt, errors)
+  info = fields[7]
+  fields[7] = "ANN=%s" % annotation if info in ('', '.') else "%s;ANN=%s" % (info, annotation)
+
+def annotate(options, positionals):
+  database_dir = genome_dir(options, positionals[0])
+  with open(os.path.join(database_dir, PREDICTOR_FILENAME), 'r') as predictor_file:
+    predictor = json.load(predictor_file)
+  genes, sequences = predictor['genes'], predictor['sequences']
+  gene_starts = {contig: [gene[0] for gene in contig_genes]
+                 for contig, contig_genes in genes.items()}
+  vcf_filename = positionals[1] if len(positionals) > 1 else '-'
+  vcf_file = sys.stdin if vcf_filename == '-' else open(vcf_filename, 'r')
+  records = 0
+  output = sys.stdout
+  for line in vcf_file:
+    if line.startswith('#CHROM'):
+      output.write("##SnpEffVersion=\"%s\"\n" % SNPEFF_VERSION.replace('\t', ' '))
+      output.write(ANN_HEADER + "\n")
+    if line[0] == '#':
+      output.write(line)
+      continue
+    fields = line.rstrip('\n').split('\t')
+    annotate_record(fields, genes, gene_starts, sequences)
+    output.write('\t'.join(fields) + '\n')
+    records += 1
+  if '-stats' in options:
+    with open(options['-stats'], 'w') as stats_file:
+      stats_file.write("<html><body>%s variants</body></html>\n" % records)
+  return 0
+
+def run_jar(arguments):
+  if arguments[:1] == ['-version']:
+    print(SNPEFF_VERSION)
+    return 0
+  command = arguments[0] if arguments else None
+  options, positionals = parse_snpeff_arguments(arguments[1:])
+  if command == 'build':
+    return build(options, positionals)
+  if command in ('ann', 'eff'):
+    return annotate(options, positionals)
+  print("Unknown command '%s'" % command, file=sys.stderr)
+  return 255
+
+def main(arguments):
+  time.sleep(float(os.environ.get('STUB_SNPEFF_STARTUP_SECONDS', 0)))
+  for i, argument in enumerate(arguments):
+    if argument == '-version':
+      print('java version "%s"' % os.environ.get('STUB_JAVA_VERSION', '1.7.0_80'),
+            file=sys.stderr)
+      return 0
+    if argument == '-jar':
+      return run_jar(arguments[i+2:])
+  print("Usage: stub_snpeff.py [JVM options] -jar snpEff.jar command ...",
+        file=sys.stderr)
+  return 1
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
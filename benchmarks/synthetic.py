@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Writes synthetic references and VCFs for benchmarking snpEffWrapper
+
+The reference is a GFF3 with a gene, mRNA and CDS for each gene and the
+sequences in a ##FASTA section, like the GFFs snpEffBuildAndRun is given.
+Variants are drawn from the reference so their REF bases match it; a
+proportion of them can be given SnpEff style ANN fields, some with errors,
+to benchmark the checks of annotated VCFs.  Everything is generated from a
+seed so the same parameters always give the same files."""
+
+import argparse
+import os
+import random
+
+ANN_HEADER = '##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations: \'Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | Transcript_BioType | Rank | HGVS.c | HGVS.p | cDNA.pos / cDNA.length | CDS.pos / CDS.length | AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO\' ">'
+
+ANNOTATION_ERRORS = [
+  'WARNING_REF_DOES_NOT_MATCH_GENOME',
+  'WARNING_SEQUENCE_NOT_AVAILABLE',
+  'ERROR_CHROMOSOME_NOT_FOUND',
+  'ERROR_OUT_OF_CHROMOSOME_RANGE'
+]
+
+BASES = 'ACGT'
+FASTA_LINE_WIDTH = 60
+
+def contig_names(contigs):
+  return ["contig_%s" % i for i in range(1, contigs + 1)]
+
+def random_sequence(rng, length):
+  return ''.join(rng.choice(BASES) for i in range(length))
+
+def gene_positions(contig_length, genes):
+  """Evenly spaced, non-overlapping (start, end) positions of genes"""
+  if genes == 0:
+    return []
+  spacing = contig_length // genes
+  gene_length = max(3, (spacing * 2 // 3) // 3 * 3)
+  return [(i * spacing + 1, i * spacing + gene_length) for i in range(genes)]
+
+def write_reference(output_file, contigs, contig_length, genes_per_contig,
+                    seed=1):
+  """Writes a GFF3 with genes on each contig followed by their sequences
+
+  Returns a dict of contig name to sequence"""
+  rng = random.Random(seed)
+  sequences = {name: random_sequence(rng, contig_length)
+               for name in contig_names(contigs)}
+  print("##gff-version 3", file=output_file)
+  for name in contig_names(contigs):
+    print("##sequence-region %s 1 %s" % (name, contig_length), file=output_file)
+  for name in contig_names(contigs):
+    for i, (start, end) in enumerate(gene_positions(contig_length,
+                                                    genes_per_contig)):
+      gene_id = "%s_gene_%s" % (name, i)
+      strand = '+' if i % 2 == 0 else '-'
+      print("\t".join([name, "synthetic", "gene", str(start), str(end), ".",
+                       strand, ".", "ID=%s;Name=%s" % (gene_id, gene_id)]),
+            file=output_file)
+      print("\t".join([name, "synthetic", "mRNA", str(start), str(end), ".",
+                       strand, ".", "ID=%s.t;Parent=%s" % (gene_id, gene_id)]),
+            file=output_file)
+      print("\t".join([name, "synthetic", "CDS", str(start), str(end), ".",
+                       strand, "0", "ID=%s.cds;Parent=%s.t" % (gene_id, gene_id)]),
+            file=output_file)
+  print("##FASTA", file=output_file)
+  for name in contig_names(contigs):
+    print(">%s" % name, file=output_file)
+    sequence = sequences[name]
+    for start in range(0, len(sequence), FASTA_LINE_WIDTH):
+      print(sequence[start:start+FASTA_LINE_WIDTH], file=output_file)
+  return sequences
+
+def _annotation(rng, alt, contig, contig_length, position, genes, error_rate):
+  error = rng.choice(ANNOTATION_ERRORS) if rng.random() < error_rate else ''
+  gene = "%s_gene_%s" % (contig, (position - 1) * max(1, genes) // contig_length)
+  return "%s|missense_variant|MODERATE|%s|%s|transcript|%s.t|protein_coding|1/1|c.%s>%s|||||%s" % (
+    alt, gene, gene, gene, position, alt, error)
+
+def write_vcf(output_file, sequences, variants, samples=1, ann_density=0.0,
+              error_rate=0.0, genes_per_contig=1, seed=1):
+  """Writes a VCF of SNPs spread over the sequences, sorted by position
+
+  ann_density is the proportion of records with an ANN field and error_rate
+  the proportion of those whose annotation has one of ANNOTATION_ERRORS"""
+  rng = random.Random(seed)
+  names = sorted(sequences, key=lambda name: int(name.rsplit('_', 1)[1]))
+  print("##fileformat=VCFv4.1", file=output_file)
+  if ann_density > 0:
+    print(ANN_HEADER, file=output_file)
+  print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        file=output_file)
+  print("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                   "INFO", "FORMAT"] +
+                  ["sample_%s" % i for i in range(samples)]), file=output_file)
+  genotypes = "\t".join(["0", "1"] * (samples // 2) + ["0"] * (samples % 2))
+  per_contig = [variants // len(names)] * len(names)
+  for i in range(variants % len(names)):
+    per_contig[i] += 1
+  for name, count in zip(names, per_contig):
+    sequence = sequences[name]
+    positions = sorted(rng.sample(range(1, len(sequence) + 1),
+                                  min(count, len(sequence))))
+    for position in positions:
+      ref = sequence[position - 1]
+      alt = rng.choice([base for base in BASES if base != ref])
+      info = "DP=%s" % rng.randint(5, 100)
+      if rng.random() < ann_density:
+        info += ";ANN=%s" % _annotation(rng, alt, name, len(sequence),
+                                        position, genes_per_contig, error_rate)
+      print("%s\t%s\t.\t%s\t%s\t50\tPASS\t%s\tGT\t%s" %
+            (name, position, ref, alt, info, genotypes), file=output_file)
+
+def write_dataset(output_dir, contigs=10, contig_length=100000,
+                  genes_per_contig=50, variants=100000, samples=1,
+                  ann_density=0.0, error_rate=0.0, seed=1, annotated=False):
+  """Writes reference.gff and variants.vcf to output_dir
+
+  If annotated is set, annotated.vcf has the same records as variants.vcf
+  but all of them have an ANN field.  Returns the paths of the files."""
+  os.makedirs(output_dir, exist_ok=True)
+  gff_filename = os.path.join(output_dir, 'reference.gff')
+  with open(gff_filename, 'w') as gff_file:
+    sequences = write_reference(gff_file, contigs, contig_length,
+                                genes_per_contig, seed)
+  filenames = [gff_filename]
+  vcfs = [('variants.vcf', ann_density)]
+  if annotated:
+    vcfs.append(('annotated.vcf', 1.0))
+  for name, density in vcfs:
+    filenames.append(os.path.join(output_dir, name))
+    with open(filenames[-1], 'w') as vcf_file:
+      write_vcf(vcf_file, sequences, variants, samples, density, error_rate,
+                genes_per_contig, seed)
+  return filenames
+
+def add_dataset_arguments(parser):
+  parser.add_argument('--contigs', type=int, default=10,
+                      help="Number of contigs in the reference (default: %(default)s)")
+  parser.add_argument('--contig-length', type=int, default=100000,
+                      help="Length of each contig (default: %(default)s)")
+  parser.add_argument('--genes-per-contig', type=int, default=50,
+                      help="Number of genes on each contig (default: %(default)s)")
+  parser.add_argument('--variants', type=int, default=100000,
+                      help="Number of records in the VCF (default: %(default)s)")
+  parser.add_argument('--samples', type=int, default=1,
+                      help="Number of samples in the VCF (default: %(default)s)")
+  parser.add_argument('--ann-density', type=float, default=0.0,
+                      help="Proportion of records which already have an ANN field (default: %(default)s)")
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help="Proportion of ANN fields with an annotation error (default: %(default)s)")
+  parser.add_argument('--seed', type=int, default=1,
+                      help="Random seed (default: %(default)s)")
+
+def dataset_parameters(args):
+  return {
+    'contigs': args.contigs,
+    'contig_length': args.contig_length,
+    'genes_per_contig': args.genes_per_contig,
+    'variants': args.variants,
+    'samples': args.samples,
+    'ann_density': args.ann_density,
+    'error_rate': args.error_rate,
+    'seed': args.seed
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('output_dir', help="Where to write reference.gff and variants.vcf")
+  add_dataset_arguments(parser)
+  args = parser.parse_args()
+  for filename in write_dataset(args.output_dir, **dataset_parameters(args)):
+    print("Wrote %s (%.1f MB)" % (filename, os.path.getsize(filename) / 1024**2))
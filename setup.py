@@ -5,13 +5,19 @@ import multiprocessing
 setup(name='snpEffWrapper',
       version='0.2.5',
       scripts=[
-        'scripts/snpEffBuildAndRun'
+        'scripts/snpEffBuildAndRun',
+        'scripts/snpEffAnnotationServer'
       ],
       install_requires=[
         'Jinja2',
-        'PyVCF',
         'PyYAML'
       ],
+      extras_require={
+        'parquet': ['pyarrow']
+      },
+      tests_require=[
+        'PyVCF'
+      ],
       include_package_data=True,
       package_data={
         'data': 'snpEffWrapper/data/*',
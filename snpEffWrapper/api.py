@@ -0,0 +1,274 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+
+from .checkpoint import DEFAULT_CHUNK_RECORDS
+from .compression import is_compressed_filename
+from .metrics import DEFAULT_PROGRESS_INTERVAL
+from .contigs import parse_alias_rules
+from .filters import parse_effect_terms, parse_impacts
+from .prune import MIN_PRUNE_DISTANCE
+from .records import AnnotatedRecord
+from .scratch import default_scratch_dir
+from .streaming import StreamedVCF
+from .table import check_effects_table
+from .wrapper import (DEFAULT_JAVA_VERSIONS, annotate_vcf, annotate_vcfs, annotated_vcf_lines,
+                      annotated_vcf_output, can_stream_vcf, check_and_amend_executables,
+                      get_output_options, preflight_vcf, run_metrics)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CODING_TABLE = 'default: Bacterial_and_Plant_Plastid'
+
+def default_options():
+  """The options of an annotation and their defaults
+
+  These are the same as snpEffBuildAndRun's, which takes its defaults from
+  here.  Some of them come from environment variables so they are looked up
+  each time."""
+  return OrderedDict([
+    ('snpeff_exec', None),
+    ('java_exec', None),
+    ('java_versions', DEFAULT_JAVA_VERSIONS),
+    ('coding_table', DEFAULT_CODING_TABLE),
+    ('bgzip', None),
+    ('tabix', False),
+    ('compression_threads', min(4, multiprocessing.cpu_count())),
+    ('jobs', 1),
+    ('threads', 1),
+    ('build_heap', None),
+    ('annotate_heap', None),
+    ('java_gc', None),
+    ('java_options', None),
+    ('metrics_file', os.environ.get('SNPEFF_WRAPPER_METRICS_FILE')),
+    ('summary_file', None),
+    ('progress_interval', DEFAULT_PROGRESS_INTERVAL),
+    ('debug', False),
+    ('scratch_dir', default_scratch_dir()),
+    ('keep', False),
+    ('cache_dir', os.environ.get('SNPEFF_WRAPPER_CACHE_DIR')),
+    ('cache_max_size', None),
+    ('prune', False),
+    ('prune_distance', None),
+    ('resume_dir', None),
+    ('chunk_records', DEFAULT_CHUNK_RECORDS),
+    ('deduplicate', False),
+    ('contig_aliases', None),
+    ('contig_alias_rules', None),
+    ('contig_report', None),
+    ('preflight', False),
+    ('impacts', None),
+    ('effects', None),
+    ('genes', None),
+    ('only_matching_annotations', False),
+    ('effects_table', None)
+  ])
+
+def annotation_options(**options):
+  """Makes the arguments the wrapper expects from keyword options
+
+  Options which aren't given take their values from default_options.
+  Unknown options raise TypeError, like an unknown keyword argument would."""
+  args = default_options()
+  unknown_options = sorted(set(options) - set(args))
+  if len(unknown_options) > 0:
+    raise TypeError("Unknown options: %s" % ", ".join(unknown_options))
+  args.update(options)
+  args = argparse.Namespace(**args)
+  for option in ['compression_threads', 'jobs', 'threads', 'chunk_records']:
+    if getattr(args, option) < 1:
+      raise ValueError("%s must be at least 1" % option)
+  if args.progress_interval < 0:
+    raise ValueError("progress_interval cannot be negative")
+  if args.prune_distance is not None and args.prune_distance < MIN_PRUNE_DISTANCE:
+    raise ValueError("prune_distance must be at least %s" % MIN_PRUNE_DISTANCE)
+  args.contig_alias_rules = parse_alias_rules(args.contig_alias_rules)
+  args.impacts = parse_impacts(args.impacts)
+  args.effects = parse_effect_terms(args.effects)
+  if args.only_matching_annotations and args.impacts is None and args.effects is None and args.genes is None:
+    raise ValueError("only_matching_annotations needs impacts, effects or genes")
+  if args.effects_table is not None:
+    check_effects_table(args.effects_table)
+  return args
+
+def _check_output_options(args, output_filename=None):
+  """Works out whether to bgzip the output if it wasn't set"""
+  if args.bgzip is None:
+    args.bgzip = output_filename is not None and is_compressed_filename(output_filename)
+  if args.tabix and not args.bgzip:
+    raise ValueError("tabix needs bgzip")
+  if args.tabix and output_filename is None:
+    raise ValueError("tabix needs an output file")
+
+def _on_disk(source):
+  """Is source, a path or a text stream, a file on disk?"""
+  if isinstance(source, str):
+    return True
+  filename = getattr(source, 'name', None)
+  return isinstance(filename, str) and os.path.isfile(filename)
+
+def _spool_dir(scratch_dir):
+  spool_dir = scratch_dir if scratch_dir is not None else os.getcwd()
+  os.makedirs(spool_dir, exist_ok=True)
+  return spool_dir
+
+@contextmanager
+def _input_file(source, scratch_dir=None):
+  """Yields source, a path or a text stream, as a file which is on disk
+
+  Paths are opened and closed again afterwards.  Streams which aren't files
+  on disk (e.g. stdin) are copied to a temporary file in scratch_dir first,
+  as SnpEff needs to read the VCF and GFF by name."""
+  if isinstance(source, str):
+    with open(source, 'r') as input_file:
+      yield input_file
+    return
+  if _on_disk(source):
+    yield source
+    return
+  filename = getattr(source, 'name', None)
+  with tempfile.NamedTemporaryFile(mode='w', dir=_spool_dir(scratch_dir),
+                                   prefix='.snpeff_input_') as spool_file:
+    logger.debug("Copying %s to %s" % (filename or 'input', spool_file.name))
+    shutil.copyfileobj(source, spool_file, 1024*1024)
+    spool_file.flush()
+    with open(spool_file.name, 'r') as input_file:
+      yield input_file
+
+@contextmanager
+def _vcf_input_file(source, args):
+  """Yields source as the VCF to annotate
+
+  Like _input_file, except that streams which aren't files on disk are
+  annotated as they're read, as a StreamedVCF, unless the run needs the
+  whole VCF first (see wrapper.can_stream_vcf)."""
+  if _on_disk(source) or not can_stream_vcf(args):
+    with _input_file(source, args.scratch_dir) as vcf_file:
+      yield vcf_file
+    return
+  with StreamedVCF(source, _spool_dir(args.scratch_dir)) as vcf_file:
+    yield vcf_file
+
+def _output_file(output):
+  """Opens output if it's a path; the wrapper renames its output over this file"""
+  if isinstance(output, str):
+    return open(output, 'w')
+  return output
+
+def _output_filename(output):
+  if output is None or output is sys.stdout:
+    return None
+  return output if isinstance(output, str) else output.name
+
+class AnnotatedVCF(object):
+  """Iterates over the AnnotatedRecords of a VCF as SnpEff annotates them
+
+  header is the list of the VCF's header lines; it is complete once the
+  first record has been read.  metrics is the run's RunMetrics.  If not all
+  of the records are read, close() (or using it in a with statement) stops
+  SnpEff and deletes the temporary database."""
+  def __init__(self, gff, vcf, args, output=None, check=True):
+    self.header = []
+    self.metrics = None
+    self._records = self._annotate(gff, vcf, args, output, check)
+
+  def _annotate(self, gff, vcf, args, output, check):
+    with ExitStack() as stack:
+      args.gff_file = stack.enter_context(_input_file(gff, args.scratch_dir))
+      args.vcf_file = stack.enter_context(_vcf_input_file(vcf, args))
+      self.metrics = stack.enter_context(run_metrics(args))
+      lines = annotated_vcf_lines(args, self.metrics, check)
+      stack.callback(lines.close)
+      output_file = None
+      if output is not None:
+        output_file = stack.enter_context(annotated_vcf_output(_output_file(output),
+                                                               output_options=get_output_options(args),
+                                                               metrics=self.metrics))
+      for line in lines:
+        if output_file is not None:
+          output_file.write(line)
+        if line[0] == '#':
+          self.header.append(line)
+        else:
+          yield AnnotatedRecord(line)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return next(self._records)
+
+  def close(self):
+    self._records.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.close()
+
+def annotate(gff, vcf, output=None, check=True, **options):
+  """Annotates vcf with the features in gff, returning an AnnotatedVCF
+
+  gff and vcf can be paths or text streams.  The records are yielded as
+  SnpEff writes them; if output (a path or a stream) is given the annotated
+  VCF is written there too.  If check is set AnnotationError is raised once
+  the last record has been read if SnpEff reported problems, otherwise they
+  are only logged.  The keyword options are listed in default_options; the
+  executables are checked before this returns."""
+  args = annotation_options(**options)
+  _check_output_options(args, _output_filename(output))
+  args = check_and_amend_executables(args)
+  return AnnotatedVCF(gff, vcf, args, output, check)
+
+def annotate_file(gff, vcf, output, **options):
+  """Annotates vcf with the features in gff, writing the annotated VCF to output
+
+  output can be a path or a stream (e.g. sys.stdout); it is bgzipped if
+  its name ends in .gz or .bgz unless bgzip is given.  It can be None if
+  only the effects_table is wanted.  Returns the run's RunMetrics."""
+  args = annotation_options(**options)
+  _check_output_options(args, _output_filename(output))
+  args = check_and_amend_executables(args)
+  with _input_file(gff, args.scratch_dir) as args.gff_file, \
+       _vcf_input_file(vcf, args) as args.vcf_file:
+    args.output_vcf = _output_file(output)
+    return annotate_vcf(args)
+
+def check_reference(gff, vcf, **options):
+  """Checks that vcf matches the reference sequences in gff without annotating it
+
+  Every record's POS and REF is checked against the ##FASTA section of the
+  GFF (see wrapper.preflight_check), which takes seconds rather than the
+  time to build the database and run SnpEff.  PreflightError, an
+  AnnotationError, is raised if there are problems; they are logged first.
+  Returns the run's RunMetrics."""
+  args = annotation_options(**options)
+  with _input_file(gff, args.scratch_dir) as args.gff_file, \
+       _input_file(vcf, args.scratch_dir) as args.vcf_file:
+    return preflight_vcf(args)
+
+def annotate_batch(gff, vcf_filenames, output_dir, **options):
+  """Annotates the VCFs in vcf_filenames against one database
+
+  Each annotated VCF is written to output_dir (see wrapper.annotate_vcfs).
+  Returns the run's RunMetrics."""
+  args = annotation_options(**options)
+  if args.resume_dir is not None:
+    raise ValueError("Batches of VCFs can't be resumed, annotate them one at a time with resume_dir")
+  if args.effects_table is not None:
+    raise ValueError("effects_table can only be written for one VCF, annotate them one at a time")
+  args.bgzip = bool(args.bgzip)
+  _check_output_options(args, output_dir)
+  args = check_and_amend_executables(args)
+  with _input_file(gff, args.scratch_dir) as args.gff_file:
+    args.vcf_filenames = list(vcf_filenames)
+    args.output_dir = output_dir
+    return annotate_vcfs(args)
@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+def _hash_file(filename, hasher, block_size=1024*1024):
+  with open(filename, 'rb') as input_file:
+    for block in iter(lambda: input_file.read(block_size), b''):
+      hasher.update(block)
+
+def database_cache_key(gff_filename, codon_tables, snpeff_version,
+                       pruned_contigs=None, renamed_contigs=None):
+  """Hash of everything which goes into `snpEff build`
+
+  codon_tables is the mapping of contig to coding table which will be
+  rendered into the config and snpeff_version identifies the jar doing the
+  build.  pruned_contigs are the contigs the GFF was pruned to, if it was,
+  and renamed_contigs a dict of the contigs renamed to match the VCF."""
+  hasher = hashlib.sha256()
+  _hash_file(gff_filename, hasher)
+  hasher.update(json.dumps(codon_tables, sort_keys=True).encode('utf-8'))
+  hasher.update(snpeff_version.encode('utf-8'))
+  if pruned_contigs is not None:
+    hasher.update(json.dumps(sorted(pruned_contigs)).encode('utf-8'))
+  if renamed_contigs:
+    hasher.update(json.dumps(renamed_contigs, sort_keys=True).encode('utf-8'))
+  return hasher.hexdigest()
+
+def _directory_size(directory):
+  total = 0
+  for root, dirs, files in os.walk(directory):
+    for filename in files:
+      path = os.path.join(root, filename)
+      if not os.path.islink(path):
+        total += os.path.getsize(path)
+  return total
+
+def _directory_mode(parent_dir, mode=0o755):
+  """mode with the umask applied, as os.mkdir would give a new directory
+
+  The umask is found by making a directory rather than with os.umask, which
+  would briefly change it for every thread."""
+  probe_dir = tempfile.mkdtemp(prefix='.mode_', dir=parent_dir)
+  try:
+    probe_subdir = os.path.join(probe_dir, 'probe')
+    os.mkdir(probe_subdir, 0o777)
+    return os.stat(probe_subdir).st_mode & mode
+  finally:
+    shutil.rmtree(probe_dir, ignore_errors=True)
+
+class DatabaseCache(object):
+  """Content addressed cache of built SnpEff databases
+
+  Each entry is a directory named after its key containing the `data`
+  directory written by `snpEff build`.  Entries are built in a staging
+  directory and renamed into place so that they are never seen half written.
+  A lock file per key is held exclusively while building (so concurrent jobs
+  wait for each other rather than building the same entry twice) and shared
+  while an entry is in use (so it isn't evicted from under a running job).
+  Once the cache is bigger than max_size bytes, the least recently used
+  entries are evicted."""
+
+  COMPLETE_MARKER = '.complete'
+
+  def __init__(self, cache_dir, max_size=None):
+    self.cache_dir = os.path.abspath(cache_dir)
+    self.max_size = max_size
+    os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def _marker_filename(self, key):
+    return os.path.join(self._entry_dir(key), self.COMPLETE_MARKER)
+
+  def _is_complete(self, key):
+    return os.path.isfile(self._marker_filename(key))
+
+  @contextmanager
+  def _lock(self, key, operation):
+    lock_filename = os.path.join(self.cache_dir, "%s.lock" % key)
+    with open(lock_filename, 'a') as lock_file:
+      fcntl.flock(lock_file, operation)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def _build(self, key, build):
+    staging_dir = tempfile.mkdtemp(prefix=".building_%s_" % key,
+                                   dir=self.cache_dir)
+    try:
+      build(os.path.join(staging_dir, 'data'))
+      with open(os.path.join(staging_dir, self.COMPLETE_MARKER), 'w') as marker:
+        json.dump({'size': _directory_size(staging_dir),
+                   'created': time.time()}, marker)
+      # mkdtemp only lets its owner into the staging directory, but other
+      # users sharing the cache need to read the entry
+      os.chmod(staging_dir, _directory_mode(self.cache_dir))
+      os.rename(staging_dir, self._entry_dir(key))
+    except:
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      raise
+    logger.info("Added database %s to the cache in %s", key, self.cache_dir)
+
+  @contextmanager
+  def database(self, key, build):
+    """Yields the data directory of the database for key
+
+    If the database isn't in the cache, build is called with a path which it
+    should populate with a built database.  The entry is protected from
+    eviction until the context exits."""
+    while True:
+      with self._lock(key, fcntl.LOCK_SH):
+        if self._is_complete(key):
+          logger.info("Using cached database %s", key)
+          os.utime(self._marker_filename(key))
+          yield os.path.join(self._entry_dir(key), 'data')
+          return
+      with self._lock(key, fcntl.LOCK_EX):
+        if not self._is_complete(key):
+          logger.info("Database %s is not in the cache, building it", key)
+          self._build(key, build)
+      self.evict(keep=key)
+
+  def _entries(self):
+    for key in os.listdir(self.cache_dir):
+      marker_filename = self._marker_filename(key)
+      try:
+        with open(marker_filename, 'r') as marker:
+          size = json.load(marker)['size']
+        yield os.path.getmtime(marker_filename), key, size
+      except (FileNotFoundError, NotADirectoryError):
+        pass # Not an entry or evicted by another job
+
+  def _remove_abandoned_builds(self):
+    for name in os.listdir(self.cache_dir):
+      if not name.startswith('.building_'):
+        continue
+      key = name.split('_')[1]
+      try:
+        with self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB):
+          logger.debug("Removing abandoned build %s", name)
+          shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+      except BlockingIOError:
+        pass # Still being built
+
+  def evict(self, keep=None):
+    """Removes least recently used entries until the cache fits in max_size
+
+    Entries which are in use by another job are skipped"""
+    self._remove_abandoned_builds()
+    if self.max_size is None:
+      return
+    entries = sorted(self._entries())
+    total_size = sum(size for last_used, key, size in entries)
+    for last_used, key, size in entries:
+      if total_size <= self.max_size:
+        break
+      if key == keep:
+        continue
+      try:
+        with self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB):
+          logger.info("Evicting database %s from the cache", key)
+          os.remove(self._marker_filename(key))
+          shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+          total_size -= size
+      except BlockingIOError:
+        logger.debug("Not evicting database %s, it is in use", key)
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from collections import Counter
+
+from .summary import AnnotationSummary
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+DEFAULT_CHUNK_RECORDS = 100000
+MANIFEST_FILENAME = 'manifest.json'
+
+def checkpoint_key(*parts):
+  """Hash of the inputs and settings of a run, which must match to resume it"""
+  return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+def file_sha256(filename, block_size=1024*1024):
+  hasher = hashlib.sha256()
+  with open(filename, 'rb') as input_file:
+    for block in iter(lambda: input_file.read(block_size), b''):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+class Checkpoint(object):
+  """The progress of a resumable annotation, kept in work_dir
+
+  The VCF is split into chunks in work_dir/chunks; as each chunk is
+  annotated its output, with the SHA-256 of its content, its annotation
+  errors and its summary, is recorded in a manifest.  When a run with the
+  same run_key (see checkpoint_key) is restarted, the chunks whose outputs
+  are still intact are skipped.  work_dir/database can be used as a
+  DatabaseCache so the database is only built once.  Anything left by a
+  run with a different run_key is removed first."""
+  def __init__(self, work_dir, run_key):
+    self.work_dir = os.path.abspath(work_dir)
+    self.run_key = run_key
+    self.chunks = None
+    os.makedirs(self.work_dir, exist_ok=True)
+    self._load()
+
+  @property
+  def manifest_filename(self):
+    return os.path.join(self.work_dir, MANIFEST_FILENAME)
+
+  @property
+  def chunk_dir(self):
+    return os.path.join(self.work_dir, 'chunks')
+
+  @property
+  def database_dir(self):
+    return os.path.join(self.work_dir, 'database')
+
+  def _path(self, filename):
+    return os.path.join(self.work_dir, filename)
+
+  def _reset(self):
+    self.chunks = None
+    for directory in [self.chunk_dir, self.database_dir]:
+      shutil.rmtree(directory, ignore_errors=True)
+    if os.path.isfile(self.manifest_filename):
+      os.remove(self.manifest_filename)
+
+  def _load(self):
+    try:
+      with open(self.manifest_filename, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    except FileNotFoundError:
+      self._reset()
+      return
+    except (OSError, ValueError) as e:
+      logger.warn("Could not read %s, starting again: %s" % (self.manifest_filename, e))
+      self._reset()
+      return
+    if (manifest.get('version') != CHECKPOINT_VERSION or
+        manifest.get('run_key') != self.run_key):
+      logger.warn("%s was left by a different run, starting again" % self.work_dir)
+      self._reset()
+      return
+    chunks = manifest['chunks']
+    for chunk in chunks:
+      input_filename = self._path(chunk['input'])
+      if not os.path.isfile(input_filename) or file_sha256(input_filename) != chunk['input_sha256']:
+        logger.warn("Chunk %s has changed, starting again" % input_filename)
+        self._reset()
+        return
+      if chunk['output'] is None:
+        continue
+      output_filename = self._path(chunk['output'])
+      if not os.path.isfile(output_filename) or file_sha256(output_filename) != chunk['output_sha256']:
+        logger.warn("The output of chunk %s is missing or has changed, annotating it again" %
+                    input_filename)
+        chunk.update(output=None, output_sha256=None, errors={}, summary=None)
+    self.chunks = chunks
+    logger.info("Resuming from %s: %s of %s chunks are already annotated" %
+                (self.work_dir, self.completed_chunks, len(self.chunks)))
+
+  def save(self):
+    """Writes the manifest atomically, so a run killed part way through leaves the last one"""
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=self.work_dir,
+                                     prefix='.manifest_') as manifest_file:
+      json.dump({'version': CHECKPOINT_VERSION, 'run_key': self.run_key,
+                 'chunks': self.chunks}, manifest_file, indent=1)
+    os.replace(manifest_file.name, self.manifest_filename)
+
+  def set_chunks(self, input_filenames):
+    """Records the chunks the VCF was split into"""
+    self.chunks = [{
+      'input': os.path.relpath(input_filename, self.work_dir),
+      'input_sha256': file_sha256(input_filename),
+      'output': None,
+      'output_sha256': None,
+      'errors': {},
+      'summary': None
+    } for input_filename in input_filenames]
+    self.save()
+
+  @property
+  def completed_chunks(self):
+    return sum(1 for chunk in self.chunks if chunk['output'] is not None)
+
+  def is_complete(self, index):
+    return self.chunks[index]['output'] is not None
+
+  def input_filename(self, index):
+    return self._path(self.chunks[index]['input'])
+
+  def output_filename(self, index):
+    return os.path.join(self.chunk_dir, "chunk_%s.annotated.vcf" % index)
+
+  def complete(self, index, output_filename, errors, summary=None):
+    """Moves a chunk's annotated VCF into place and records it in the manifest"""
+    os.replace(output_filename, self.output_filename(index))
+    chunk = self.chunks[index]
+    chunk['output'] = os.path.relpath(self.output_filename(index), self.work_dir)
+    chunk['output_sha256'] = file_sha256(self.output_filename(index))
+    chunk['errors'] = dict(errors)
+    if summary is not None:
+      summary_filename = os.path.join(self.chunk_dir, "chunk_%s.summary.json" % index)
+      summary.write(summary_filename)
+      chunk['summary'] = os.path.relpath(summary_filename, self.work_dir)
+    self.save()
+
+  def errors(self, index):
+    return Counter(self.chunks[index]['errors'])
+
+  def summary(self, index):
+    """The AnnotationSummary of a chunk
+
+    If the chunk was annotated by a run which didn't summarise it, its
+    output is summarised now."""
+    summary_filename = self.chunks[index]['summary']
+    if summary_filename is not None:
+      return AnnotationSummary.read(self._path(summary_filename))
+    summary = AnnotationSummary()
+    with open(self._path(self.chunks[index]['output']), 'r') as output_file:
+      for line in output_file:
+        if line[0] != '#':
+          summary.add_line(line)
+    return summary
+
+  def output_filenames(self):
+    return [self._path(chunk['output']) for chunk in self.chunks]
+
+  def remove(self):
+    """Removes the chunks, database and manifest once the output is finished"""
+    logger.debug("Removing checkpoint from %s" % self.work_dir)
+    self._reset()
+    try:
+      os.rmdir(self.work_dir)
+    except OSError:
+      pass # Not empty, e.g. the user's own files
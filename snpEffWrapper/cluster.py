@@ -0,0 +1,321 @@
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+
+from collections import Counter
+
+from .cache import DatabaseCache
+from .checkpoint import checkpoint_key, file_sha256
+from .compression import open_text, uncompressed_size
+from .shards import merged_vcf_lines, split_vcf_records
+from .summary import AnnotationSummary
+from .wrapper import (_annotate_vcf_file, _annotation_job_files, _clean_up_temp_database,
+                      _get_build_output_files, _get_database_cache, _snpeff_version, annotated_vcf_output,
+                      built_database, check_contigs, create_config_file, create_temp_database,
+                      get_genome_name, get_gff_contigs, get_output_options, get_vcf_contigs,
+                      log_annotation_errors, parse_coding_table, plan_annotation_resources,
+                      report_annotation_errors, run_metrics)
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+PLAN_FILENAME = 'plan.json'
+DEFAULT_SHARD_RECORDS = 1000000
+
+class ShardPlanError(ValueError):
+  pass
+
+def _write_json(content, filename):
+  """Writes JSON atomically, so a job killed part way through leaves the last version"""
+  with tempfile.NamedTemporaryFile(mode='w', delete=False,
+                                   dir=os.path.dirname(filename),
+                                   prefix='.%s_' % os.path.basename(filename)) as json_file:
+    json.dump(content, json_file, indent=1)
+  os.replace(json_file.name, filename)
+
+class ShardPlan(object):
+  """A VCF split into shards to be annotated by separate jobs, kept in work_dir
+
+  plan.json records the inputs, the database which is shared by the shards
+  and the VCF of each shard.  Each shard's job moves its output into
+  work_dir/outputs and then records it, with its annotation errors and
+  summary, in its own shard_N.done.json, so no two jobs ever write to the
+  same file and a shard is done only once all of that is in place."""
+  def __init__(self, work_dir, plan):
+    self.work_dir = os.path.abspath(work_dir)
+    self.plan = plan
+
+  @classmethod
+  def load(cls, work_dir):
+    plan_filename = os.path.join(work_dir, PLAN_FILENAME)
+    try:
+      with open(plan_filename, 'r') as plan_file:
+        plan = json.load(plan_file)
+    except FileNotFoundError:
+      raise ShardPlanError("%s hasn't been planned, run `snpEffBuildAndRun plan` first" %
+                           work_dir)
+    if plan.get('version') != PLAN_VERSION:
+      raise ShardPlanError("%s was planned by a different version of snpEffWrapper" %
+                           work_dir)
+    return cls(work_dir, plan)
+
+  @property
+  def shard_count(self):
+    return len(self.plan['shards'])
+
+  @property
+  def output_dir(self):
+    return os.path.join(self.work_dir, 'outputs')
+
+  def input_filename(self, index):
+    return os.path.join(self.work_dir, self.plan['shards'][index]['input'])
+
+  def output_filename(self, index):
+    return os.path.join(self.output_dir, "shard_%s.annotated.vcf" % index)
+
+  def summary_filename(self, index):
+    return os.path.join(self.output_dir, "shard_%s.summary.json" % index)
+
+  def done_filename(self, index):
+    return os.path.join(self.output_dir, "shard_%s.done.json" % index)
+
+  def done(self, index):
+    """What the shard's job recorded, or None if it isn't done or its output has changed"""
+    try:
+      with open(self.done_filename(index), 'r') as done_file:
+        done = json.load(done_file)
+    except (FileNotFoundError, ValueError):
+      return None
+    output_filename = self.output_filename(index)
+    if not os.path.isfile(output_filename) or file_sha256(output_filename) != done['output_sha256']:
+      logger.warn("The output of shard %s is missing or has changed" % index)
+      return None
+    return done
+
+  def check_input(self, index):
+    if file_sha256(self.input_filename(index)) != self.plan['shards'][index]['input_sha256']:
+      raise ShardPlanError("Shard %s has changed since it was planned, plan %s again" %
+                           (index, self.work_dir))
+
+  def complete(self, index, temp_output_filename, errors, summary):
+    os.replace(temp_output_filename, self.output_filename(index))
+    summary.write(self.summary_filename(index))
+    _write_json({'output_sha256': file_sha256(self.output_filename(index)),
+                 'errors': dict(errors)}, self.done_filename(index))
+
+def _run_key(args, coding_table):
+  inputs = []
+  for filename in [args.gff_file.name, args.vcf_file]:
+    input_stat = os.stat(filename)
+    inputs.append([os.path.realpath(filename), input_stat.st_size,
+                   input_stat.st_mtime])
+  return checkpoint_key(inputs, coding_table, _snpeff_version(args.snpeff_exec),
+                        args.shards, args.shard_records)
+
+def _shared_database(args, temp_database_dir, plan, resource_plan, metrics):
+  """The built_database context for a plan's database, building it if it isn't in the cache"""
+  database_cache = DatabaseCache(plan['cache_dir'])
+  build_stdout, build_stderr = _get_build_output_files(temp_database_dir,
+                                                       args.debug)
+  config_filename = create_config_file(temp_database_dir,
+                                       get_genome_name(args.gff_file),
+                                       plan['vcf_contigs'], plan['coding_table'])
+  return config_filename, built_database(temp_database_dir, args.java_exec,
+                                         args.snpeff_exec, config_filename,
+                                         build_stdout, build_stderr,
+                                         database_cache, plan['cache_key'],
+                                         resource_plan.build, metrics)
+
+def _build_shared_database(args, plan, metrics):
+  with metrics.stage('create_temp_database'):
+    temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir)
+  try:
+    with metrics.stage('plan_resources'):
+      resource_plan = plan_annotation_resources(args, 0, 1)
+    _, database = _shared_database(args, temp_database_dir, plan,
+                                   resource_plan, metrics)
+    with database:
+      pass
+  finally:
+    with metrics.stage('clean_up'):
+      _clean_up_temp_database(temp_database_dir, args.keep)
+
+def plan_shards(args):
+  """Splits args.vcf_file into shards for separate jobs and builds their database
+
+  The shards have args.shard_records records each or, if args.shards is
+  set, the records are shared as evenly as possible between that many.
+  The database is built into args.cache_dir, or work_dir/database, so the
+  jobs can share it.  Planning the same inputs with the same settings again
+  only makes sure the database is still there; planning something else in
+  the same args.work_dir is an error, as its shards may be running.
+  Returns the RunMetrics of the run."""
+  with run_metrics(args) as metrics:
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    with metrics.stage('parse_coding_table'):
+      coding_table = parse_coding_table(args.coding_table)
+    run_key = _run_key(args, coding_table)
+    if os.path.isfile(os.path.join(work_dir, PLAN_FILENAME)):
+      shard_plan = ShardPlan.load(work_dir)
+      if shard_plan.plan['run_key'] != run_key:
+        raise ShardPlanError("%s was planned for different inputs or settings, use a new directory" %
+                             work_dir)
+      logger.info("%s is already planned" % work_dir)
+      _build_shared_database(args, shard_plan.plan, metrics)
+      return metrics
+    with metrics.stage('get_gff_contigs'):
+      gff_contigs = get_gff_contigs(args.gff_file)
+    record_counts = Counter()
+    with metrics.stage('get_vcf_contigs'):
+      with open_text(args.vcf_file) as vcf_file:
+        vcf_contigs = get_vcf_contigs(vcf_file, record_counts)
+    records = sum(record_counts.values())
+    metrics.count('input_records', records)
+    with metrics.stage('check_contigs'):
+      check_contigs(vcf_contigs, gff_contigs, coding_table)
+    shard_records = args.shard_records
+    if args.shards is not None:
+      shard_records = max(1, int(math.ceil(records / float(args.shards))))
+    shard_dir = os.path.join(work_dir, 'shards')
+    shutil.rmtree(shard_dir, ignore_errors=True) # Left by a plan which didn't finish
+    os.makedirs(shard_dir)
+    with metrics.stage('split_vcf'):
+      with open_text(args.vcf_file) as vcf_file:
+        shard_filenames = split_vcf_records(vcf_file, shard_dir, shard_records)
+    metrics.count('shards', len(shard_filenames))
+    args.cache_dir = args.cache_dir or os.path.join(work_dir, 'database')
+    with metrics.stage('database_cache_key'):
+      _, cache_key = _get_database_cache(args, gff_contigs, coding_table)
+    plan = {
+      'version': PLAN_VERSION,
+      'run_key': run_key,
+      'gff_file': os.path.abspath(args.gff_file.name),
+      'vcf_file': os.path.abspath(args.vcf_file),
+      'snpeff_exec': os.path.abspath(args.snpeff_exec),
+      'coding_table': coding_table,
+      'vcf_contigs': vcf_contigs,
+      'cache_dir': os.path.abspath(args.cache_dir),
+      'cache_key': cache_key,
+      'records': records,
+      'shards': [{
+        'input': os.path.relpath(shard_filename, work_dir),
+        'input_sha256': file_sha256(shard_filename),
+        'records': min(shard_records, records - i * shard_records)
+      } for i, shard_filename in enumerate(shard_filenames)]
+    }
+    _build_shared_database(args, plan, metrics)
+    os.makedirs(os.path.join(work_dir, 'outputs'), exist_ok=True)
+    _write_json(plan, os.path.join(work_dir, PLAN_FILENAME))
+    logger.info("Planned %s shards of the %s records in %s" % (len(shard_filenames),
+                                                              records, work_dir))
+  return metrics
+
+def planned_snpeff_exec(work_dir):
+  """The SnpEff the plan in work_dir was built with, which its shards must use"""
+  return ShardPlan.load(work_dir).plan['snpeff_exec']
+
+def run_shard(args):
+  """Annotates shard args.index of the plan in args.work_dir
+
+  The plan's GFF and SnpEff are used, with the database built by
+  plan_shards; args.snpeff_exec should already be set to the plan's (see
+  planned_snpeff_exec).  If the shard is already done this does nothing, so
+  failed or duplicated jobs can simply be run again.  The output is only
+  recorded once it's complete.  Returns the RunMetrics of the run."""
+  with run_metrics(args) as metrics:
+    shard_plan = ShardPlan.load(args.work_dir)
+    plan = shard_plan.plan
+    index = args.index
+    if index < 0 or index >= shard_plan.shard_count:
+      raise ShardPlanError("There are only %s shards in %s" % (shard_plan.shard_count,
+                                                             args.work_dir))
+    if shard_plan.done(index) is not None:
+      logger.info("Shard %s is already annotated" % index)
+      return metrics
+    shard_plan.check_input(index)
+    input_filename = shard_plan.input_filename(index)
+    metrics.count('input_records', plan['shards'][index]['records'])
+    with open(plan['gff_file'], 'r') as args.gff_file:
+      with metrics.stage('create_temp_database'):
+        temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir)
+      try:
+        with metrics.stage('plan_resources'):
+          resource_plan = plan_annotation_resources(args,
+                                                    uncompressed_size(input_filename),
+                                                    1)
+        config_filename, database = _shared_database(args, temp_database_dir,
+                                                     plan, resource_plan,
+                                                     metrics)
+        with database, metrics.stage('annotate'):
+          _, stderr_filename, annotation_stats_file = _annotation_job_files(temp_database_dir, index, args.debug)
+          with tempfile.NamedTemporaryFile(delete=False, dir=shard_plan.output_dir,
+                                           prefix='.shard_%s_' % index) as temp_output_file:
+            pass
+          try:
+            errors, processes, summary = _annotate_vcf_file(args.java_exec, args.snpeff_exec,
+                                                            input_filename, config_filename,
+                                                            temp_output_file.name,
+                                                            stderr_filename,
+                                                            annotation_stats_file,
+                                                            resource_plan.annotate,
+                                                            expected_records=plan['shards'][index]['records'],
+                                                            progress_interval=args.progress_interval,
+                                                            summarise=True)
+            metrics.add_processes(processes)
+            metrics.count('output_records', summary.records)
+            metrics.count('annotation_errors', sum(errors.values()))
+            shard_plan.complete(index, temp_output_file.name, errors, summary)
+          finally:
+            if os.path.isfile(temp_output_file.name):
+              os.remove(temp_output_file.name)
+      finally:
+        with metrics.stage('clean_up'):
+          _clean_up_temp_database(temp_database_dir, args.keep)
+    log_annotation_errors(errors)
+    logger.info("Annotated shard %s of %s" % (index, shard_plan.shard_count))
+  return metrics
+
+def merge_shards(args):
+  """Merges the outputs of every shard of the plan in args.work_dir into args.output_vcf
+
+  The annotation errors of all of the shards are checked together, as
+  check_annotations would for the whole VCF; AnnotationError is raised,
+  and nothing is written, if there were any.  args.summary_file gets the
+  summary of all of the shards.  Returns the RunMetrics of the run."""
+  with run_metrics(args) as metrics:
+    shard_plan = ShardPlan.load(args.work_dir)
+    error_counter = Counter()
+    missing_shards = []
+    for index in range(shard_plan.shard_count):
+      done = shard_plan.done(index)
+      if done is None:
+        missing_shards.append(index)
+      else:
+        error_counter.update(done['errors'])
+    if len(missing_shards) > 0:
+      raise ShardPlanError("%s of %s shards haven't been annotated: %s" %
+                           (len(missing_shards), shard_plan.shard_count,
+                            ", ".join(str(index) for index in missing_shards)))
+    metrics.count('shards', shard_plan.shard_count)
+    metrics.count('annotation_errors', sum(error_counter.values()))
+    logger.info("Checking the annotated shards for common issues")
+    with metrics.stage('check_annotations'):
+      report_annotation_errors(error_counter)
+    with metrics.stage('merge_vcfs'):
+      with annotated_vcf_output(args.output_vcf,
+                                output_options=get_output_options(args),
+                                metrics=metrics) as output_file:
+        output_file.writelines(merged_vcf_lines([shard_plan.output_filename(index)
+                                                 for index in range(shard_plan.shard_count)]))
+    metrics.count('output_records', shard_plan.plan['records'])
+    if args.summary_file is not None:
+      with metrics.stage('write_summary'):
+        summary = AnnotationSummary()
+        for index in range(shard_plan.shard_count):
+          summary.merge(AnnotationSummary.read(shard_plan.summary_filename(index)))
+        summary.write(args.summary_file)
+  return metrics
@@ -0,0 +1,130 @@
+import logging
+import threading
+
+from collections import OrderedDict
+
+from .compression import open_text
+
+logger = logging.getLogger(__name__)
+
+SITES_HEADER = [
+  "##fileformat=VCFv4.1\n",
+  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+]
+
+def _site(line):
+  """The (CHROM, POS, REF, ALT) of a VCF record"""
+  chrom, pos, _, ref, alt = line.split('\t', 5)[:5]
+  return chrom, pos, ref, alt.rstrip('\r\n')
+
+def collect_sites(vcf_filenames, record_counts=None):
+  """Collects the unique sites of a batch of VCFs
+
+  Returns an OrderedDict of each contig, in the order they're first seen,
+  to the set of (POS, REF, ALT) on it.  If record_counts is a list the
+  number of records in each VCF is appended to it."""
+  sites = OrderedDict()
+  for vcf_filename in vcf_filenames:
+    records = 0
+    with open_text(vcf_filename) as vcf_file:
+      for line in vcf_file:
+        if line[0] == '#':
+          continue
+        chrom, pos, ref, alt = _site(line)
+        contig_sites = sites.get(chrom)
+        if contig_sites is None:
+          contig_sites = sites[chrom] = set()
+        contig_sites.add((int(pos), ref, alt))
+        records += 1
+    if record_counts is not None:
+      record_counts.append(records)
+  return sites
+
+def write_sites_vcf(sites, sites_filename):
+  """Writes sites (see collect_sites) to a sites-only VCF sorted by position
+
+  Returns the number of sites"""
+  count = 0
+  with open(sites_filename, 'w') as sites_file:
+    sites_file.writelines(SITES_HEADER)
+    for chrom, contig_sites in sites.items():
+      for pos, ref, alt in sorted(contig_sites):
+        sites_file.write("%s\t%s\t.\t%s\t%s\t.\t.\t.\n" % (chrom, pos, ref, alt))
+        count += 1
+  return count
+
+class SiteAnnotations(object):
+  """Looks up the annotations SnpEff gave each site of a sites-only VCF
+
+  Only the byte offset of each annotated site is kept in memory; its INFO
+  is read from the file when it's needed.  header is the list of header
+  lines SnpEff added (e.g. the ##INFO line for ANN)."""
+  def __init__(self, annotated_sites_filename):
+    self.filename = annotated_sites_filename
+    self.header = []
+    self.offsets = {}
+    self._file = open(annotated_sites_filename, 'rb')
+    self._lock = threading.Lock()
+    offset = 0
+    for line in self._file:
+      if line[:1] == b'#':
+        if not line.startswith(b'##fileformat') and not line.startswith(b'#CHROM'):
+          self.header.append(line.decode('utf-8'))
+      else:
+        self.offsets[_site(line.decode('utf-8'))] = offset
+      offset += len(line)
+
+  def info(self, site):
+    """The INFO SnpEff wrote for site, or None if it isn't in the sites VCF"""
+    offset = self.offsets.get(site)
+    if offset is None:
+      return None
+    with self._lock:
+      self._file.seek(offset)
+      line = self._file.readline()
+    return line.decode('utf-8').split('\t', 8)[7].rstrip('\r\n')
+
+  def close(self):
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.close()
+
+_site_annotations = {}
+
+def get_site_annotations(annotated_sites_filename):
+  """The SiteAnnotations of a file, read once in each process which joins VCFs to it"""
+  site_annotations = _site_annotations.get(annotated_sites_filename)
+  if site_annotations is None:
+    site_annotations = SiteAnnotations(annotated_sites_filename)
+    _site_annotations[annotated_sites_filename] = site_annotations
+  return site_annotations
+
+def forget_site_annotations(annotated_sites_filename):
+  site_annotations = _site_annotations.pop(annotated_sites_filename, None)
+  if site_annotations is not None:
+    site_annotations.close()
+
+def joined_vcf_lines(vcf_file, site_annotations):
+  """Yields the lines of a VCF with the annotations of its sites added
+
+  The header lines SnpEff added are put before the #CHROM line and the
+  INFO SnpEff gave each site is appended to the record's own, as if the
+  VCF had been annotated by itself."""
+  for line in vcf_file:
+    if line[0] == '#':
+      if line.startswith('#CHROM'):
+        yield from site_annotations.header
+      yield line
+      continue
+    columns = line.split('\t', 8)
+    added_info = site_annotations.info(_site(line))
+    if added_info is not None and added_info != '.':
+      info = columns[7].rstrip('\r\n')
+      ending = columns[7][len(info):]
+      columns[7] = (added_info if info in ['', '.'] else "%s;%s" % (info, added_info)) + ending
+      line = '\t'.join(columns)
+    yield line
@@ -0,0 +1,301 @@
+import gzip
+import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes per BGZF block, the same as htslib so a block always
+# fits in the 64KB limit even if it doesn't compress
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+TABIX_LINEAR_SHIFT = 14
+
+OutputOptions = namedtuple('OutputOptions', ['bgzip', 'threads', 'tabix'])
+
+class CompressionError(ValueError):
+  pass
+
+def is_gzipped(filename):
+  """Checks for the gzip magic number; bgzip files are gzip files too"""
+  try:
+    with open(filename, 'rb') as input_file:
+      return input_file.read(2) == b'\x1f\x8b'
+  except (OSError, TypeError):
+    return False
+
+def is_compressed_filename(filename):
+  return re.search('\\.b?gz$', filename) is not None
+
+def strip_compression_extension(filename):
+  return re.sub('\\.b?gz$', '', filename)
+
+def open_binary(filename):
+  """Opens a file for reading bytes, decompressing it if it's gzipped"""
+  if is_gzipped(filename):
+    return gzip.open(filename, 'rb')
+  return open(filename, 'rb')
+
+def open_text(filename):
+  """Opens a file for reading text, decompressing it if it's gzipped"""
+  if is_gzipped(filename):
+    return gzip.open(filename, 'rt', encoding='utf-8')
+  return open(filename, 'r')
+
+def reopen_text(input_file):
+  """Reopens a file which was opened as text with a decompressing reader
+
+  Files which aren't gzipped, or aren't on disk, are returned unchanged"""
+  filename = getattr(input_file, 'name', None)
+  if not isinstance(filename, str) or not is_gzipped(filename):
+    return input_file
+  input_file.close()
+  return open_text(filename)
+
+def copy_decompressed(input_filename, output_filename):
+  if not is_gzipped(input_filename):
+    shutil.copy(input_filename, output_filename)
+    return
+  logger.debug("Decompressing %s to %s" % (input_filename, output_filename))
+  with gzip.open(input_filename, 'rb') as input_file, \
+       open(output_filename, 'wb') as output_file:
+    shutil.copyfileobj(input_file, output_file, 1024*1024)
+
+def uncompressed_size(filename):
+  """Size of a file once it's decompressed
+
+  Adds up the sizes in the footers of the blocks of bgzip files (which
+  doesn't need to decompress them); other gzip files only record their size
+  modulo 4GB"""
+  if not is_gzipped(filename):
+    return os.path.getsize(filename)
+  total = 0
+  with open(filename, 'rb') as input_file:
+    while True:
+      header = input_file.read(18)
+      if len(header) == 0:
+        return total
+      if len(header) < 18 or header[12:14] != b'BC':
+        break # Not bgzip
+      block_size = struct.unpack('<H', header[16:18])[0] + 1
+      input_file.seek(block_size - 18 - 4, os.SEEK_CUR)
+      total += struct.unpack('<I', input_file.read(4))[0]
+    input_file.seek(-4, os.SEEK_END)
+    return struct.unpack('<I', input_file.read(4))[0]
+
+def compress_block(data, level=6):
+  """Compresses up to BGZF_BLOCK_SIZE bytes into a BGZF block"""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+  compressed = compressor.compress(data) + compressor.flush()
+  header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                       ord('B'), ord('C'), 2, len(compressed) + 25)
+  footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+  return header + compressed + footer
+
+def _reg2bin(beg, end):
+  """The smallest UCSC bin containing [beg, end), as used by tabix"""
+  end -= 1
+  for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+    if beg >> shift == end >> shift:
+      return offset + (beg >> shift)
+  return 0
+
+class TabixIndex(object):
+  """Builds a tabix index of a VCF from the records as they are written
+
+  Offsets are kept as positions in the uncompressed VCF until the index is
+  written, when they are converted to BGZF virtual offsets."""
+  def __init__(self):
+    self.contigs = []
+    self.bins = {}
+    self.linear = {}
+    self.last_start = None
+    self.sorted = True
+
+  def add(self, line, start_offset, end_offset):
+    if line[:1] == b'#' or not self.sorted:
+      return
+    fields = line.split(b'\t', 5)
+    try:
+      contig = fields[0].decode('utf-8')
+      beg = int(fields[1]) - 1
+      end = beg + max(len(fields[3]), 1)
+    except (IndexError, ValueError):
+      return # Not a record, tabix would skip it too
+    if len(self.contigs) == 0 or contig != self.contigs[-1]:
+      if contig in self.bins:
+        logger.warn("Not indexing the VCF, %s is in more than one block" % contig)
+        self.sorted = False
+        return
+      self.contigs.append(contig)
+      self.bins[contig] = {}
+      self.linear[contig] = []
+      self.last_start = None
+    elif beg < self.last_start:
+      logger.warn("Not indexing the VCF, %s isn't sorted by position" % contig)
+      self.sorted = False
+      return
+    self.last_start = beg
+    chunks = self.bins[contig].setdefault(_reg2bin(beg, end), [])
+    if len(chunks) > 0 and chunks[-1][1] == start_offset:
+      chunks[-1][1] = end_offset
+    else:
+      chunks.append([start_offset, end_offset])
+    linear = self.linear[contig]
+    for window in range(beg >> TABIX_LINEAR_SHIFT,
+                        ((end - 1) >> TABIX_LINEAR_SHIFT) + 1):
+      if window >= len(linear):
+        linear.extend([None] * (window + 1 - len(linear)))
+      if linear[window] is None:
+        linear[window] = start_offset
+
+  def to_bytes(self, virtual_offset):
+    """Serialises the index, using virtual_offset to convert offsets"""
+    names = b''.join(contig.encode('utf-8') + b'\0' for contig in self.contigs)
+    output = [b'TBI\1', struct.pack('<i', len(self.contigs)),
+              struct.pack('<6i', 2, 1, 2, 0, ord('#'), 0), # VCF preset
+              struct.pack('<i', len(names)), names]
+    for contig in self.contigs:
+      bins = self.bins[contig]
+      output.append(struct.pack('<i', len(bins)))
+      for bin_number in sorted(bins):
+        chunks = bins[bin_number]
+        output.append(struct.pack('<Ii', bin_number, len(chunks)))
+        for start, end in chunks:
+          output.append(struct.pack('<QQ', virtual_offset(start),
+                                    virtual_offset(end)))
+      linear = []
+      previous = 0
+      for offset in self.linear[contig]:
+        previous = virtual_offset(offset) if offset is not None else previous
+        linear.append(previous)
+      output.append(struct.pack('<i%sQ' % len(linear), len(linear), *linear))
+    return b''.join(output)
+
+class BgzfWriter(object):
+  """Writes text to a file as BGZF (bgzip) blocks compressed in a thread pool
+
+  zlib releases the GIL so blocks are compressed in parallel; they are
+  written in order as they finish.  If index is True, a tabix index of the
+  VCF being written is built at the same time (see write_index)."""
+  def __init__(self, output_file, threads=1, index=False, level=6,
+               close_file=True):
+    self.output_file = output_file
+    self.name = getattr(output_file, 'name', None)
+    self.threads = threads
+    self.level = level
+    self.close_file = close_file
+    self.executor = ThreadPoolExecutor(max_workers=threads)
+    self.pending = deque()
+    self.buffer = bytearray()
+    self.block_offsets = []
+    self.compressed_offset = 0
+    self.uncompressed_offset = 0
+    self.index = TabixIndex() if index else None
+    self.partial_line = b''
+    self.closed = False
+
+  def _write_next_block(self):
+    compressed = self.pending.popleft().result()
+    self.block_offsets.append(self.compressed_offset)
+    self.output_file.write(compressed)
+    self.compressed_offset += len(compressed)
+
+  def _submit_block(self, data):
+    self.pending.append(self.executor.submit(compress_block, data, self.level))
+    if len(self.pending) > self.threads * 4:
+      self._write_next_block()
+
+  def _index_lines(self, data):
+    start = 0
+    while True:
+      newline = data.find(b'\n', start)
+      if newline == -1:
+        self.partial_line += data[start:]
+        return
+      line = self.partial_line + data[start:newline+1]
+      line_start = self.uncompressed_offset - len(self.partial_line) + start
+      self.index.add(line, line_start, line_start + len(line))
+      self.partial_line = b''
+      start = newline + 1
+
+  def write(self, text):
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    if self.index is not None:
+      self._index_lines(data)
+    self.uncompressed_offset += len(data)
+    self.buffer += data
+    while len(self.buffer) >= BGZF_BLOCK_SIZE:
+      self._submit_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+      del self.buffer[:BGZF_BLOCK_SIZE]
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    self.output_file.flush()
+
+  def close(self):
+    if self.closed:
+      return
+    if len(self.buffer) > 0:
+      self._submit_block(bytes(self.buffer))
+      self.buffer = bytearray()
+    while len(self.pending) > 0:
+      self._write_next_block()
+    self.block_offsets.append(self.compressed_offset) # Where the EOF block is
+    self.output_file.write(BGZF_EOF)
+    self.executor.shutdown()
+    if self.close_file:
+      self.output_file.close()
+    else:
+      self.output_file.flush()
+    self.closed = True
+
+  def abort(self):
+    """Stops compressing without finishing the file"""
+    self.executor.shutdown(wait=False)
+    if self.close_file:
+      self.output_file.close()
+    self.closed = True
+
+  def _virtual_offset(self, offset):
+    block, within_block = divmod(offset, BGZF_BLOCK_SIZE)
+    return (self.block_offsets[block] << 16) | within_block
+
+  def write_index(self, index_filename):
+    """Writes the tabix index once the file is closed
+
+    Returns False, without writing anything, if the VCF couldn't be indexed
+    because it isn't sorted"""
+    if self.index is None or not self.closed:
+      raise CompressionError("Can only write an index for a finished, indexed file")
+    if not self.index.sorted:
+      return False
+    index_bytes = self.index.to_bytes(self._virtual_offset)
+    with tempfile.NamedTemporaryFile(mode='wb', delete=False,
+                                     dir=os.path.dirname(os.path.abspath(index_filename)),
+                                     prefix='.tabix_') as index_file:
+      for start in range(0, len(index_bytes), BGZF_BLOCK_SIZE):
+        index_file.write(compress_block(index_bytes[start:start+BGZF_BLOCK_SIZE]))
+      index_file.write(BGZF_EOF)
+    os.replace(index_file.name, index_filename)
+    logger.info("Wrote tabix index %s" % index_filename)
+    return True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    if exception_type is None:
+      self.close()
+    else:
+      self.abort()
@@ -0,0 +1,149 @@
+import logging
+import os
+import re
+import tempfile
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Rules for matching contigs which are named differently in the VCF and GFF;
+# each normalises a name and contigs match if their normalised names do
+ALIAS_RULES = OrderedDict([
+  ('chr', lambda contig: re.sub('^[cC]hr(?=.)', '', contig)),
+  ('version', lambda contig: re.sub('\\.\\d+$', '', contig))
+])
+
+REPORT_HEADER = "vcf_contig\tgff_contig\tstatus\trecords\n"
+
+class ContigAliasError(ValueError):
+  pass
+
+def parse_alias_rules(rules):
+  """Parses a list, or comma separated string, of the names of ALIAS_RULES"""
+  if rules is None:
+    return []
+  if isinstance(rules, str):
+    rules = [rule.strip() for rule in rules.split(',') if rule.strip() != '']
+  unknown_rules = [rule for rule in rules if rule not in ALIAS_RULES]
+  if len(unknown_rules) > 0:
+    raise ContigAliasError("Unknown contig alias rules '%s', choose from '%s'" %
+                           ("', '".join(unknown_rules), "', '".join(ALIAS_RULES)))
+  return list(rules)
+
+def read_contig_aliases(alias_filename):
+  """Reads a file of the name of each contig in the VCF and its name in the GFF
+
+  Each line has the two names separated by whitespace; blank lines and
+  lines starting with '#' are ignored."""
+  aliases = {}
+  with open(alias_filename, 'r') as alias_file:
+    for line_number, line in enumerate(alias_file, 1):
+      if line.strip() == '' or line[0] == '#':
+        continue
+      names = line.split()
+      if len(names) != 2:
+        raise ContigAliasError("Expected a VCF contig and a GFF contig on line %s of %s" %
+                               (line_number, alias_filename))
+      aliases[names[0]] = names[1]
+  return aliases
+
+class ContigAliases(object):
+  """The other names a VCF's contigs might have in the GFF
+
+  aliases is a dict of the name of a contig in the VCF to its name in the
+  GFF, rules a list of the names of ALIAS_RULES to apply to both."""
+  def __init__(self, aliases=None, rules=None):
+    self.aliases = dict(aliases or {})
+    self.rules = parse_alias_rules(rules)
+
+  def __bool__(self):
+    return len(self.aliases) > 0 or len(self.rules) > 0
+
+  def normalise(self, contig):
+    for rule in self.rules:
+      contig = ALIAS_RULES[rule](contig)
+    return contig
+
+class ContigReconciliation(object):
+  """How the contigs of VCFs match the contigs with features in a GFF
+
+  Each VCF contig is matched by its own name, then its alias (if any) and
+  then, if aliases has rules, by its normalised name if only one GFF
+  contig normalises to it.  All of the lookups are in dicts or sets, so
+  this is linear in the number of contigs.  gff_names maps each VCF
+  contig which was found to its name in the GFF and missing lists those
+  which weren't.  A GFF contig is only matched to one VCF contig; its
+  own name wins, otherwise the first."""
+  def __init__(self, vcf_contigs, gff_contigs, aliases=None,
+               record_counts=None):
+    aliases = aliases if aliases is not None else ContigAliases()
+    self.vcf_contigs = list(vcf_contigs)
+    self.gff_contigs = list(gff_contigs)
+    self.record_counts = record_counts
+    self.gff_names = OrderedDict()
+    self.missing = []
+    gff_contig_set = set(self.gff_contigs)
+    normalised_gff_names = {}
+    if aliases.rules:
+      for contig in self.gff_contigs:
+        normalised = aliases.normalise(contig)
+        # None marks a normalised name which more than one contig has
+        normalised_gff_names[normalised] = None if normalised in normalised_gff_names else contig
+    # The VCF contig each GFF contig has been matched to
+    matched = {contig: contig for contig in self.vcf_contigs if contig in gff_contig_set}
+    for contig in self.vcf_contigs:
+      if contig in gff_contig_set:
+        self.gff_names[contig] = contig
+        continue
+      gff_name = aliases.aliases.get(contig)
+      if gff_name not in gff_contig_set and aliases.rules:
+        gff_name = normalised_gff_names.get(aliases.normalise(contig))
+      if gff_name is None or gff_name not in gff_contig_set:
+        self.missing.append(contig)
+      elif gff_name in matched:
+        logger.warn("Could not use '%s' for contig '%s', it's already used for '%s'" %
+                    (gff_name, contig, matched[gff_name]))
+        self.missing.append(contig)
+      else:
+        self.gff_names[contig] = gff_name
+        matched[gff_name] = contig
+    self.unused = [contig for contig in self.gff_contigs if contig not in matched]
+
+  @property
+  def renames(self):
+    """A dict of each GFF contig which is called something else in the VCF to that name"""
+    return {gff_name: contig for contig, gff_name in self.gff_names.items()
+            if gff_name != contig}
+
+  def status(self, contig):
+    if contig not in self.gff_names:
+      return 'missing'
+    return 'matched' if self.gff_names[contig] == contig else 'aliased'
+
+  def log(self):
+    renames = self.renames
+    for gff_name, contig in sorted(renames.items()):
+      logger.debug("Using GFF contig '%s' for VCF contig '%s'" % (gff_name, contig))
+    logger.info("Matched %s of %s VCF contigs to the GFF, %s by an alias" %
+                (len(self.gff_names), len(self.vcf_contigs), len(renames)))
+
+  def report_lines(self):
+    """Yields the lines of a TSV of the status of each VCF and GFF contig"""
+    yield REPORT_HEADER
+    for contig in self.vcf_contigs:
+      records = ''
+      if self.record_counts is not None:
+        records = self.record_counts.get(contig, 0)
+      yield "%s\t%s\t%s\t%s\n" % (contig, self.gff_names.get(contig, ''),
+                                  self.status(contig), records)
+    for contig in self.unused:
+      yield "\t%s\tunused\t\n" % contig
+
+  def write(self, report_filename):
+    """Writes the report atomically"""
+    report_dir = os.path.dirname(os.path.abspath(report_filename))
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=report_dir,
+                                     prefix='.contig_report_') as report_file:
+      report_file.writelines(self.report_lines())
+    os.replace(report_file.name, report_filename)
@@ -0,0 +1,154 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# SnpEff's impacts, from most to least severe
+IMPACTS = ['HIGH', 'MODERATE', 'LOW', 'MODIFIER']
+
+FILTER_HEADER = '##snpEffWrapperFilter'
+
+class FilterError(ValueError):
+  pass
+
+def _split_list(values):
+  if isinstance(values, str):
+    values = values.split(',')
+  return [value.strip() for value in values if value.strip() != '']
+
+def parse_impacts(impacts):
+  """Parses a list, or comma separated string, of IMPACTS (in any case)"""
+  if impacts is None:
+    return None
+  impacts = [impact.upper() for impact in _split_list(impacts)]
+  unknown_impacts = [impact for impact in impacts if impact not in IMPACTS]
+  if len(unknown_impacts) > 0:
+    raise FilterError("Unknown impacts '%s', choose from '%s'" %
+                      ("', '".join(unknown_impacts), "', '".join(IMPACTS)))
+  if len(impacts) == 0:
+    raise FilterError("No impacts to keep")
+  return impacts
+
+def parse_effect_terms(effects):
+  """Parses a list, or comma separated string, of sequence ontology terms e.g. 'missense_variant'"""
+  if effects is None:
+    return None
+  effects = _split_list(effects)
+  if len(effects) == 0:
+    raise FilterError("No effects to keep")
+  return effects
+
+def read_gene_list(gene_filename):
+  """Reads a file of gene names or IDs, one per line
+
+  Blank lines and lines starting with '#' are ignored."""
+  genes = []
+  with open(gene_filename, 'r') as gene_file:
+    for line in gene_file:
+      if line.strip() == '' or line[0] == '#':
+        continue
+      genes.append(line.strip())
+  if len(genes) == 0:
+    raise FilterError("No genes in %s" % gene_filename)
+  return genes
+
+def _ann_span(info):
+  """The start and end of the value of the ANN field in an INFO column, or None
+
+  The INFO column is the last one of a VCF without samples, so the end is
+  before any newline."""
+  if info.startswith('ANN='):
+    start = 4
+  else:
+    start = info.find(';ANN=')
+    if start == -1:
+      return None
+    start += 5
+  end = info.find(';', start)
+  return start, len(info.rstrip('\r\n')) if end == -1 else end
+
+class AnnotationFilter(object):
+  """Keeps the records of an annotated VCF with an annotation of interest
+
+  A record is kept if any of the annotations in its ANN field has one of
+  impacts, one of effects among its terms and one of genes as its gene name
+  or ID; criteria which are None aren't checked.  Records without any
+  annotations are dropped.  If prune is set, the annotations of the kept
+  records which don't match are removed from their ANN fields.  kept and
+  removed count the records as they are filtered."""
+  def __init__(self, impacts=None, effects=None, genes=None, prune=False):
+    self.impacts = None if impacts is None else set(parse_impacts(impacts))
+    self.effects = None if effects is None else set(parse_effect_terms(effects))
+    self.genes = None if genes is None else set(genes)
+    self.prune = prune
+    self.kept = 0
+    self.removed = 0
+    # A record can only have an impact if it is somewhere in the line
+    self._impact_markers = None
+    if self.impacts is not None:
+      self._impact_markers = ['|%s|' % impact for impact in self.impacts]
+
+  def describe(self):
+    criteria = []
+    if self.impacts is not None:
+      criteria.append("impacts=%s" % ",".join(impact for impact in IMPACTS
+                                              if impact in self.impacts))
+    if self.effects is not None:
+      criteria.append("effects=%s" % ",".join(sorted(self.effects)))
+    if self.genes is not None:
+      criteria.append("genes=%s" % len(self.genes))
+    if self.prune:
+      criteria.append("only_matching_annotations")
+    return ";".join(criteria)
+
+  def header_line(self):
+    """A header line recording the filter, added before #CHROM"""
+    return '%s="%s"\n' % (FILTER_HEADER, self.describe())
+
+  def matches(self, annotation):
+    """Does one annotation of an ANN field match all of the criteria?"""
+    fields = annotation.split('|', 5)
+    if len(fields) < 5:
+      return False
+    if self.impacts is not None and fields[2] not in self.impacts:
+      return False
+    if self.effects is not None and self.effects.isdisjoint(fields[1].split('&')):
+      return False
+    if self.genes is not None and fields[3] not in self.genes and fields[4] not in self.genes:
+      return False
+    return True
+
+  def filter_line(self, line):
+    """The line to write in place of a line of an annotated VCF, or None to drop it"""
+    if line[0] == '#':
+      if line.startswith('#CHROM'):
+        return self.header_line() + line
+      return line
+    if self._impact_markers is not None and not any(marker in line for marker in self._impact_markers):
+      self.removed += 1
+      return None
+    columns = line.split('\t', 8)
+    span = _ann_span(columns[7]) if len(columns) > 7 else None
+    if span is None:
+      self.removed += 1
+      return None
+    start, end = span
+    annotations = columns[7][start:end].split(',')
+    matching = [annotation for annotation in annotations if self.matches(annotation)]
+    if len(matching) == 0:
+      self.removed += 1
+      return None
+    self.kept += 1
+    if not self.prune or len(matching) == len(annotations):
+      return line
+    columns[7] = columns[7][:start] + ','.join(matching) + columns[7][end:]
+    return '\t'.join(columns)
+
+def get_annotation_filter(impacts=None, effects=None, gene_filename=None,
+                          prune=False):
+  """An AnnotationFilter for the options of a run, or None if it doesn't filter"""
+  if impacts is None and effects is None and gene_filename is None:
+    if prune:
+      raise FilterError("Keeping only the matching annotations needs impacts, effects or genes to match")
+    return None
+  genes = None if gene_filename is None else read_gene_list(gene_filename)
+  return AnnotationFilter(impacts, effects, genes, prune)
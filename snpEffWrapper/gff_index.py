@@ -0,0 +1,214 @@
+import io
+import json
+import logging
+import os
+import tempfile
+
+from collections import OrderedDict, namedtuple
+
+from .compression import open_binary
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+
+FastaRecord = namedtuple('FastaRecord', ['name', 'length', 'offset',
+                                         'line_bases', 'line_width'])
+
+class GFFIndex(object):
+  """Summary of a GFF from a single pass over it
+
+  feature_counts maps each contig with features to the number of features
+  on it.  sequences maps the name of each record in the ##FASTA section to
+  a FastaRecord with its length, the byte offset of its first base and the
+  number of bases and bytes on each line (like a samtools .fai).  If the
+  lines of a sequence aren't all the same width (see _check_line_widths)
+  its line_bases and line_width are None, so offsets within it can't be
+  worked out and it has to be read line by line."""
+  def __init__(self, feature_counts=None, sequences=None, fasta_offset=None):
+    self.feature_counts = feature_counts if feature_counts is not None else OrderedDict()
+    self.sequences = sequences if sequences is not None else OrderedDict()
+    self.fasta_offset = fasta_offset
+
+  @property
+  def feature_contigs(self):
+    return sorted(self.feature_counts)
+
+  def to_dict(self):
+    return {
+      'version': INDEX_VERSION,
+      'feature_counts': list(self.feature_counts.items()),
+      'sequences': [list(record) for record in self.sequences.values()],
+      'fasta_offset': self.fasta_offset
+    }
+
+  @classmethod
+  def from_dict(cls, index_dict):
+    feature_counts = OrderedDict(index_dict['feature_counts'])
+    sequences = OrderedDict((record[0], FastaRecord(*record))
+                            for record in index_dict['sequences'])
+    return cls(feature_counts, sequences, index_dict['fasta_offset'])
+
+def _check_line_widths(record, segment):
+  """Checks that the lines of part of a sequence are as wide as its first line
+
+  This is samtools faidx's rule: every line but the last must be the same
+  width and the last can't be wider.  record is the list _index_fasta is
+  building, ending with whether a shorter (so the last) line has been seen
+  and whether the lines are all the same width so far."""
+  if not segment.endswith(b'\n'):
+    segment += b'\n' # The end of the file
+  if record[4] is None:
+    line_width = segment.find(b'\n') + 1
+    record[3] = len(segment[:line_width].rstrip(b'\r\n'))
+    record[4] = line_width
+  if not record[6]:
+    return
+  width = record[4]
+  full_lines, last_line = divmod(len(segment), width)
+  line_ends = segment[width-1:full_lines*width:width]
+  if (record[3] == 0 or record[5] or line_ends.count(b'\n') != full_lines or
+      segment.count(b'\n') != full_lines + (1 if last_line else 0)):
+    record[6] = False
+  record[5] = last_line > 0
+
+def _index_fasta(gff_file, start, sequences, block_size=4*1024*1024):
+  """Indexes the sequences in a GFF from start to the end of the file
+
+  Reads the FASTA in large blocks, only looking at the headers, rather than
+  splitting every line of sequence"""
+  gff_file.seek(start)
+  block_offset = start
+  leftover = b''
+  record = None
+  while True:
+    data = gff_file.read(block_size)
+    block = leftover + data
+    if data:
+      end = block.rfind(b'\n') + 1
+      if end == 0:
+        leftover = block
+        continue
+    else:
+      end = len(block)
+    leftover = block[end:]
+    position = 0
+    while position < end:
+      if block[position:position+1] == b'>':
+        line_end = block.find(b'\n', position, end)
+        line_end = end if line_end == -1 else line_end
+        name = block[position+1:line_end].split()[0].decode('utf-8')
+        record = [name, 0, block_offset + line_end + 1, None, None, False, True]
+        sequences[name] = record
+        position = line_end + 1
+        continue
+      next_header = block.find(b'\n>', position, end)
+      segment_end = end if next_header == -1 else next_header + 1
+      segment = block[position:segment_end]
+      if record is not None:
+        _check_line_widths(record, segment)
+        record[1] += len(segment) - segment.count(b'\n') - segment.count(b'\r')
+      position = segment_end
+    block_offset += end
+    if not data:
+      break
+  for name, record in sequences.items():
+    if not record[6]:
+      logger.debug("The lines of %s aren't all the same width" % name)
+      record[3:5] = [None, None]
+    sequences[name] = FastaRecord(*record[:5])
+
+def read_sequence(gff_file, record):
+  """Reads the bases of a sequence line by line from a GFF opened in binary mode
+
+  Unlike working out offsets from its line_bases and line_width, this
+  works whether or not its lines are all the same width."""
+  gff_file.seek(record.offset)
+  lines = []
+  bases = 0
+  while bases < record.length:
+    line = gff_file.readline()
+    if not line or line[:1] == b'>':
+      break
+    line = line.rstrip(b'\r\n')
+    lines.append(line)
+    bases += len(line)
+  return b''.join(lines)[:record.length]
+
+def build_gff_index(gff_file):
+  """Indexes a GFF opened in binary mode
+
+  Features are counted line by line until the ##FASTA directive (or the
+  first FASTA header); the sequences are then indexed in bulk."""
+  feature_counts = OrderedDict()
+  offset = 0
+  fasta_offset = None
+  gff_file.seek(0)
+  for line in iter(gff_file.readline, b''):
+    if line.startswith(b'##FASTA'):
+      fasta_offset = offset + len(line)
+      break
+    if line.startswith(b'>'):
+      fasta_offset = offset
+      break
+    offset += len(line)
+    if line[:1] == b'#' or line.strip() == b'':
+      continue
+    contig = line.split(b'\t', 1)[0].strip().decode('utf-8')
+    feature_counts[contig] = feature_counts.get(contig, 0) + 1
+  sequences = OrderedDict()
+  if fasta_offset is not None:
+    _index_fasta(gff_file, fasta_offset, sequences)
+  return GFFIndex(feature_counts, sequences, fasta_offset)
+
+def _index_filename(gff_filename):
+  return "%s.index.json" % gff_filename
+
+def _load_index(gff_filename, gff_stat):
+  try:
+    with open(_index_filename(gff_filename), 'r') as index_file:
+      index_dict = json.load(index_file)
+  except (OSError, ValueError):
+    return None
+  if (index_dict.get('version') != INDEX_VERSION or
+      index_dict.get('size') != gff_stat.st_size or
+      index_dict.get('mtime') != gff_stat.st_mtime):
+    return None
+  return GFFIndex.from_dict(index_dict)
+
+def _save_index(gff_filename, gff_stat, index):
+  index_dict = index.to_dict()
+  index_dict['size'] = gff_stat.st_size
+  index_dict['mtime'] = gff_stat.st_mtime
+  index_filename = _index_filename(gff_filename)
+  try:
+    with tempfile.NamedTemporaryFile(mode='w', delete=False,
+                                     dir=os.path.dirname(index_filename),
+                                     prefix='.gff_index_') as index_file:
+      json.dump(index_dict, index_file)
+    os.replace(index_file.name, index_filename)
+    logger.debug("Saved GFF index to %s" % index_filename)
+  except OSError as e:
+    logger.debug("Could not save GFF index to %s: %s" % (index_filename, e))
+
+def get_gff_index(gff_file):
+  """Gets the index of a GFF, reusing the one saved next to it if it's current
+
+  gff_file can be an open file or, for GFFs which aren't on disk, any
+  file-like object.  Offsets in the index of a gzipped GFF are offsets in
+  the decompressed GFF."""
+  gff_filename = getattr(gff_file, 'name', None)
+  if not isinstance(gff_filename, str) or not os.path.isfile(gff_filename):
+    gff_file.seek(0)
+    content = gff_file.read()
+    if isinstance(content, str):
+      content = content.encode('utf-8')
+    return build_gff_index(io.BytesIO(content))
+  gff_stat = os.stat(gff_filename)
+  index = _load_index(gff_filename, gff_stat)
+  if index is None:
+    logger.debug("Indexing %s" % gff_filename)
+    with open_binary(gff_filename) as binary_gff_file:
+      index = build_gff_index(binary_gff_file)
+    _save_index(gff_filename, gff_stat, index)
+  return index
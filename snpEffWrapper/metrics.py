@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the log line with a run's metrics, for monitoring to look for
+METRICS_LOG_PREFIX = 'snpEffWrapper_metrics'
+METRICS_VERSION = 1
+DEFAULT_PROGRESS_INTERVAL = 60
+PROGRESS_CHECK_RECORDS = 10000
+
+ProcessUsage = namedtuple('ProcessUsage', ['returncode', 'peak_rss_mb',
+                                           'user_seconds', 'system_seconds'])
+
+def wait_for_process(process):
+  """Waits for a subprocess.Popen, returning its ProcessUsage
+
+  Uses wait4 so the peak RSS and CPU time are those of this process alone"""
+  _, status, rusage = os.wait4(process.pid, 0)
+  if os.WIFSIGNALED(status):
+    process.returncode = -os.WTERMSIG(status)
+  else:
+    process.returncode = os.WEXITSTATUS(status)
+  return ProcessUsage(process.returncode, rusage.ru_maxrss / 1024.0,
+                      rusage.ru_utime, rusage.ru_stime)
+
+def _children_cpu_seconds():
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+class RunMetrics(object):
+  """Timings of the stages of a run and the resources its SnpEff processes used
+
+  Each stage records its wall time, the CPU time of this process and the
+  CPU time of the child processes which finished during it.  Stages which
+  run more than once (e.g. annotating each VCF of a batch) are added up."""
+  def __init__(self):
+    self.started = time.time()
+    self.start_cpu = time.process_time()
+    self.start_children_cpu = _children_cpu_seconds()
+    self.stages = OrderedDict()
+    self.processes = []
+    self.counts = OrderedDict()
+    self.status = None
+    self.error = None
+    self.finished = None
+
+  @contextmanager
+  def stage(self, name):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_cpu_start = _children_cpu_seconds()
+    try:
+      yield
+    finally:
+      stage = self.stages.setdefault(name, OrderedDict([('calls', 0),
+                                                        ('wall_seconds', 0.0),
+                                                        ('cpu_seconds', 0.0),
+                                                        ('child_cpu_seconds', 0.0)]))
+      stage['calls'] += 1
+      stage['wall_seconds'] += time.perf_counter() - wall_start
+      stage['cpu_seconds'] += time.process_time() - cpu_start
+      stage['child_cpu_seconds'] += _children_cpu_seconds() - children_cpu_start
+
+  def add_process(self, stage, usage, seconds, name=None):
+    """Records the ProcessUsage of a SnpEff process which ran in stage"""
+    self.processes.append({
+      'stage': stage,
+      'name': name,
+      'returncode': usage.returncode,
+      'wall_seconds': round(seconds, 3),
+      'peak_rss_mb': round(usage.peak_rss_mb, 1),
+      'user_seconds': round(usage.user_seconds, 3),
+      'system_seconds': round(usage.system_seconds, 3)
+    })
+
+  def add_processes(self, processes):
+    """Adds processes recorded by the RunMetrics of a worker"""
+    self.processes.extend(processes)
+
+  def count(self, name, value=1):
+    self.counts[name] = self.counts.get(name, 0) + value
+
+  def finish(self, status, error=None):
+    self.status = status
+    self.error = "%s: %s" % (type(error).__name__, error) if error is not None else None
+    self.finished = time.time()
+
+  def to_dict(self):
+    finished = self.finished if self.finished is not None else time.time()
+    stages = OrderedDict()
+    for name, stage in self.stages.items():
+      stages[name] = OrderedDict((key, round(value, 3) if isinstance(value, float) else value)
+                                 for key, value in stage.items())
+    return OrderedDict([
+      ('version', METRICS_VERSION),
+      ('status', self.status),
+      ('error', self.error),
+      ('started', round(self.started, 3)),
+      ('wall_seconds', round(finished - self.started, 3)),
+      ('cpu_seconds', round(time.process_time() - self.start_cpu, 3)),
+      ('child_cpu_seconds', round(_children_cpu_seconds() - self.start_children_cpu, 3)),
+      ('peak_rss_mb', round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)),
+      ('stages', stages),
+      ('processes', self.processes),
+      ('counts', self.counts)
+    ])
+
+  def log(self):
+    """Logs the metrics as one line of JSON prefixed with METRICS_LOG_PREFIX"""
+    logger.info("%s %s" % (METRICS_LOG_PREFIX,
+                           json.dumps(self.to_dict(), separators=(',', ':'))))
+
+  def write(self, metrics_filename):
+    metrics_dir = os.path.dirname(os.path.abspath(metrics_filename))
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=metrics_dir,
+                                     prefix='.metrics_') as metrics_file:
+      json.dump(self.to_dict(), metrics_file, indent=2)
+    os.replace(metrics_file.name, metrics_filename)
+    logger.info("Wrote metrics to %s" % metrics_filename)
+
+def _format_duration(seconds):
+  seconds = int(round(seconds))
+  if seconds >= 3600:
+    return "%sh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+  if seconds >= 60:
+    return "%sm%02ds" % (seconds // 60, seconds % 60)
+  return "%ss" % seconds
+
+class ProgressReporter(object):
+  """Logs how quickly records are being annotated every interval seconds
+
+  If the number of records expected is known the time remaining is
+  estimated too.  update() is cheap enough to call every few thousand
+  records; an interval of 0 turns the reports off."""
+  def __init__(self, expected_records=None, interval=DEFAULT_PROGRESS_INTERVAL,
+               label='the VCF'):
+    self.expected_records = expected_records
+    self.interval = interval
+    self.label = label
+    self.records = 0
+    self.start = time.monotonic()
+    self.last_report = self.start
+
+  def update(self, records):
+    self.records = records
+    if not self.interval:
+      return
+    now = time.monotonic()
+    if now - self.last_report < self.interval:
+      return
+    self.last_report = now
+    logger.info(self.describe(now))
+
+  def rate(self, now=None):
+    elapsed = (now if now is not None else time.monotonic()) - self.start
+    return self.records / elapsed if elapsed > 0 else 0.0
+
+  def describe(self, now=None):
+    rate = self.rate(now)
+    if not self.expected_records:
+      return "Annotated %s records of %s (%.0f records/s)" % (self.records,
+                                                              self.label, rate)
+    percent = 100.0 * self.records / self.expected_records
+    remaining = max(self.expected_records - self.records, 0)
+    estimate = _format_duration(remaining / rate) if rate > 0 else 'unknown'
+    return "Annotated %s of %s records of %s (%.0f%%, %.0f records/s, about %s left)" % (
+      self.records, self.expected_records, self.label, percent, rate, estimate)
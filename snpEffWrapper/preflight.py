@@ -0,0 +1,123 @@
+import logging
+import mmap
+
+from collections import Counter
+
+from .compression import is_gzipped, open_binary
+from .gff_index import read_sequence
+
+logger = logging.getLogger(__name__)
+
+# The number of records logged for each kind of problem
+PREFLIGHT_EXAMPLES = 5
+
+class ReferenceSequences(object):
+  """Looks up the bases of the sequences in the ##FASTA section of a GFF
+
+  Uses the FastaRecords of the GFF's GFFIndex to find them.  Plain GFFs are
+  memory-mapped, so only the pages holding the bases which are looked up
+  are read; gzipped GFFs can't be, so each sequence is decompressed the
+  first time it's needed.  Sequences whose lines aren't all the same width
+  (see gff_index.GFFIndex) are read whole too, as the offsets of their
+  bases can't be worked out."""
+  def __init__(self, gff_filename, gff_index):
+    self.sequences = gff_index.sequences
+    self._gff_filename = gff_filename
+    self._gff_file = None
+    self._mmap = None
+    self._decompressed = {}
+    if not is_gzipped(gff_filename):
+      self._gff_file = open(gff_filename, 'rb')
+      self._mmap = mmap.mmap(self._gff_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def length(self, contig):
+    record = self.sequences.get(contig)
+    return None if record is None else record.length
+
+  def _offset(self, record, position):
+    """The byte offset of a 0-based position in a sequence, as samtools faidx works it out"""
+    return (record.offset + (position // record.line_bases) * record.line_width +
+            position % record.line_bases)
+
+  def _sequence(self, record):
+    sequence = self._decompressed.get(record.name)
+    if sequence is None:
+      with open_binary(self._gff_filename) as gff_file:
+        sequence = read_sequence(gff_file, record)
+      self._decompressed = {record.name: sequence} # Only keep the latest
+    return sequence
+
+  def fetch(self, contig, start, end):
+    """The bases from 0-based start to end of contig, in upper case"""
+    record = self.sequences[contig]
+    end = min(end, record.length)
+    if start >= end:
+      return ''
+    if self._mmap is None or record.line_bases is None:
+      bases = self._sequence(record)[start:end]
+    else:
+      bases = self._mmap[self._offset(record, start):self._offset(record, end - 1) + 1]
+      bases = bases.replace(b'\n', b'').replace(b'\r', b'')
+    return bases.decode('ascii').upper()
+
+  def close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._gff_file.close()
+      self._mmap = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.close()
+
+def _bases_match(ref, bases):
+  """Does a VCF's REF match the reference? N matches any base, as it does in SnpEff"""
+  if ref == bases:
+    return True
+  if len(ref) != len(bases):
+    return False
+  return all(a == b or a == 'N' or b == 'N' for a, b in zip(ref, bases))
+
+def preflight_errors(vcf_file, reference, gff_names=None):
+  """Checks the POS and REF of every record in vcf_file against reference
+
+  gff_names maps each VCF contig to its name in the GFF (by default they
+  are the same); records on contigs which aren't in it are skipped, as
+  check_contigs has already warned about them.  Returns a Counter of the
+  problems SnpEff would report, named as in wrapper.annotation_error_map,
+  and logs the first few records with each.  As in SnpEff, a record is
+  only out of range if its POS is past the end of the contig; a REF which
+  runs past the end doesn't match the reference."""
+  error_counter = Counter()
+  vcf_file.seek(0)
+  for line in vcf_file:
+    if line[0] == '#':
+      continue
+    contig, position, _, ref = line.split('\t', 4)[:4]
+    contig = contig.strip()
+    gff_name = contig if gff_names is None else gff_names.get(contig)
+    if gff_name is None:
+      continue
+    length = reference.length(gff_name)
+    start = int(position) - 1
+    ref = ref.upper()
+    if length is None:
+      error = 'WARNING_SEQUENCE_NOT_AVAILABLE'
+      detail = "'%s' has no sequence in the GFF" % gff_name
+    elif start >= length:
+      error = 'ERROR_OUT_OF_CHROMOSOME_RANGE'
+      detail = "'%s' is only %s bases long" % (gff_name, length)
+    else:
+      bases = reference.fetch(gff_name, start, start + len(ref))
+      if _bases_match(ref, bases):
+        continue
+      error = 'WARNING_REF_DOES_NOT_MATCH_GENOME'
+      detail = "REF is %s but the reference has %s" % (ref, bases)
+      if len(bases) < len(ref):
+        detail += " before the end of '%s'" % gff_name
+    error_counter[error] += 1
+    if error_counter[error] <= PREFLIGHT_EXAMPLES:
+      logger.warn("%s at %s:%s: %s" % (error, contig, position, detail))
+  return error_counter
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+def user_cache_dir():
+  cache_home = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, 'snpEffWrapper')
+
+def default_probe_cache_filename():
+  if 'SNPEFF_WRAPPER_PROBE_CACHE' in os.environ:
+    return os.environ['SNPEFF_WRAPPER_PROBE_CACHE']
+  return os.path.join(user_cache_dir(), 'probes.json')
+
+class ProbeCache(object):
+  """Remembers what was learnt by running an executable
+
+  Results are stored in a JSON file keyed by the real path of the executable
+  and the name of the probe.  A result is only reused while the executable
+  has the same size and modification time, so upgrading Java or SnpEff in
+  place is noticed.  Failed probes (which return None) aren't cached, so
+  they are retried next time.  The cache is best effort: if it can't be read or
+  written (or filename is empty) the probes are just run every time."""
+  def __init__(self, filename=None):
+    self.filename = filename if filename is not None else default_probe_cache_filename()
+
+  def _load(self):
+    try:
+      with open(self.filename, 'r') as cache_file:
+        return json.load(cache_file)
+    except (OSError, ValueError):
+      return {}
+
+  def _save(self, probes):
+    try:
+      cache_dir = os.path.dirname(os.path.abspath(self.filename))
+      os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+      with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=cache_dir,
+                                       prefix='.probes_') as cache_file:
+        json.dump(probes, cache_file, indent=2, sort_keys=True)
+      os.replace(cache_file.name, self.filename)
+    except OSError as e:
+      logger.debug("Could not save probe cache to %s: %s" % (self.filename, e))
+
+  def get(self, executable, name, probe):
+    """Returns probe(executable), reusing the cached result if it's current"""
+    if not self.filename:
+      return probe(executable)
+    try:
+      path = os.path.realpath(executable)
+      executable_stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+      return probe(executable)
+    key = "%s:%s" % (name, path)
+    fingerprint = [executable_stat.st_size, executable_stat.st_mtime]
+    probes = self._load()
+    cached = probes.get(key)
+    if cached is not None and cached['fingerprint'] == fingerprint:
+      logger.debug("Using cached %s of %s" % (name, path))
+      return cached['result']
+    result = probe(executable)
+    if result is not None: # e.g. java was killed, try again next time
+      probes[key] = {'fingerprint': fingerprint, 'result': result}
+      self._save(probes)
+    return result
+
+def _run_version_command(command):
+  try:
+    output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+    return output.decode('utf-8', 'replace')
+  except (OSError, subprocess.CalledProcessError): # Probably doesn't exist
+    return None
+
+def _probe_java_version(java):
+  output = _run_version_command([java, '-Xmx10m', '-version'])
+  if output is None:
+    return None
+  match = re.search('version "([^"]+)"', output)
+  return match.group(1) if match is not None else None
+
+def java_version(java, probe_cache=None):
+  """The version reported by `java -version` e.g. 1.7.0_21 or 11.0.2
+
+  Returns None if java couldn't be run"""
+  probe_cache = probe_cache if probe_cache is not None else ProbeCache()
+  return probe_cache.get(java, 'java_version', _probe_java_version)
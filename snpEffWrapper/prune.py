@@ -0,0 +1,235 @@
+import logging
+import re
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from .compression import open_binary
+from .gff_index import GFFIndex, get_gff_index
+
+logger = logging.getLogger(__name__)
+
+# SnpEff's default upstream / downstream interval; features closer than this
+# to a variant can be in its annotations
+MIN_PRUNE_DISTANCE = 5000
+
+# Types of features which SnpEff makes genes from; the nearest of these on
+# either side of a variant name its intergenic_region
+GENIC_TYPES = set([b'gene', b'pseudogene', b'mRNA', b'transcript', b'CDS',
+                   b'exon', b'tRNA', b'rRNA', b'ncRNA'])
+
+class PruneError(ValueError):
+  pass
+
+class _FeatureGroup(object):
+  """A top level feature and all of its descendants"""
+  __slots__ = ['contig', 'start', 'end', 'genic', 'keep']
+
+  def __init__(self, contig, start, end, genic):
+    self.contig = contig
+    self.start = start
+    self.end = end
+    self.genic = genic
+    self.keep = False
+
+def _attribute(attributes, name):
+  match = re.search(b'(?:^|;)' + name + b'=([^;]*)', attributes)
+  if match is None:
+    return None
+  return match.group(1).split(b',')[0].strip()
+
+def _read_features(gff_file):
+  """Yields the byte offset and line of everything before the FASTA"""
+  gff_file.seek(0)
+  offset = 0
+  for line in iter(gff_file.readline, b''):
+    if line.startswith(b'##FASTA') or line.startswith(b'>'):
+      return
+    yield offset, line
+    offset += len(line)
+
+def _group_features(gff_file, contigs):
+  """Groups the features on contigs by their top level ancestor
+
+  Returns a dict of the offset of each feature's line to its _FeatureGroup
+  and the list of groups"""
+  features = []
+  parents = {}
+  for offset, line in _read_features(gff_file):
+    if line[:1] == b'#' or line.strip() == b'':
+      continue
+    columns = line.rstrip(b'\r\n').split(b'\t')
+    if len(columns) < 9 or columns[0].strip() not in contigs:
+      continue
+    feature_id = _attribute(columns[8], b'ID')
+    parent_id = _attribute(columns[8], b'Parent')
+    if feature_id is not None and parent_id is not None:
+      parents[feature_id] = parent_id
+    features.append((offset, columns[0].strip(), int(columns[3]),
+                     int(columns[4]), columns[2] in GENIC_TYPES,
+                     feature_id, parent_id))
+
+  def root(feature_id):
+    seen = set()
+    while feature_id in parents and feature_id not in seen:
+      seen.add(feature_id)
+      feature_id = parents[feature_id]
+    return feature_id
+
+  groups = {}
+  feature_groups = {}
+  for offset, contig, start, end, genic, feature_id, parent_id in features:
+    group_id = root(parent_id if parent_id is not None else feature_id)
+    key = (contig, group_id) if group_id is not None else (contig, offset)
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = _FeatureGroup(contig, start, end, genic)
+    else:
+      group.start = min(group.start, start)
+      group.end = max(group.end, end)
+      group.genic = group.genic or genic
+    feature_groups[offset] = group
+  return feature_groups, list(groups.values())
+
+def _mark_nearby_groups(groups, positions, distance):
+  """Marks the groups within distance of a variant, and the nearest genic
+  group on each side of every variant, to be kept"""
+  contig_groups = {}
+  for group in groups:
+    contig_groups.setdefault(group.contig, []).append(group)
+  for contig, groups_on_contig in contig_groups.items():
+    contig_positions = sorted(positions.get(contig.decode('utf-8'), []))
+    for group in groups_on_contig:
+      i = bisect_left(contig_positions, group.start - distance)
+      group.keep = (i < len(contig_positions) and
+                    contig_positions[i] <= group.end + distance)
+    genic_groups = [group for group in groups_on_contig if group.genic]
+    by_end = sorted(genic_groups, key=lambda group: group.end)
+    ends = [group.end for group in by_end]
+    by_start = sorted(genic_groups, key=lambda group: group.start)
+    starts = [group.start for group in by_start]
+    for position in contig_positions:
+      left = bisect_left(ends, position) - 1
+      if left >= 0:
+        by_end[left].keep = True
+      right = bisect_right(starts, position)
+      if right < len(by_start):
+        by_start[right].keep = True
+
+def _copy_sequence(gff_file, record, output_file, name=None):
+  """Copies a sequence from the FASTA section of a GFF using its FastaRecord
+
+  The sequence is called name in the copy, if that's given.  Sequences
+  whose lines aren't all the same width are copied line by line."""
+  name = record.name if name is None else name
+  output_file.write(b'>' + name.encode('utf-8') + b'\n')
+  if record.length == 0:
+    return
+  if record.line_bases is None:
+    _copy_sequence_lines(gff_file, record, output_file)
+    return
+  full_lines, last_line = divmod(record.length, record.line_bases)
+  size = full_lines * record.line_width
+  if last_line:
+    size += last_line + record.line_width - record.line_bases
+  gff_file.seek(record.offset)
+  remaining = size
+  data = b''
+  while remaining > 0:
+    data = gff_file.read(min(remaining, 4*1024*1024))
+    if not data:
+      break
+    output_file.write(data)
+    remaining -= len(data)
+  if not data.endswith(b'\n'):
+    output_file.write(b'\n')
+
+def _copy_sequence_lines(gff_file, record, output_file):
+  """Copies the lines of a sequence until all of its bases have been copied"""
+  gff_file.seek(record.offset)
+  bases = 0
+  line = b''
+  while bases < record.length:
+    line = gff_file.readline()
+    if not line or line[:1] == b'>':
+      break
+    output_file.write(line)
+    bases += len(line.rstrip(b'\r\n'))
+  if not line.endswith(b'\n'):
+    output_file.write(b'\n')
+
+def _renamed_line(line, renames):
+  """Renames the contig in the first column of a GFF line"""
+  contig, rest = line.split(b'\t', 1)
+  return renames.get(contig.strip(), contig) + b'\t' + rest
+
+def prune_gff(gff_file, output_filename, contigs, positions=None,
+              distance=None, renames=None):
+  """Writes a GFF with only the features and sequences of contigs
+
+  If contigs is None, every contig is kept.  renames is a dict of the
+  contigs (by their name in the GFF) to call something else in the copy,
+  see contigs.ContigReconciliation.renames; contigs and positions use
+  the names in the GFF.
+
+  If distance is given, features (with all of their descendants) which are
+  further than distance bases from every variant in positions (a dict of
+  contig to positions) are dropped too, except for the nearest genes on
+  either side of each variant.  distance can't be less than SnpEff's
+  upstream / downstream interval so the annotations don't change.  Returns
+  a GFFIndex of what was kept, to plan resources with; its offsets are
+  those in the original GFF."""
+  if distance is not None and distance < MIN_PRUNE_DISTANCE:
+    raise PruneError("Cannot prune features closer than %s bases to a variant, they could be annotated" %
+                     MIN_PRUNE_DISTANCE)
+  index = get_gff_index(gff_file)
+  pruning = contigs is not None or distance is not None
+  if contigs is None:
+    contigs = set(index.feature_counts) | set(index.sequences)
+  contigs = set(contigs)
+  kept_contigs = set(contig.encode('utf-8') for contig in contigs)
+  renames = renames or {}
+  binary_renames = {contig.encode('utf-8'): name.encode('utf-8')
+                    for contig, name in renames.items()}
+  feature_counts = OrderedDict()
+  with open_binary(gff_file.name) as binary_gff_file, \
+       open(output_filename, 'wb') as output_file:
+    feature_groups = None
+    if distance is not None:
+      feature_groups, groups = _group_features(binary_gff_file, kept_contigs)
+      _mark_nearby_groups(groups, positions or {}, distance)
+    for offset, line in _read_features(binary_gff_file):
+      if line.startswith(b'##sequence-region'):
+        fields = line.split()
+        if len(fields) > 1 and fields[1] not in kept_contigs:
+          continue
+        if len(fields) > 1 and fields[1] in binary_renames:
+          line = line.replace(fields[1], binary_renames[fields[1]], 1)
+      elif line[:1] != b'#' and line.strip() != b'':
+        contig = line.split(b'\t', 1)[0].strip()
+        if contig not in kept_contigs:
+          continue
+        if feature_groups is not None and offset in feature_groups and \
+           not feature_groups[offset].keep:
+          continue
+        if contig in binary_renames:
+          line = _renamed_line(line, binary_renames)
+        contig = contig.decode('utf-8')
+        contig = renames.get(contig, contig)
+        feature_counts[contig] = feature_counts.get(contig, 0) + 1
+      output_file.write(line)
+    sequences = OrderedDict()
+    if index.fasta_offset is not None:
+      output_file.write(b'##FASTA\n')
+      for name, record in index.sequences.items():
+        if name in contigs:
+          new_name = renames.get(name, name)
+          _copy_sequence(binary_gff_file, record, output_file, new_name)
+          sequences[new_name] = record._replace(name=new_name)
+  if renames:
+    logger.info("Renamed %s contigs in the reference" % len(renames))
+  if pruning:
+    logger.info("Pruned the reference to %s of %s contigs and %s of %s features" %
+                (len(sequences) or len(feature_counts), len(index.sequences) or len(index.feature_counts),
+                 sum(feature_counts.values()), sum(index.feature_counts.values())))
+  return GFFIndex(feature_counts, sequences, index.fasta_offset)
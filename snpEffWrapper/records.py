@@ -0,0 +1,122 @@
+# The sub-fields of each annotation in SnpEff's ANN field, in order
+EFFECT_FIELDS = [
+  'allele',
+  'annotation',
+  'impact',
+  'gene_name',
+  'gene_id',
+  'feature_type',
+  'feature_id',
+  'transcript_biotype',
+  'rank',
+  'hgvs_c',
+  'hgvs_p',
+  'cdna_position',
+  'cds_position',
+  'protein_position',
+  'distance',
+  'messages'
+]
+
+class Effect(object):
+  """One of the annotations in a record's ANN field
+
+  The sub-fields are kept as the strings SnpEff wrote ('' if it left them
+  empty) in the order of EFFECT_FIELDS.  There can be millions of these so
+  they have __slots__ rather than a __dict__."""
+  __slots__ = EFFECT_FIELDS
+
+  def __init__(self, allele, annotation, impact, gene_name, gene_id,
+               feature_type, feature_id, transcript_biotype, rank, hgvs_c,
+               hgvs_p, cdna_position, cds_position, protein_position,
+               distance, messages):
+    self.allele = allele
+    self.annotation = annotation
+    self.impact = impact
+    self.gene_name = gene_name
+    self.gene_id = gene_id
+    self.feature_type = feature_type
+    self.feature_id = feature_id
+    self.transcript_biotype = transcript_biotype
+    self.rank = rank
+    self.hgvs_c = hgvs_c
+    self.hgvs_p = hgvs_p
+    self.cdna_position = cdna_position
+    self.cds_position = cds_position
+    self.protein_position = protein_position
+    self.distance = distance
+    self.messages = messages
+
+  @property
+  def terms(self):
+    """The sequence ontology terms of the annotation e.g. ['missense_variant']"""
+    return self.annotation.split('&') if self.annotation else []
+
+  def to_tuple(self):
+    return tuple(getattr(self, field) for field in EFFECT_FIELDS)
+
+  def __eq__(self, other):
+    return isinstance(other, Effect) and self.to_tuple() == other.to_tuple()
+
+  def __repr__(self):
+    return "Effect(%s)" % ", ".join("%s=%r" % (field, getattr(self, field))
+                                    for field in EFFECT_FIELDS)
+
+def parse_effects(ann):
+  """Parses the value of an ANN field into a list of Effects"""
+  effects = []
+  if not ann:
+    return effects
+  field_count = len(EFFECT_FIELDS)
+  for annotation in ann.split(','):
+    fields = annotation.split('|', field_count - 1)
+    if len(fields) < field_count:
+      fields.extend([''] * (field_count - len(fields)))
+    effects.append(Effect(*fields))
+  return effects
+
+def get_info_value(info, key):
+  """Gets the value of key from a VCF INFO column without parsing the rest
+
+  Returns None if the key isn't there and True if it's a flag"""
+  for entry in info.split(';'):
+    if entry == key:
+      return True
+    if entry.startswith(key) and entry[len(key):len(key)+1] == '=':
+      return entry[len(key)+1:]
+  return None
+
+class AnnotatedRecord(object):
+  """A record of an annotated VCF
+
+  The first eight columns are split out of the line; the ANN field is only
+  parsed into Effects the first time effects is read.  line is the record
+  as SnpEff wrote it, including the samples and the newline."""
+  __slots__ = ['chrom', 'pos', 'id', 'ref', 'alt', 'qual', 'filter', 'info',
+               'line', '_effects']
+
+  def __init__(self, line):
+    columns = line.rstrip('\r\n').split('\t', 8)
+    if len(columns) < 8:
+      raise ValueError("Expected at least 8 columns in VCF record: %s" % line.rstrip())
+    self.chrom = columns[0]
+    self.pos = int(columns[1])
+    self.id = columns[2]
+    self.ref = columns[3]
+    self.alt = columns[4].split(',')
+    self.qual = columns[5]
+    self.filter = columns[6]
+    self.info = columns[7]
+    self.line = line
+    self._effects = None
+
+  @property
+  def effects(self):
+    if self._effects is None:
+      ann = get_info_value(self.info, 'ANN')
+      self._effects = parse_effects(ann if ann is not True else None)
+    return self._effects
+
+  def __repr__(self):
+    return "AnnotatedRecord(%s:%s %s>%s, %s effects)" % (
+      self.chrom, self.pos, self.ref, ",".join(self.alt), len(self.effects))
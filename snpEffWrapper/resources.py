@@ -0,0 +1,212 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shlex
+import tempfile
+import time
+
+from .probes import user_cache_dir
+
+logger = logging.getLogger(__name__)
+
+MIN_HEAP_MB = 512
+HEAP_STEP_MB = 256
+SERIAL_GC_MAX_HEAP_MB = 2048
+DEFAULT_SAFETY_FACTOR = 1.5
+HISTORY_HEADROOM = 1.2
+HISTORY_RUNS = 200
+MAX_HISTORY_LINES = 5000
+
+# Rough costs of each stage in MB, per MB of GFF (features and sequence are
+# both held in memory) and per feature (transcripts, exons etc. are objects)
+STAGE_COSTS = {
+  'build': {'base_mb': 128, 'per_gff_mb': 1.5, 'per_feature_mb': 0.002,
+            'per_vcf_mb': 0},
+  'annotate': {'base_mb': 128, 'per_gff_mb': 1.0, 'per_feature_mb': 0.002,
+               'per_vcf_mb': 0.01}
+}
+
+GC_OPTIONS = {
+  'serial': ['-XX:+UseSerialGC'],
+  'parallel': ['-XX:+UseParallelGC'],
+  'g1': ['-XX:+UseG1GC']
+}
+
+class ResourcePlanError(ValueError):
+  pass
+
+def parse_heap_size(heap_str):
+  """Parses a heap size like the JVM does e.g. 512m or 4g, returning MB"""
+  match = re.match('^\\s*(\\d+(?:\\.\\d+)?)\\s*([mMgG]?)[bB]?\\s*$', heap_str)
+  if match is None:
+    raise ResourcePlanError("Could not parse heap size '%s'" % heap_str)
+  size = float(match.group(1))
+  if match.group(2).lower() == 'g':
+    size *= 1024
+  return int(math.ceil(size))
+
+def default_history_filename():
+  if 'SNPEFF_WRAPPER_RESOURCE_HISTORY' in os.environ:
+    return os.environ['SNPEFF_WRAPPER_RESOURCE_HISTORY']
+  return os.path.join(user_cache_dir(), 'resource_history.jsonl')
+
+class JvmPlan(object):
+  """The JVM settings for one stage of a run and the inputs they were based on
+
+  Once the stage has run, record() adds its peak memory use to the history
+  so that later plans can be tuned."""
+  def __init__(self, stage, heap_mb, gc, gc_threads, inputs,
+               extra_options=None, history_filename=None):
+    self.stage = stage
+    self.heap_mb = heap_mb
+    self.gc = gc
+    self.gc_threads = gc_threads
+    self.inputs = inputs
+    self.extra_options = extra_options if extra_options is not None else []
+    self.history_filename = history_filename
+
+  def options(self):
+    options = ["-Xmx%sm" % self.heap_mb, "-XX:-UsePerfData"]
+    options += GC_OPTIONS[self.gc]
+    if self.gc != 'serial':
+      options.append("-XX:ParallelGCThreads=%s" % self.gc_threads)
+    return options + self.extra_options
+
+  def to_dict(self):
+    return {
+      'stage': self.stage,
+      'heap_mb': self.heap_mb,
+      'gc': self.gc,
+      'gc_threads': self.gc_threads,
+      'extra_options': self.extra_options,
+      'inputs': self.inputs
+    }
+
+  def record(self, peak_rss_mb, seconds, returncode):
+    if not self.history_filename:
+      return
+    run = self.to_dict()
+    run.update({'peak_rss_mb': peak_rss_mb, 'seconds': round(seconds, 3),
+                'returncode': returncode, 'finished': time.time()})
+    if returncode != 0 and peak_rss_mb >= 0.9 * self.heap_mb:
+      logger.warn("SnpEff may have run out of memory with a %sMB heap, try a bigger --%s-heap" %
+                  (self.heap_mb, self.stage))
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(self.history_filename)),
+                  mode=0o755, exist_ok=True)
+      with open(self.history_filename, 'a') as history_file:
+        history_file.write(json.dumps(run, sort_keys=True) + '\n')
+    except OSError as e:
+      logger.debug("Could not record resource usage in %s: %s" %
+                   (self.history_filename, e))
+
+class ResourcePlan(object):
+  """The JvmPlans for building the database and annotating"""
+  def __init__(self, build, annotate):
+    self.build = build
+    self.annotate = annotate
+
+  def peak_heap_mb(self):
+    return max(self.build.heap_mb, self.annotate.heap_mb)
+
+def _estimate_heap_mb(stage, inputs):
+  costs = STAGE_COSTS[stage]
+  return (costs['base_mb'] +
+          costs['per_gff_mb'] * inputs['gff_bytes'] / 1024**2 +
+          costs['per_feature_mb'] * inputs['features'] +
+          costs['per_vcf_mb'] * inputs['vcf_bytes'] / 1024**2)
+
+def load_history(history_filename):
+  """Reads the recent runs from the history, trimming it if it's got long"""
+  if not history_filename:
+    return []
+  try:
+    with open(history_filename, 'r') as history_file:
+      lines = history_file.readlines()
+  except OSError:
+    return []
+  if len(lines) > MAX_HISTORY_LINES:
+    lines = lines[-MAX_HISTORY_LINES // 2:]
+    try:
+      with tempfile.NamedTemporaryFile(mode='w', delete=False,
+                                       dir=os.path.dirname(os.path.abspath(history_filename)),
+                                       prefix='.resource_history_') as history_file:
+        history_file.writelines(lines)
+      os.replace(history_file.name, history_filename)
+    except OSError as e:
+      logger.debug("Could not trim %s: %s" % (history_filename, e))
+  runs = []
+  for line in lines:
+    try:
+      runs.append(json.loads(line))
+    except ValueError:
+      pass # Partly written by a run which was killed
+  return runs
+
+def _history_factor(stage, history):
+  """How much memory earlier runs of stage needed relative to the estimate
+
+  Runs which failed close to their heap limit probably ran out of memory so
+  are taken to need at least twice the heap they had"""
+  ratios = []
+  for run in [run for run in history if run.get('stage') == stage][-HISTORY_RUNS:]:
+    try:
+      estimate = _estimate_heap_mb(stage, run['inputs'])
+      if run['returncode'] == 0:
+        ratios.append(run['peak_rss_mb'] / estimate)
+      elif run['peak_rss_mb'] >= 0.9 * run['heap_mb']:
+        ratios.append(2.0 * run['heap_mb'] / estimate)
+    except (KeyError, TypeError, ZeroDivisionError):
+      pass
+  return max(ratios) if ratios else None
+
+def _round_heap_mb(heap_mb):
+  heap_mb = int(math.ceil(heap_mb / HEAP_STEP_MB)) * HEAP_STEP_MB
+  return max(heap_mb, MIN_HEAP_MB)
+
+def plan_stage(stage, inputs, history, concurrent_jvms=1, heap_mb=None,
+               gc=None, extra_options=None, history_filename=None):
+  """Chooses the heap size and garbage collector for a stage
+
+  heap_mb and gc override the planner.  Small heaps use the serial collector,
+  which has the lowest overhead; bigger ones use the parallel collector with
+  the node's cores shared between the concurrent JVMs."""
+  if heap_mb is None:
+    estimate = _estimate_heap_mb(stage, inputs)
+    factor = _history_factor(stage, history)
+    if factor is None:
+      heap_mb = _round_heap_mb(estimate * DEFAULT_SAFETY_FACTOR)
+    else:
+      heap_mb = _round_heap_mb(estimate * factor * HISTORY_HEADROOM)
+  if gc is None:
+    gc = 'serial' if heap_mb <= SERIAL_GC_MAX_HEAP_MB else 'parallel'
+  gc_threads = max(1, min(8, multiprocessing.cpu_count() // concurrent_jvms))
+  return JvmPlan(stage, heap_mb, gc, gc_threads, inputs, extra_options,
+                 history_filename)
+
+def plan_resources(gff_index, gff_bytes, vcf_bytes, concurrent_jvms=1,
+                   build_heap_mb=None, annotate_heap_mb=None, gc=None,
+                   java_options=None, history_filename=None):
+  """Plans the JVMs to build a database from a GFF and annotate a VCF with it
+
+  gff_index is the GFFIndex of the GFF; vcf_bytes is the size of the biggest
+  VCF which will be annotated (or of each shard).  The history of earlier
+  runs is read from history_filename if it's given."""
+  inputs = {
+    'gff_bytes': gff_bytes,
+    'features': sum(gff_index.feature_counts.values()),
+    'bases': sum(record.length for record in gff_index.sequences.values()),
+    'vcf_bytes': vcf_bytes
+  }
+  extra_options = shlex.split(java_options) if java_options else []
+  history = load_history(history_filename)
+  build = plan_stage('build', inputs, history, 1, build_heap_mb, gc,
+                     extra_options, history_filename)
+  annotate = plan_stage('annotate', inputs, history, concurrent_jvms,
+                        annotate_heap_mb, gc, extra_options, history_filename)
+  logger.info("Planned a %sMB heap to build the database and %sMB to annotate" %
+              (build.heap_mb, annotate.heap_mb))
+  return ResourcePlan(build, annotate)
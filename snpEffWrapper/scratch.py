@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+from .compression import copy_decompressed, is_gzipped
+
+logger = logging.getLogger(__name__)
+
+TEMP_DIR_PREFIX = 'snpeff_data_dir_'
+OWNER_FILENAME = '.owner'
+
+def default_scratch_dir():
+  return os.environ.get('SNPEFF_WRAPPER_SCRATCH_DIR')
+
+def stage_file(source, destination):
+  """Makes source available at destination as cheaply as possible
+
+  Tries a hardlink (same filesystem), then a symlink, and only copies the
+  file if neither works.  Gzipped files are decompressed.  Returns how the
+  file was staged."""
+  if is_gzipped(source):
+    copy_decompressed(source, destination)
+    return 'decompressed'
+  try:
+    os.link(source, destination)
+    return 'hardlink'
+  except OSError:
+    pass
+  try:
+    os.symlink(os.path.abspath(source), destination)
+    return 'symlink'
+  except OSError:
+    pass
+  shutil.copy(source, destination)
+  return 'copy'
+
+def _process_running(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True # Someone else's process
+  return True
+
+def make_temp_dir(scratch_dir=None):
+  """Creates a temporary directory in scratch_dir (default: the working directory)
+
+  The directory records which process owns it so that it can be removed by
+  sweep_stale_temp_dirs if that process is killed before it cleans up"""
+  scratch_dir = scratch_dir if scratch_dir is not None else os.getcwd()
+  os.makedirs(scratch_dir, mode=0o755, exist_ok=True)
+  sweep_stale_temp_dirs(scratch_dir)
+  temp_dir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=scratch_dir)
+  with open(os.path.join(temp_dir, OWNER_FILENAME), 'w') as owner_file:
+    json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, owner_file)
+  return temp_dir
+
+def sweep_stale_temp_dirs(scratch_dir):
+  """Removes temporary directories left by processes on this host which died"""
+  hostname = socket.gethostname()
+  for name in os.listdir(scratch_dir):
+    if not name.startswith(TEMP_DIR_PREFIX):
+      continue
+    temp_dir = os.path.join(scratch_dir, name)
+    try:
+      with open(os.path.join(temp_dir, OWNER_FILENAME), 'r') as owner_file:
+        owner = json.load(owner_file)
+    except (OSError, ValueError):
+      continue # Kept with --keep by an older version or not ours
+    if owner.get('keep') or owner.get('host') != hostname:
+      continue
+    if not _process_running(owner.get('pid')):
+      logger.info("Removing %s left behind by process %s" % (temp_dir,
+                                                             owner['pid']))
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+def keep_temp_dir(temp_dir):
+  """Stops a temporary directory from being swept once its owner exits"""
+  owner_filename = os.path.join(temp_dir, OWNER_FILENAME)
+  with open(owner_filename, 'r') as owner_file:
+    owner = json.load(owner_file)
+  owner['keep'] = True
+  with open(owner_filename, 'w') as owner_file:
+    json.dump(owner, owner_file)
+
+def _exit_on_signal(signum, frame):
+  raise SystemExit(128 + signum)
+
+def install_signal_handlers():
+  """Turns SIGTERM and SIGHUP into SystemExit so that cleanup code runs
+
+  Batch schedulers send SIGTERM when a job runs out of time"""
+  for signum in [signal.SIGTERM, signal.SIGHUP]:
+    signal.signal(signum, _exit_on_signal)
@@ -0,0 +1,303 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from .compression import is_compressed_filename
+from .wrapper import annotate_vcf, plan_annotation_resources
+
+logger = logging.getLogger(__name__)
+
+JOB_MEMORY = 4 * 1024**3 # The default -Xmx given to SnpEff
+
+class ServerError(ValueError):
+  pass
+
+class Job(object):
+  """An annotation job and its progress through the scheduler"""
+  def __init__(self, job_id, spec, memory):
+    self.job_id = job_id
+    self.spec = spec
+    self.memory = memory
+    self.state = 'queued'
+    self.error = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+    self.done = threading.Event()
+
+  def status(self):
+    return {
+      'job_id': self.job_id,
+      'state': self.state,
+      'error': self.error,
+      'gff_file': self.spec['gff_file'],
+      'vcf_file': self.spec['vcf_file'],
+      'output_vcf': self.spec['output_vcf'],
+      'memory': self.memory,
+      'submitted': self.submitted,
+      'started': self.started,
+      'finished': self.finished
+    }
+
+class JobScheduler(object):
+  """Runs jobs in the order they're submitted within a memory budget
+
+  Each job needs the memory given when it's submitted (default: job_memory
+  bytes) for its JVM; jobs wait in the queue until there is enough of the
+  budget left to start them (one job always runs, even if it is bigger than
+  the budget).  run_job is called with the spec of each job in its own
+  thread."""
+  def __init__(self, run_job, memory_budget, job_memory=JOB_MEMORY,
+               history_size=1000):
+    self.run_job = run_job
+    self.memory_budget = memory_budget
+    self.job_memory = job_memory
+    self.memory_in_use = 0
+    self.queue = deque()
+    self.jobs = OrderedDict()
+    self.history_size = history_size
+    self.job_ids = itertools.count(1)
+    self.condition = threading.Condition()
+    self.stopped = False
+    self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+    self.dispatcher.start()
+
+  def submit(self, spec, memory=None):
+    memory = memory if memory is not None else self.job_memory
+    with self.condition:
+      job = Job(next(self.job_ids), spec, memory)
+      self.jobs[job.job_id] = job
+      self.queue.append(job)
+      self._forget_old_jobs()
+      self.condition.notify_all()
+    logger.info("Queued job %s to annotate %s", job.job_id, spec['vcf_file'])
+    return job.job_id
+
+  def _forget_old_jobs(self):
+    finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+    for job_id in finished[:max(len(self.jobs) - self.history_size, 0)]:
+      del self.jobs[job_id]
+
+  def _get_job(self, job_id):
+    try:
+      return self.jobs[job_id]
+    except KeyError:
+      raise ServerError("Unknown job %s" % job_id)
+
+  def status(self, job_id):
+    return self._get_job(job_id).status()
+
+  def wait(self, job_id):
+    job = self._get_job(job_id)
+    job.done.wait()
+    return job.status()
+
+  def stats(self):
+    with self.condition:
+      states = [job.state for job in self.jobs.values()]
+      return {
+        'queue_depth': len(self.queue),
+        'running': states.count('running'),
+        'succeeded': states.count('succeeded'),
+        'failed': states.count('failed'),
+        'memory_budget': self.memory_budget,
+        'memory_in_use': self.memory_in_use,
+        'jobs': [job.status() for job in self.jobs.values()]
+      }
+
+  def _can_start(self):
+    return (self.memory_in_use == 0 or
+            self.memory_in_use + self.queue[0].memory <= self.memory_budget)
+
+  def _dispatch(self):
+    while True:
+      with self.condition:
+        self.condition.wait_for(lambda: self.stopped or
+                                (len(self.queue) > 0 and self._can_start()))
+        if self.stopped:
+          return
+        job = self.queue.popleft()
+        job.state = 'running'
+        job.started = time.time()
+        self.memory_in_use += job.memory
+      threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+  def _run(self, job):
+    logger.info("Starting job %s", job.job_id)
+    try:
+      self.run_job(job.spec)
+      job.state = 'succeeded'
+    except Exception as e:
+      logger.exception("Job %s failed", job.job_id)
+      job.state = 'failed'
+      job.error = "%s: %s" % (type(e).__name__, e)
+    job.finished = time.time()
+    with self.condition:
+      self.memory_in_use -= job.memory
+      self.condition.notify_all()
+    job.done.set()
+    logger.info("Finished job %s (%s)", job.job_id, job.state)
+
+  def stop(self):
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+  """Handles newline delimited JSON requests, one response per request"""
+  def handle(self):
+    for line in self.rfile:
+      try:
+        request = json.loads(line.decode('utf-8'))
+        response = {'ok': True, 'result': self.server.handle_request(request)}
+      except (ValueError, KeyError, OSError) as e:
+        response = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+      except Exception as e:
+        # e.g. a malformed request; answer it so the client isn't left waiting
+        logger.exception("Failed to handle a request")
+        response = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+      self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+      self.wfile.flush()
+
+class AnnotationServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+  """Accepts annotation jobs on a Unix socket
+
+  Java and SnpEff are found once when the server starts and built databases
+  are kept in the server's cache, so each job only pays for annotation."""
+  daemon_threads = True
+
+  def __init__(self, socket_path, server_args, memory_budget):
+    self.server_args = server_args
+    self.scheduler = JobScheduler(self.run_job, memory_budget)
+    if os.path.exists(socket_path):
+      if server_running(socket_path):
+        raise ServerError("A server is already listening on %s" % socket_path)
+      os.remove(socket_path) # Left behind by a server which was killed
+    socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+  def server_bind(self):
+    socketserver.UnixStreamServer.server_bind(self)
+    # Only the user running the server can submit jobs; this is done before
+    # the socket starts listening so nobody else can connect in between
+    os.chmod(self.server_address, 0o600)
+
+  def handle_request(self, request):
+    command = request['command']
+    if command == 'submit':
+      spec = _validate_job(request['job'])
+      return self.scheduler.submit(spec, self.job_memory(spec))
+    elif command == 'status':
+      return self.scheduler.status(request['job_id'])
+    elif command == 'wait':
+      return self.scheduler.wait(request['job_id'])
+    elif command == 'stats':
+      return self.scheduler.stats()
+    raise ServerError("Unknown command '%s'" % command)
+
+  def _job_args(self, spec):
+    args = argparse.Namespace(**vars(self.server_args))
+    args.coding_table = spec['coding_table']
+    args.threads = 1
+    args.bgzip = spec['bgzip']
+    args.tabix = spec['bgzip'] and spec['tabix']
+    args.metrics_file = spec['metrics_file']
+    args.summary_file = spec['summary_file']
+    args.prune = False # Jobs share the server's cached databases
+    args.prune_distance = None
+    args.resume_dir = None
+    args.contig_aliases = None
+    args.contig_alias_rules = None
+    args.contig_report = None
+    args.preflight = False
+    args.impacts = None
+    args.effects = None
+    args.genes = None
+    args.only_matching_annotations = False
+    args.effects_table = None
+    return args
+
+  def job_memory(self, spec):
+    """The biggest Java heap planned for a job, in bytes"""
+    args = self._job_args(spec)
+    with open(spec['gff_file'], 'r') as args.gff_file:
+      resource_plan = plan_annotation_resources(args,
+                                                os.path.getsize(spec['vcf_file']),
+                                                1)
+    return resource_plan.peak_heap_mb() * 1024**2
+
+  def run_job(self, spec):
+    args = self._job_args(spec)
+    with open(spec['gff_file'], 'r') as args.gff_file, \
+         open(spec['vcf_file'], 'r') as args.vcf_file:
+      args.output_vcf = open(spec['output_vcf'], 'w')
+      annotate_vcf(args)
+
+  def server_close(self):
+    self.scheduler.stop()
+    socketserver.UnixStreamServer.server_close(self)
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+
+def _validate_job(job):
+  spec = {
+    'gff_file': job['gff_file'],
+    'vcf_file': job['vcf_file'],
+    'output_vcf': job['output_vcf'],
+    'coding_table': job.get('coding_table', 'default: Bacterial_and_Plant_Plastid'),
+    'bgzip': bool(job.get('bgzip', is_compressed_filename(job['output_vcf']))),
+    'tabix': bool(job.get('tabix', False)),
+    'metrics_file': job.get('metrics_file'),
+    'summary_file': job.get('summary_file')
+  }
+  for key in ['gff_file', 'vcf_file', 'output_vcf', 'metrics_file', 'summary_file']:
+    if spec[key] is not None and not os.path.isabs(spec[key]):
+      raise ServerError("%s must be an absolute path" % key)
+  return spec
+
+def send_request(socket_path, request):
+  """Sends a request to the server and returns its result"""
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(socket_path)
+    client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    with client.makefile('r', encoding='utf-8') as responses:
+      response = json.loads(responses.readline())
+  if not response['ok']:
+    raise ServerError(response['error'])
+  return response['result']
+
+def server_running(socket_path):
+  try:
+    send_request(socket_path, {'command': 'stats'})
+    return True
+  except (OSError, ValueError):
+    return False
+
+def submit_and_wait(socket_path, gff_filename, vcf_filename, output_filename,
+                    coding_table, bgzip=False, tabix=False, metrics_file=None,
+                    summary_file=None):
+  """Runs an annotation job on the server, raising ServerError if it fails"""
+  job = {
+    'gff_file': os.path.abspath(gff_filename),
+    'vcf_file': os.path.abspath(vcf_filename),
+    'output_vcf': os.path.abspath(output_filename),
+    'coding_table': coding_table,
+    'bgzip': bgzip,
+    'tabix': tabix,
+    'metrics_file': os.path.abspath(metrics_file) if metrics_file is not None else None,
+    'summary_file': os.path.abspath(summary_file) if summary_file is not None else None
+  }
+  job_id = send_request(socket_path, {'command': 'submit', 'job': job})
+  logger.info("Submitted job %s to the server on %s", job_id, socket_path)
+  status = send_request(socket_path, {'command': 'wait', 'job_id': job_id})
+  if status['state'] != 'succeeded':
+    raise ServerError("Job %s failed: %s" % (job_id, status['error']))
+  return status
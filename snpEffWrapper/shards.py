@@ -0,0 +1,93 @@
+import logging
+import os
+
+from itertools import chain
+
+from .compression import uncompressed_size
+
+logger = logging.getLogger(__name__)
+
+def _read_header(vcf_file):
+  """Reads the header of a VCF, returns it and the first record (or None)"""
+  header = []
+  for line in vcf_file:
+    if line[0] != '#':
+      return header, line
+    header.append(line)
+  return header, None
+
+def _start_shard(shard_dir, shard_filenames, header):
+  shard_filenames.append(os.path.join(shard_dir,
+                                      "shard_%s.vcf" % len(shard_filenames)))
+  shard_file = open(shard_filenames[-1], 'w')
+  shard_file.writelines(header)
+  return shard_file
+
+def split_vcf(vcf_file, shard_dir, shard_count):
+  """Splits a VCF into at most shard_count VCFs of consecutive records
+
+  Each shard has a copy of the header and roughly the same number of bytes
+  of records.  Shards end between contigs where they can and only split a
+  contig into ranges of positions when it's too big for one shard, so
+  concatenating the records of the shards in order gives the original VCF.
+  Returns the filenames of the shards."""
+  vcf_file.seek(0)
+  target_size = max(uncompressed_size(vcf_file.name) / shard_count, 1)
+  header, first_record = _read_header(vcf_file)
+  records = [] if first_record is None else chain([first_record], vcf_file)
+  shard_filenames = []
+  shard_file = None
+  shard_size = 0
+  previous_contig = None
+  for line in records:
+    contig = line.split('\t', 1)[0]
+    full = shard_size >= target_size
+    full_enough = contig != previous_contig and shard_size >= target_size / 2
+    if shard_file is None or (len(shard_filenames) < shard_count and
+                              (full or full_enough)):
+      if shard_file is not None:
+        shard_file.close()
+      shard_file = _start_shard(shard_dir, shard_filenames, header)
+      shard_size = 0
+    shard_file.write(line)
+    shard_size += len(line)
+    previous_contig = contig
+  if shard_file is None:
+    # No records, still annotate the header so that the output has one
+    shard_file = _start_shard(shard_dir, shard_filenames, header)
+  shard_file.close()
+  logger.debug("Split %s into %s shards" % (vcf_file.name, len(shard_filenames)))
+  return shard_filenames
+
+def split_vcf_records(vcf_file, shard_dir, shard_records):
+  """Splits a VCF into VCFs of shard_records consecutive records (fewer in the last)
+
+  Like split_vcf, each has a copy of the header and concatenating their
+  records in order gives the original VCF.  Returns their filenames."""
+  vcf_file.seek(0)
+  header, first_record = _read_header(vcf_file)
+  records = [] if first_record is None else chain([first_record], vcf_file)
+  shard_filenames = []
+  shard_file = _start_shard(shard_dir, shard_filenames, header)
+  shard_size = 0
+  for line in records:
+    if shard_size == shard_records:
+      shard_file.close()
+      shard_file = _start_shard(shard_dir, shard_filenames, header)
+      shard_size = 0
+    shard_file.write(line)
+    shard_size += 1
+  shard_file.close()
+  logger.debug("Split %s into %s shards" % (vcf_file.name, len(shard_filenames)))
+  return shard_filenames
+
+def merged_vcf_lines(vcf_filenames):
+  """Yields the lines of VCFs with their records in order, using the first one's header"""
+  for i, vcf_filename in enumerate(vcf_filenames):
+    with open(vcf_filename, 'r') as vcf_file:
+      header, line = _read_header(vcf_file)
+      if i == 0:
+        yield from header
+      if line is not None:
+        yield line
+        yield from vcf_file
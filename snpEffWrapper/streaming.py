@@ -0,0 +1,142 @@
+import gzip
+import io
+import logging
+import re
+import tempfile
+
+from collections import Counter
+from itertools import chain
+
+logger = logging.getLogger(__name__)
+
+# Records are kept in memory up to this many bytes while the contigs are
+# found, then spill to a temporary file
+DEFAULT_SPOOL_SIZE = 64*1024*1024
+
+CONTIG_HEADER = re.compile('^##contig=<(?:.*,)?ID=([^,>]+)')
+
+def _decompressed(vcf_stream):
+  """Decompresses a gzipped (or bgzipped) stream on the fly, e.g. from `bcftools view -Oz`"""
+  buffer = getattr(vcf_stream, 'buffer', None)
+  if buffer is None or not hasattr(buffer, 'peek'):
+    return vcf_stream
+  if buffer.peek(2)[:2] != b'\x1f\x8b':
+    return vcf_stream
+  logger.debug("Decompressing %s" % getattr(vcf_stream, 'name', 'the VCF'))
+  return io.TextIOWrapper(gzip.GzipFile(fileobj=buffer), encoding='utf-8')
+
+class StreamedVCF(object):
+  """A VCF read from a stream (e.g. stdin) which SnpEff annotates as it's read
+
+  The header is read straight away.  The contigs come from its ##contig
+  lines if it has any, otherwise the records are read into a buffer to
+  find them (see contigs), which spills to a temporary file in spool_dir
+  once it's bigger than spool_size.  SnpEff reads the VCF from its stdin
+  (see read), so a VCF with ##contig lines is never written to disk."""
+  def __init__(self, vcf_stream, spool_dir=None, spool_size=DEFAULT_SPOOL_SIZE):
+    name = getattr(vcf_stream, 'name', None)
+    self.name = name if isinstance(name, str) else '<stream>'
+    self.spool_dir = spool_dir
+    self.spool_size = spool_size
+    self.header = []
+    self.records = None
+    self.undeclared_contigs = Counter()
+    self.record_contigs = Counter()
+    self._stream = _decompressed(vcf_stream)
+    self._first_record = None
+    self._spool = None
+    self._lines = None
+    for line in self._stream:
+      if line[0] != '#':
+        self._first_record = line
+        break
+      self.header.append(line)
+    self.header_contigs = []
+    for line in self.header:
+      match = CONTIG_HEADER.match(line)
+      if match is not None:
+        self.header_contigs.append(match.group(1))
+
+  def _records(self):
+    if self._first_record is None:
+      return iter([])
+    return chain([self._first_record], self._stream)
+
+  def contigs(self, record_counts=None):
+    """The VCF's contigs, from its ##contig lines or by reading its records
+
+    Contigs from the ##contig lines might not have any records (see
+    from_header).  If the records have to be read, record_counts (a
+    Counter) is updated with the number on each contig, as get_vcf_contigs
+    does, and records is set to their total."""
+    if len(self.header_contigs) > 0:
+      logger.debug("Using the %s contigs in the header of %s" % (len(self.header_contigs),
+                                                               self.name))
+      return sorted(set(self.header_contigs))
+    self._spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size,
+                                                mode='w+', dir=self.spool_dir,
+                                                prefix='.snpeff_input_')
+    contig_counts = Counter()
+    spooled_bytes = 0
+    for line in self._records():
+      contig_counts[line.split('\t', 1)[0].strip()] += 1
+      spooled_bytes += self._spool.write(line)
+    self._spool.seek(0)
+    if spooled_bytes > self.spool_size:
+      logger.info("%s has no ##contig lines, its records were copied to %s to find them" %
+                  (self.name, self.spool_dir or 'the working directory'))
+    if record_counts is not None:
+      record_counts.update(contig_counts)
+    self.records = sum(contig_counts.values())
+    return sorted(contig_counts)
+
+  def from_header(self):
+    """Were the contigs taken from the ##contig lines, rather than the records?"""
+    return self._spool is None and len(self.header_contigs) > 0
+
+  def lines(self):
+    """Yields the lines of the VCF
+
+    If the contigs were taken from the ##contig lines, the records on each
+    contig are counted in record_contigs as they're read.  Those on contigs
+    which aren't in the ##contig lines are also counted in
+    undeclared_contigs, with a warning once the last line has been read,
+    as they weren't checked against the GFF."""
+    yield from self.header
+    if self._spool is not None:
+      yield from self._spool
+      return
+    declared_contigs = set(self.header_contigs)
+    for line in self._records():
+      contig = line.split('\t', 1)[0].strip()
+      self.record_contigs[contig] += 1
+      if contig not in declared_contigs:
+        self.undeclared_contigs[contig] += 1
+      yield line
+    for contig, count in sorted(self.undeclared_contigs.items()):
+      logger.warn("%s records on contig '%s' which isn't in the ##contig lines of %s" %
+                  (count, contig, self.name))
+
+  def read(self, size=-1):
+    """Reads the VCF as bytes, so it can be copied to SnpEff like a file"""
+    if self._lines is None:
+      self._lines = self.lines()
+    chunks = []
+    length = 0
+    while size < 0 or length < size:
+      line = next(self._lines, None)
+      if line is None:
+        break
+      chunks.append(line.encode('utf-8'))
+      length += len(chunks[-1])
+    return b''.join(chunks)
+
+  def close(self):
+    if self._spool is not None:
+      self._spool.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.close()
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from .records import get_info_value
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_VERSION = 1
+SUMMARY_COLUMNS = ['contig', 'gene', 'effect', 'impact', 'variants', 'alleles']
+
+class AnnotationSummary(object):
+  """Counts of annotated variants by contig, gene, effect and impact
+
+  A record is counted once for each different (gene, effect, impact) in its
+  ANN field, along with the number of its alleles which have it.  Effects
+  like 'missense_variant&splice_region_variant' are counted under each
+  term.  The names are interned so each is only stored once however many
+  rows it's in.  Summaries of shards or batches of VCFs can be merged."""
+  def __init__(self):
+    self.records = 0
+    self.annotated_records = 0
+    self.counts = {} # (contig, gene, effect, impact) -> [variants, alleles]
+
+  def add_record(self, contig, ann):
+    self.records += 1
+    if not ann or ann is True:
+      return
+    self.annotated_records += 1
+    record_alleles = {}
+    for annotation in ann.split(','):
+      fields = annotation.split('|', 5)
+      if len(fields) < 5:
+        fields.extend([''] * (5 - len(fields)))
+      allele, effects, impact, gene_name, gene_id = fields[:5]
+      gene = gene_name or gene_id
+      for effect in effects.split('&'):
+        record_alleles.setdefault((gene, effect, impact), set()).add(allele)
+    contig = sys.intern(contig)
+    for (gene, effect, impact), alleles in record_alleles.items():
+      key = (contig, sys.intern(gene), sys.intern(effect), sys.intern(impact))
+      counts = self.counts.get(key)
+      if counts is None:
+        self.counts[key] = [1, len(alleles)]
+      else:
+        counts[0] += 1
+        counts[1] += len(alleles)
+
+  def add_line(self, line):
+    """Counts a record of an annotated VCF; only its contig and ANN are looked at"""
+    columns = line.split('\t', 8)
+    ann = get_info_value(columns[7].rstrip('\r\n'), 'ANN') if 'ANN=' in line else None
+    self.add_record(columns[0], ann)
+
+  def merge(self, other):
+    self.records += other.records
+    self.annotated_records += other.annotated_records
+    for key, (variants, alleles) in other.counts.items():
+      counts = self.counts.get(key)
+      if counts is None:
+        self.counts[key] = [variants, alleles]
+      else:
+        counts[0] += variants
+        counts[1] += alleles
+    return self
+
+  def rows(self):
+    """The counts as sorted lists in the order of SUMMARY_COLUMNS"""
+    return [list(key) + counts for key, counts in sorted(self.counts.items())]
+
+  def to_dict(self):
+    return {
+      'version': SUMMARY_VERSION,
+      'records': self.records,
+      'annotated_records': self.annotated_records,
+      'columns': SUMMARY_COLUMNS,
+      'rows': self.rows()
+    }
+
+  def _write_tsv(self, summary_file):
+    summary_file.write("## records=%s\n" % self.records)
+    summary_file.write("## annotated_records=%s\n" % self.annotated_records)
+    summary_file.write("\t".join(SUMMARY_COLUMNS) + "\n")
+    for row in self.rows():
+      summary_file.write("\t".join(str(value) for value in row) + "\n")
+
+  def write(self, summary_filename):
+    """Writes the summary as JSON if summary_filename ends in .json, otherwise as TSV"""
+    summary_dir = os.path.dirname(os.path.abspath(summary_filename))
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=summary_dir,
+                                     prefix='.summary_') as summary_file:
+      if summary_filename.endswith('.json'):
+        json.dump(self.to_dict(), summary_file)
+      else:
+        self._write_tsv(summary_file)
+    os.replace(summary_file.name, summary_filename)
+    logger.info("Wrote a summary of the annotations to %s" % summary_filename)
+
+  @classmethod
+  def read(cls, summary_filename):
+    """Reads a summary written by write, e.g. to merge it with others"""
+    summary = cls()
+    with open(summary_filename, 'r') as summary_file:
+      if summary_filename.endswith('.json'):
+        summary_dict = json.load(summary_file)
+        summary.records = summary_dict['records']
+        summary.annotated_records = summary_dict['annotated_records']
+        rows = summary_dict['rows']
+      else:
+        rows = []
+        for line in summary_file:
+          if line.startswith('## '):
+            name, value = line[3:].strip().split('=', 1)
+            if name in ['records', 'annotated_records']:
+              setattr(summary, name, int(value))
+          elif not line.startswith('contig\t'):
+            rows.append(line.rstrip('\n').split('\t'))
+    for contig, gene, effect, impact, variants, alleles in rows:
+      key = tuple(sys.intern(name) for name in [contig, gene, effect, impact])
+      summary.counts[key] = [int(variants), int(alleles)]
+    return summary
+
+def merge_summaries(summary_filenames, output_filename):
+  """Merges summaries written by separate runs into output_filename"""
+  summary = AnnotationSummary()
+  for summary_filename in summary_filenames:
+    summary.merge(AnnotationSummary.read(summary_filename))
+  summary.write(output_filename)
+  return summary
@@ -0,0 +1,188 @@
+import gzip
+import logging
+import os
+import tempfile
+
+from .records import EFFECT_FIELDS, get_info_value
+
+logger = logging.getLogger(__name__)
+
+# Rows are kept in memory until there are this many, then written as a row
+# group of a Parquet file (or a record batch of an Arrow file)
+DEFAULT_BATCH_ROWS = 100000
+
+RECORD_COLUMNS = ['chrom', 'pos', 'id', 'ref', 'alt', 'filter']
+TABLE_COLUMNS = RECORD_COLUMNS + EFFECT_FIELDS
+INTEGER_COLUMNS = ['pos', 'distance']
+
+class EffectsTableError(ValueError):
+  pass
+
+def table_format(table_filename):
+  """The format to write table_filename in, from its extension
+
+  .parquet is Parquet, .arrow, .feather and .ipc are the Arrow IPC file
+  format and anything else is TSV (gzipped if it ends in .gz)."""
+  extension = os.path.splitext(table_filename)[1].lower()
+  if extension == '.parquet':
+    return 'parquet'
+  if extension in ['.arrow', '.feather', '.ipc']:
+    return 'arrow'
+  return 'tsv'
+
+def _import_pyarrow(table_filename):
+  try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+  except ImportError:
+    raise EffectsTableError("Writing %s needs pyarrow (pip install pyarrow), or use a .tsv or .tsv.gz file instead" %
+                            table_filename)
+  return pyarrow
+
+def check_effects_table(table_filename):
+  """Checks that table_filename can be written, before the annotation starts"""
+  if table_format(table_filename) != 'tsv':
+    _import_pyarrow(table_filename)
+  table_dir = os.path.dirname(os.path.abspath(table_filename))
+  if not os.path.isdir(table_dir):
+    raise EffectsTableError("Can't write %s, %s doesn't exist" % (table_filename,
+                                                                  table_dir))
+
+def effect_rows(line):
+  """The rows of TABLE_COLUMNS for each annotation in a record's ANN field
+
+  The values are the strings in the VCF; records without any annotations
+  have no rows."""
+  columns = line.rstrip('\r\n').split('\t', 8)
+  ann = get_info_value(columns[7], 'ANN') if 'ANN=' in columns[7] else None
+  if not ann or ann is True:
+    return []
+  record = columns[:5] + [columns[6]]
+  field_count = len(EFFECT_FIELDS)
+  rows = []
+  for annotation in ann.split(','):
+    fields = annotation.split('|', field_count - 1)
+    if len(fields) < field_count:
+      fields.extend([''] * (field_count - len(fields)))
+    rows.append(record + fields)
+  return rows
+
+def _integer(value):
+  try:
+    return int(value)
+  except ValueError:
+    return None # e.g. empty
+
+class EffectsTable(object):
+  """A table of one row per annotation of the records of an annotated VCF
+
+  The ANN field of each record added with add_line is split into a row
+  per annotation (i.e. per allele and effect) with a column for each of
+  EFFECT_FIELDS after the record's RECORD_COLUMNS.  It's written as TSV,
+  Parquet or Arrow (see table_format); Parquet and Arrow need pyarrow, and
+  have integer pos and distance columns.  Rows are written every
+  batch_rows rows so the memory used doesn't depend on the size of the
+  VCF.  The table is written next to table_filename and only renamed over
+  it by close(); abort() discards it."""
+  def __init__(self, table_filename, batch_rows=DEFAULT_BATCH_ROWS):
+    self.filename = table_filename
+    self.format = table_format(table_filename)
+    self.batch_rows = batch_rows
+    self.rows = 0
+    self._pyarrow = None
+    self._writer = None
+    self._batch = None
+    table_dir = os.path.dirname(os.path.abspath(table_filename))
+    with tempfile.NamedTemporaryFile(delete=False, dir=table_dir,
+                                     prefix='.effects_',
+                                     suffix=os.path.basename(table_filename)) as temp_file:
+      self._temp_filename = temp_file.name
+    if self.format == 'tsv':
+      if table_filename.endswith('.gz'):
+        self._file = gzip.open(self._temp_filename, 'wt', compresslevel=6)
+      else:
+        self._file = open(self._temp_filename, 'w', buffering=1024*1024)
+      self._file.write("\t".join(TABLE_COLUMNS) + "\n")
+    else:
+      self._pyarrow = _import_pyarrow(table_filename)
+      self._schema = self._pyarrow.schema([
+        (column, self._pyarrow.int64() if column in INTEGER_COLUMNS else self._pyarrow.string())
+        for column in TABLE_COLUMNS
+      ])
+      if self.format == 'parquet':
+        self._file = None
+        self._writer = self._pyarrow.parquet.ParquetWriter(self._temp_filename,
+                                                           self._schema)
+      else:
+        self._file = open(self._temp_filename, 'wb')
+        self._writer = self._pyarrow.ipc.new_file(self._file, self._schema)
+      self._batch = []
+
+  def add_line(self, line):
+    """Adds the annotations of a record of an annotated VCF"""
+    rows = effect_rows(line)
+    self.rows += len(rows)
+    if self._batch is None:
+      self._file.writelines("\t".join(row) + "\n" for row in rows)
+      return
+    self._batch.extend(rows)
+    if len(self._batch) >= self.batch_rows:
+      self._write_batch()
+
+  def _write_batch(self):
+    if len(self._batch) == 0:
+      return
+    pyarrow = self._pyarrow
+    arrays = []
+    for i, column in enumerate(TABLE_COLUMNS):
+      values = [row[i] for row in self._batch]
+      if column in INTEGER_COLUMNS:
+        arrays.append(pyarrow.array([_integer(value) for value in values],
+                                    type=pyarrow.int64()))
+      else:
+        arrays.append(pyarrow.array(values, type=pyarrow.string()))
+    batch = pyarrow.RecordBatch.from_arrays(arrays, names=TABLE_COLUMNS)
+    if self.format == 'parquet':
+      self._writer.write_table(pyarrow.Table.from_batches([batch], self._schema))
+    else:
+      self._writer.write_batch(batch)
+    self._batch = []
+
+  def _close_files(self):
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def close(self):
+    """Writes the last rows and moves the table to its filename"""
+    if self._temp_filename is None:
+      return
+    if self._batch is not None:
+      self._write_batch()
+    self._close_files()
+    os.replace(self._temp_filename, self.filename)
+    self._temp_filename = None
+    logger.info("Wrote %s annotations to %s" % (self.rows, self.filename))
+
+  def abort(self):
+    """Discards the table, unless it was already closed"""
+    if self._temp_filename is None:
+      return
+    try:
+      self._close_files()
+    finally:
+      os.remove(self._temp_filename)
+      self._temp_filename = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    if exception_type is None:
+      self.close()
+    else:
+      self.abort()
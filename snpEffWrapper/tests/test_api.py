@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import os
+import pkg_resources
+import shutil
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from snpEffWrapper.api import *
+from snpEffWrapper.wrapper import (AnnotationError, BuildDatabaseError, MissingCodonTableError,
+                                   NoCommonContigsError, PreflightError, get_vcf_contigs)
+
+def fake_annotated_lines(java_exec, snpeff_exec, vcf_filename, config_filename,
+                         stderr, annotation_stats_file, jvm_plan=None,
+                         metrics=None, vcf_input=None):
+  if vcf_input is not None:
+    vcf_file = StringIO(vcf_input.read().decode('utf-8'))
+  else:
+    vcf_file = open(vcf_filename, 'r')
+  with vcf_file:
+    for line in vcf_file:
+      if line[0] != '#':
+        position = int(line.split('\t')[1])
+        annotation = 'ERROR_OUT_OF_CHROMOSOME_RANGE' if position > 150 else ''
+        line = line.replace('\t.\tGT', '\tANN=A|missense_variant|MODERATE|baz_gene|%s\tGT' % annotation)
+      yield line
+
+@patch('snpEffWrapper.wrapper._snpeff_annotated_lines', fake_annotated_lines)
+@patch('snpEffWrapper.wrapper._snpeff_build_database')
+@patch('snpEffWrapper.api.check_and_amend_executables', lambda args: args)
+class TestApi(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_api_',
+                                        dir=os.getcwd())
+    tests_dir = pkg_resources.resource_filename('snpEffWrapper', 'tests')
+    self.gff_filename = os.path.join(self.working_dir, 'minimal.gff')
+    shutil.copy(os.path.join(tests_dir, 'data', 'minimal.gff'),
+                self.gff_filename)
+    self.options = {'coding_table': {'default': 'Bacterial_and_Plant_Plastid'},
+                    'scratch_dir': self.working_dir,
+                    'metrics_file': None,
+                    'cache_dir': None,
+                    'progress_interval': 0}
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def write_vcf(self, positions, contig='CHROM1'):
+    vcf_filename = os.path.join(self.working_dir, 'input.vcf')
+    with open(vcf_filename, 'w') as vcf_file:
+      vcf_file.write("##fileformat=VCFv4.1\n")
+      vcf_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tQUUX\n")
+      for position in positions:
+        vcf_file.write("%s\t%s\t.\tC\tA\t.\t.\t.\tGT\t1\n" % (contig, position))
+    return vcf_filename
+
+  def test_annotation_options(self, build_mock):
+    args = annotation_options(threads=2)
+    self.assertEqual(args.threads, 2)
+    self.assertEqual(args.jobs, 1)
+    self.assertEqual(args.coding_table, DEFAULT_CODING_TABLE)
+    self.assertRaises(TypeError, annotation_options, thread=2)
+    self.assertRaises(ValueError, annotation_options, threads=0)
+    self.assertRaises(ValueError, annotation_options, progress_interval=-1)
+
+  def test_annotate(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120, 130])
+    with annotate(self.gff_filename, vcf_filename, **self.options) as records:
+      records = list(records)
+    self.assertEqual([record.pos for record in records], [110, 120, 130])
+    self.assertEqual(records[0].effects[0].gene_name, 'baz_gene')
+    self.assertEqual(build_mock.call_count, 1)
+
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with open(vcf_filename, 'r') as vcf_file:
+      annotated_vcf = annotate(self.gff_filename, vcf_file,
+                               output=output_filename, **self.options)
+      positions = [record.pos for record in annotated_vcf]
+    self.assertEqual(positions, [110, 120, 130])
+    self.assertEqual(len(annotated_vcf.header), 2)
+    self.assertEqual(annotated_vcf.metrics.status, 'succeeded')
+    with open(output_filename, 'r') as output_file:
+      self.assertEqual(len([line for line in output_file if 'ANN=' in line]), 3)
+    self.assertEqual(sorted(os.listdir(self.working_dir)),
+                     ['input.vcf', 'minimal.gff', 'minimal.gff.index.json',
+                      'output.vcf'])
+
+  def test_annotate_stream(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    with open(vcf_filename, 'r') as vcf_file:
+      vcf_stream = StringIO(vcf_file.read())
+    records = annotate(self.gff_filename, vcf_stream, **self.options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+    self.assertEqual(sorted(os.listdir(self.working_dir)),
+                     ['input.vcf', 'minimal.gff', 'minimal.gff.index.json'])
+
+    # With ##contig lines the records are piped to SnpEff without reading them first
+    vcf_stream = StringIO(vcf_stream.getvalue().replace('#CHROM', '##contig=<ID=CHROM1>\n#CHROM'))
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with patch('snpEffWrapper.streaming.tempfile.SpooledTemporaryFile') as spool_mock:
+      metrics = annotate_file(self.gff_filename, vcf_stream, output_filename,
+                              **self.options)
+    self.assertFalse(spool_mock.called)
+    self.assertNotIn('input_records', metrics.counts)
+    self.assertEqual(metrics.counts['output_records'], 2)
+
+    vcf_stream.seek(0)
+    records = annotate(self.gff_filename, vcf_stream, threads=2, **self.options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+
+  def test_annotate_stream_unused_contigs(self, build_mock):
+    # Like GATK and bcftools, declare a contig without any records
+    vcf_filename = self.write_vcf([110, 120])
+    with open(vcf_filename, 'r') as vcf_file:
+      vcf = vcf_file.read().replace('#CHROM', '##contig=<ID=CHROM1>\n##contig=<ID=UNUSED>\n#CHROM')
+    with open(vcf_filename, 'w') as vcf_file:
+      vcf_file.write(vcf)
+    options = dict(self.options, coding_table={'CHROM1': 'Standard'})
+    records = annotate(self.gff_filename, vcf_filename, **options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+    records = annotate(self.gff_filename, StringIO(vcf), **options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+
+    # Records on a contig without a coding table still fail
+    options['coding_table'] = {'UNUSED': 'Standard'}
+    with self.assertRaises(MissingCodonTableError):
+      list(annotate(self.gff_filename, vcf_filename, **options))
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with self.assertRaises(MissingCodonTableError):
+      annotate_file(self.gff_filename, StringIO(vcf), output_filename, **options)
+    self.assertFalse(os.path.exists(output_filename))
+
+  def test_annotate_stopped_early(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120, 130])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with annotate(self.gff_filename, vcf_filename, output=output_filename,
+                  **self.options) as annotated_vcf:
+      record = next(annotated_vcf)
+      self.assertEqual(record.pos, 110)
+    self.assertEqual(annotated_vcf.metrics.status, 'stopped')
+    self.assertEqual(sorted(os.listdir(self.working_dir)),
+                     ['input.vcf', 'minimal.gff', 'minimal.gff.index.json'])
+
+  def test_annotation_errors(self, build_mock):
+    vcf_filename = self.write_vcf([110, 160])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    records = annotate(self.gff_filename, vcf_filename, output=output_filename,
+                       **self.options)
+    self.assertEqual(next(records).pos, 110)
+    self.assertEqual(next(records).pos, 160)
+    self.assertRaises(AnnotationError, next, records)
+    self.assertFalse(os.path.exists(output_filename))
+
+    records = annotate(self.gff_filename, vcf_filename, check=False,
+                       **self.options)
+    self.assertEqual(len(list(records)), 2)
+
+  def test_build_while_reading_vcf(self, build_mock):
+    build_started = threading.Event()
+    build_mock.side_effect = lambda *args: build_started.set()
+    def slow_get_vcf_contigs(*args):
+      self.assertTrue(build_started.wait(5))
+      return get_vcf_contigs(*args)
+    vcf_filename = self.write_vcf([110, 120])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with patch('snpEffWrapper.wrapper.get_vcf_contigs', slow_get_vcf_contigs):
+      metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                              **self.options)
+    self.assertEqual(metrics.counts['output_records'], 2)
+    self.assertEqual(build_mock.call_count, 1)
+
+  def test_build_stopped(self, build_mock):
+    killed = threading.Event()
+    def slow_build(java_exec, snpeff_exec, config_filename, stdout, stderr,
+                   jvm_plan, metrics, processes):
+      process = MagicMock()
+      process.poll.return_value = None
+      process.kill.side_effect = killed.set
+      processes.append(process)
+      if not killed.wait(5):
+        raise AssertionError("The build wasn't stopped")
+      raise BuildDatabaseError("Killed")
+    build_mock.side_effect = slow_build
+    vcf_filename = self.write_vcf([110], contig='NOT_IN_GFF')
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    self.assertRaises(NoCommonContigsError, annotate_file, self.gff_filename,
+                      vcf_filename, output_filename, **self.options)
+    self.assertTrue(killed.is_set())
+    self.assertEqual(sorted(os.listdir(self.working_dir)),
+                     ['input.vcf', 'minimal.gff', 'minimal.gff.index.json'])
+
+  def test_preflight(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    metrics = check_reference(self.gff_filename, vcf_filename, **self.options)
+    self.assertEqual(metrics.counts['preflight_errors'], 0)
+    self.assertEqual(build_mock.call_count, 0)
+
+    vcf_filename = self.write_vcf([110, 97, 250])
+    self.assertRaises(PreflightError, check_reference, self.gff_filename,
+                      vcf_filename, **self.options)
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with patch('snpEffWrapper.wrapper._snpeff_annotated_lines') as annotate_mock:
+      self.assertRaises(PreflightError, annotate_file, self.gff_filename,
+                        vcf_filename, output_filename, preflight=True,
+                        **self.options)
+    self.assertFalse(annotate_mock.called)
+    self.assertFalse(os.path.exists(output_filename))
+
+  def test_annotate_filtered(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                            impacts='high', **self.options)
+    self.assertEqual(metrics.counts['filtered_records'], 2)
+    self.assertEqual(metrics.counts['output_records'], 0)
+    with open(output_filename, 'r') as output_file:
+      lines = output_file.readlines()
+    self.assertEqual(lines[1], '##snpEffWrapperFilter="impacts=HIGH"\n')
+    self.assertEqual(len(lines), 3)
+
+    records = annotate(self.gff_filename, vcf_filename, threads=2,
+                       effects=['missense_variant'], **self.options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+
+    genes_filename = os.path.join(self.working_dir, 'genes.txt')
+    with open(genes_filename, 'w') as genes_file:
+      genes_file.write("# Genes of interest\nfoo_gene\n")
+    records = annotate(self.gff_filename, vcf_filename, genes=genes_filename,
+                       **self.options)
+    self.assertEqual(list(records), [])
+
+    # The errors of the records which were filtered out are still reported
+    vcf_filename = self.write_vcf([110, 160])
+    self.assertRaises(AnnotationError, annotate_file, self.gff_filename,
+                      vcf_filename, output_filename, impacts='HIGH',
+                      **self.options)
+    self.assertRaises(ValueError, annotation_options, impacts='SEVERE')
+    self.assertRaises(ValueError, annotation_options,
+                      only_matching_annotations=True)
+
+  def test_effects_table(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    table_filename = os.path.join(self.working_dir, 'effects.tsv')
+    metrics = annotate_file(self.gff_filename, vcf_filename, None,
+                            effects_table=table_filename, **self.options)
+    self.assertEqual(metrics.counts['effects_table_rows'], 2)
+    with open(table_filename, 'r') as table_file:
+      rows = [line.rstrip('\n').split('\t') for line in table_file]
+    self.assertEqual(rows[0][:8], ['chrom', 'pos', 'id', 'ref', 'alt', 'filter', 'allele', 'annotation'])
+    self.assertEqual([row[1] for row in rows[1:]], ['110', '120'])
+    self.assertEqual(rows[1][9], 'baz_gene')
+
+    records = annotate(self.gff_filename, vcf_filename, threads=2,
+                       effects_table=table_filename, **self.options)
+    self.assertEqual([record.pos for record in records], [110, 120])
+    with open(table_filename, 'r') as table_file:
+      self.assertEqual(len(table_file.readlines()), 3)
+
+    # The table isn't written if there were problems with the annotations
+    os.remove(table_filename)
+    vcf_filename = self.write_vcf([110, 160])
+    self.assertRaises(AnnotationError, annotate_file, self.gff_filename,
+                      vcf_filename, None, effects_table=table_filename,
+                      **self.options)
+    self.assertFalse(os.path.exists(table_filename))
+    self.assertRaises(ValueError, annotate_batch, self.gff_filename,
+                      [vcf_filename], self.working_dir,
+                      effects_table=table_filename, **self.options)
+
+  def test_annotate_pruned(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                            prune=True, prune_distance=5000, **self.options)
+    self.assertEqual(metrics.counts['pruned_contigs'], 1)
+    self.assertEqual(metrics.counts['pruned_features'], 2)
+    self.assertEqual(metrics.counts['output_records'], 2)
+    self.assertIn('prune_reference', metrics.stages)
+    self.assertRaises(ValueError, annotation_options, prune_distance=100)
+
+  def test_annotate_aliased_contigs(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120], contig='chrCHROM1')
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    report_filename = os.path.join(self.working_dir, 'contigs.tsv')
+    self.assertRaises(ValueError, annotate_file, self.gff_filename,
+                      vcf_filename, output_filename, **self.options)
+    metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                            contig_alias_rules='chr',
+                            contig_report=report_filename, **self.options)
+    self.assertEqual(metrics.counts['aliased_contigs'], 1)
+    self.assertIn('rename_contigs', metrics.stages)
+    with open(output_filename, 'r') as output_file:
+      self.assertEqual(len([line for line in output_file
+                            if line.startswith('chrCHROM1\t')]), 2)
+    with open(report_filename, 'r') as report_file:
+      self.assertIn("chrCHROM1\tCHROM1\taliased\t2\n", report_file.read())
+    self.assertRaises(ValueError, annotation_options, contig_alias_rules='foo')
+
+  @patch('snpEffWrapper.wrapper.ProcessPoolExecutor', ThreadPoolExecutor)
+  def test_annotate_resumed(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120, 130, 140])
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    resume_dir = os.path.join(self.working_dir, 'resume')
+    snpeff_exec = os.path.join(self.working_dir, 'snpEff.jar')
+    open(snpeff_exec, 'w').close()
+    self.options['snpeff_exec'] = snpeff_exec
+    annotated_vcfs = []
+    def killed_annotated_lines(java_exec, snpeff_exec, vcf_filename, *args, **kwargs):
+      annotated_vcfs.append(vcf_filename)
+      with open(vcf_filename, 'r') as vcf_file:
+        if '\t130\t' in vcf_file.read():
+          raise MemoryError("Killed")
+      yield from fake_annotated_lines(java_exec, snpeff_exec, vcf_filename, *args, **kwargs)
+    with patch('snpEffWrapper.wrapper._snpeff_annotated_lines', killed_annotated_lines):
+      self.assertRaises(MemoryError, annotate_file, self.gff_filename,
+                        vcf_filename, output_filename, resume_dir=resume_dir,
+                        chunk_records=1, threads=2, **self.options)
+    self.assertEqual(len(annotated_vcfs), 4)
+    self.assertFalse(os.path.exists(output_filename))
+    self.assertTrue(os.path.isfile(os.path.join(resume_dir, 'manifest.json')))
+
+    summary_filename = os.path.join(self.working_dir, 'summary.tsv')
+    options = dict(self.options, summary_file=summary_filename)
+    metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                            resume_dir=resume_dir, chunk_records=1, **options)
+    self.assertEqual(metrics.counts['chunks'], 4)
+    self.assertEqual(metrics.counts['resumed_chunks'], 3)
+    self.assertEqual(build_mock.call_count, 1) # The database was reused
+    with open(output_filename, 'r') as output_file:
+      self.assertEqual([line.split('\t')[1] for line in output_file
+                        if line[0] != '#'], ['110', '120', '130', '140'])
+    with open(summary_filename, 'r') as summary_file:
+      self.assertEqual(summary_file.read().splitlines()[-1],
+                       "CHROM1\tbaz_gene\tmissense_variant\tMODERATE\t4\t4")
+    self.assertFalse(os.path.exists(resume_dir))
+    self.assertRaises(ValueError, annotate_batch, self.gff_filename,
+                      [vcf_filename], self.working_dir, resume_dir=resume_dir)
+
+  @patch('snpEffWrapper.wrapper.ProcessPoolExecutor', ThreadPoolExecutor)
+  def test_annotate_batch_deduplicated(self, build_mock):
+    vcf_filenames = []
+    for name, positions in [('a', [110, 120]), ('b', [120, 130]), ('c', [130, 160])]:
+      vcf_filenames.append(os.path.join(self.working_dir, "%s.vcf" % name))
+      shutil.move(self.write_vcf(positions), vcf_filenames[-1])
+    output_dir = os.path.join(self.working_dir, 'output')
+    annotated_vcfs = []
+    def counted_annotated_lines(java_exec, snpeff_exec, vcf_filename, *args, **kwargs):
+      annotated_vcfs.append(vcf_filename)
+      with open(vcf_filename, 'r') as vcf_file:
+        for line in vcf_file:
+          if line[0] != '#': # A sites-only VCF
+            position = int(line.split('\t')[1])
+            annotation = 'ERROR_OUT_OF_CHROMOSOME_RANGE' if position > 150 else ''
+            line = line.replace('\t.\n', '\tANN=A|missense_variant|MODERATE|baz_gene|%s\n' % annotation)
+          yield line
+    with patch('snpEffWrapper.wrapper._snpeff_annotated_lines', counted_annotated_lines):
+      with self.assertRaises(AnnotationError):
+        annotate_batch(self.gff_filename, vcf_filenames, output_dir,
+                       deduplicate=True, jobs=2, **self.options)
+      self.assertEqual(len(annotated_vcfs), 1)
+      self.assertEqual(sorted(os.listdir(output_dir)),
+                       ['a.annotated.vcf', 'b.annotated.vcf']) # 160 is out of range
+
+      metrics = annotate_batch(self.gff_filename, vcf_filenames[:2],
+                               output_dir, deduplicate=True, **self.options)
+    self.assertEqual(metrics.counts['unique_sites'], 3)
+    self.assertIn('join_annotations', metrics.stages)
+    with open(os.path.join(output_dir, 'b.annotated.vcf'), 'r') as output_file:
+      self.assertEqual([line for line in output_file if line[0] != '#'], [
+        "CHROM1\t%s\t.\tC\tA\t.\t.\tANN=A|missense_variant|MODERATE|baz_gene|\tGT\t1\n" % position
+        for position in [120, 130]
+      ])
+
+  @patch('snpEffWrapper.wrapper.ProcessPoolExecutor', ThreadPoolExecutor)
+  def test_annotate_file(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120])
+    output_filename = os.path.join(self.working_dir, 'output.vcf.gz')
+    metrics = annotate_file(self.gff_filename, vcf_filename, output_filename,
+                            tabix=True, **self.options)
+    self.assertEqual(metrics.counts['output_records'], 2)
+    self.assertTrue(os.path.isfile("%s.tbi" % output_filename))
+
+    summary_filename = os.path.join(self.working_dir, 'summary.tsv')
+    options = dict(self.options, summary_file=summary_filename)
+    annotate_file(self.gff_filename, vcf_filename, output_filename, threads=2,
+                  **options)
+    with open(summary_filename, 'r') as summary_file:
+      self.assertEqual(summary_file.read().splitlines()[-1],
+                       "CHROM1\tbaz_gene\tmissense_variant\tMODERATE\t2\t2")
+    self.assertRaises(ValueError, annotate_file, self.gff_filename,
+                      vcf_filename, os.path.join(self.working_dir, 'output.vcf'),
+                      tabix=True, **self.options)
+
+if __name__ == '__main__':
+  unittest.main()
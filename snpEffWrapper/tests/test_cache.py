@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import MagicMock
+
+from snpEffWrapper.cache import *
+
+class TestDatabaseCache(unittest.TestCase):
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp(prefix='snpEffWrapper_cache_',
+                                      dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def fake_build(self, size=10):
+    def build(data_dir):
+      os.makedirs(data_dir)
+      with open(os.path.join(data_dir, 'snpEffectPredictor.bin'), 'w') as output:
+        output.write('x' * size)
+    return MagicMock(side_effect=build)
+
+  def test_database_cache_key(self):
+    gff_file = tempfile.NamedTemporaryFile(mode='w', dir=self.cache_dir,
+                                           delete=False)
+    gff_file.write("CHROM1\tEMBL\tCDS\t1\t10\t.\t+\t0\tID=foo\n")
+    gff_file.close()
+    key = database_cache_key(gff_file.name, {'CHROM1': 'Standard'}, '4.1l')
+    self.assertEqual(key, database_cache_key(gff_file.name,
+                                             {'CHROM1': 'Standard'}, '4.1l'))
+    self.assertNotEqual(key, database_cache_key(gff_file.name,
+                                                {'CHROM1': 'Mycoplasma'},
+                                                '4.1l'))
+    self.assertNotEqual(key, database_cache_key(gff_file.name,
+                                                {'CHROM1': 'Standard'}, '4.2'))
+
+  def test_database_only_built_once(self):
+    cache = DatabaseCache(self.cache_dir)
+    build = self.fake_build()
+    with cache.database('abc', build) as data_dir:
+      self.assertTrue(os.path.isfile(os.path.join(data_dir,
+                                                  'snpEffectPredictor.bin')))
+    with cache.database('abc', build) as data_dir:
+      self.assertEqual(data_dir, os.path.join(self.cache_dir, 'abc', 'data'))
+    self.assertEqual(build.call_count, 1)
+
+  def test_entry_permissions(self):
+    cache = DatabaseCache(self.cache_dir)
+    umask = os.umask(0o027)
+    try:
+      with cache.database('abc', self.fake_build()) as data_dir:
+        pass
+    finally:
+      os.umask(umask)
+    self.assertEqual(os.stat(os.path.join(self.cache_dir, 'abc')).st_mode & 0o777,
+                     0o750)
+    self.assertEqual([name for name in os.listdir(self.cache_dir)
+                      if name.startswith('.')], [])
+
+  def test_failed_build_not_cached(self):
+    cache = DatabaseCache(self.cache_dir)
+    build = MagicMock(side_effect=ValueError("Build failed"))
+    with self.assertRaises(ValueError):
+      with cache.database('abc', build) as data_dir:
+        pass
+    self.assertEqual([name for name in os.listdir(self.cache_dir)
+                      if not name.endswith('.lock')], [])
+
+  def test_evict_least_recently_used(self):
+    cache = DatabaseCache(self.cache_dir, max_size=1000)
+    for key in ['old', 'new']:
+      with cache.database(key, self.fake_build(size=400)) as data_dir:
+        pass
+    os.utime(os.path.join(self.cache_dir, 'old', '.complete'), (0, 0))
+    with cache.database('newest', self.fake_build(size=400)) as data_dir:
+      pass
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'old')))
+    self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'new')))
+    self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'newest')))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.checkpoint import *
+from snpEffWrapper.summary import AnnotationSummary
+
+class TestCheckpoint(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_checkpoint_',
+                                        dir=os.getcwd())
+    self.work_dir = os.path.join(self.working_dir, 'work')
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def write(self, filename, content):
+    with open(filename, 'w') as output_file:
+      output_file.write(content)
+    return filename
+
+  def start(self, run_key='abc'):
+    checkpoint = Checkpoint(self.work_dir, run_key)
+    if checkpoint.chunks is None:
+      os.makedirs(checkpoint.chunk_dir, exist_ok=True)
+      checkpoint.set_chunks([
+        self.write(os.path.join(checkpoint.chunk_dir, "shard_%s.vcf" % i),
+                   "#CHROM\nCHROM1\t%s\n" % i)
+        for i in range(3)
+      ])
+    return checkpoint
+
+  def complete(self, checkpoint, index, summary=None):
+    output_filename = self.write(os.path.join(self.working_dir, 'output.tmp'),
+                                 "#CHROM\nCHROM1\t%s\t.\tC\tA\t.\t.\tANN=A|foo||bar\n" % index)
+    checkpoint.complete(index, output_filename, {'ERROR_FOO': index}, summary)
+
+  def test_resume(self):
+    checkpoint = self.start()
+    self.assertEqual(checkpoint.completed_chunks, 0)
+    summary = AnnotationSummary()
+    summary.add_record('CHROM1', 'A|foo||bar')
+    self.complete(checkpoint, 0, summary)
+    self.complete(checkpoint, 2)
+
+    checkpoint = self.start()
+    self.assertEqual([checkpoint.is_complete(i) for i in range(3)],
+                     [True, False, True])
+    self.assertEqual(checkpoint.errors(2), {'ERROR_FOO': 2})
+    self.assertEqual(checkpoint.summary(0).rows(), summary.rows())
+    self.assertEqual(checkpoint.summary(2).rows(), summary.rows()) # From its output
+
+    with open(checkpoint.output_filename(2), 'a') as output_file:
+      output_file.write("CHROM1\t3\n")
+    checkpoint = self.start()
+    self.assertEqual(checkpoint.completed_chunks, 1)
+    self.complete(checkpoint, 1)
+    self.complete(checkpoint, 2)
+    self.assertEqual(checkpoint.output_filenames(),
+                     [checkpoint.output_filename(i) for i in range(3)])
+
+    checkpoint.remove()
+    self.assertFalse(os.path.exists(self.work_dir))
+
+  def test_different_run(self):
+    checkpoint = self.start()
+    self.complete(checkpoint, 0)
+    os.makedirs(checkpoint.database_dir)
+    self.write(os.path.join(self.work_dir, 'notes.txt'), "mine")
+
+    checkpoint = Checkpoint(self.work_dir, 'def')
+    self.assertIsNone(checkpoint.chunks)
+    self.assertEqual(os.listdir(self.work_dir), ['notes.txt'])
+
+    checkpoint = self.start('def')
+    with open(checkpoint.input_filename(1), 'a') as input_file:
+      input_file.write("CHROM1\t3\n")
+    self.assertIsNone(Checkpoint(self.work_dir, 'def').chunks)
+
+    self.write(checkpoint.manifest_filename, "{")
+    self.assertIsNone(Checkpoint(self.work_dir, 'def').chunks)
+    self.assertNotEqual(checkpoint_key('a', 1), checkpoint_key('a', 2))
+
+if __name__ == '__main__':
+  unittest.main()
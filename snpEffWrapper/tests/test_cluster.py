@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import pkg_resources
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from snpEffWrapper.cluster import *
+from snpEffWrapper.tests.test_api import fake_annotated_lines
+from snpEffWrapper.wrapper import AnnotationError, NoCommonContigsError
+
+@patch('snpEffWrapper.wrapper._snpeff_annotated_lines', fake_annotated_lines)
+@patch('snpEffWrapper.wrapper._snpeff_build_database')
+class TestCluster(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_cluster_',
+                                        dir=os.getcwd())
+    tests_dir = pkg_resources.resource_filename('snpEffWrapper', 'tests')
+    self.gff_filename = os.path.join(self.working_dir, 'minimal.gff')
+    shutil.copy(os.path.join(tests_dir, 'data', 'minimal.gff'),
+                self.gff_filename)
+    self.snpeff_exec = os.path.join(self.working_dir, 'snpEff.jar')
+    open(self.snpeff_exec, 'w').close()
+    self.work_dir = os.path.join(self.working_dir, 'work')
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def write_vcf(self, positions, contig='CHROM1'):
+    vcf_filename = os.path.join(self.working_dir, 'input.vcf')
+    with open(vcf_filename, 'w') as vcf_file:
+      vcf_file.write("##fileformat=VCFv4.1\n")
+      vcf_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tQUUX\n")
+      for position in positions:
+        vcf_file.write("%s\t%s\t.\tC\tA\t.\t.\t.\tGT\t1\n" % (contig, position))
+    return vcf_filename
+
+  def args(self, **options):
+    args = {'java_exec': 'java', 'snpeff_exec': self.snpeff_exec,
+            'coding_table': {'default': 'Bacterial_and_Plant_Plastid'},
+            'build_heap': None, 'annotate_heap': None, 'java_gc': None,
+            'java_options': None, 'scratch_dir': self.working_dir,
+            'keep': False, 'debug': False, 'metrics_file': None,
+            'cache_dir': None, 'cache_max_size': None, 'shards': None,
+            'shard_records': DEFAULT_SHARD_RECORDS, 'work_dir': self.work_dir,
+            'progress_interval': 0, 'bgzip': False, 'tabix': False,
+            'compression_threads': 1, 'summary_file': None}
+    args.update(options)
+    return argparse.Namespace(**args)
+
+  def plan(self, vcf_filename, **options):
+    with open(self.gff_filename, 'r') as gff_file:
+      return plan_shards(self.args(gff_file=gff_file, vcf_file=vcf_filename,
+                                   **options))
+
+  def test_plan_shards(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120, 130, 140, 150])
+    metrics = self.plan(vcf_filename, shards=2)
+    self.assertEqual(metrics.counts['shards'], 2)
+    self.assertEqual(build_mock.call_count, 1)
+    shard_plan = ShardPlan.load(self.work_dir)
+    self.assertEqual([shard['records'] for shard in shard_plan.plan['shards']],
+                     [3, 2])
+    self.assertEqual(shard_plan.plan['vcf_contigs'], ['CHROM1'])
+    self.assertTrue(os.path.isdir(os.path.join(self.work_dir, 'database')))
+
+    self.plan(vcf_filename, shards=2) # Planning again is harmless
+    self.assertEqual(build_mock.call_count, 1)
+    self.assertEqual(ShardPlan.load(self.work_dir).plan, shard_plan.plan)
+    self.assertRaises(ShardPlanError, self.plan, vcf_filename, shards=3)
+
+    self.assertRaises(ShardPlanError, ShardPlan.load, self.working_dir)
+    self.assertRaises(NoCommonContigsError, self.plan,
+                      self.write_vcf([110], contig='CHROM2'),
+                      work_dir=os.path.join(self.working_dir, 'other'))
+    self.assertFalse(os.path.exists(os.path.join(self.working_dir, 'other',
+                                                 'plan.json')))
+
+  def test_run_and_merge_shards(self, build_mock):
+    vcf_filename = self.write_vcf([110, 120, 130, 140, 150])
+    self.plan(vcf_filename, shard_records=2)
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    summary_filename = os.path.join(self.working_dir, 'summary.json')
+    self.assertRaises(ShardPlanError, merge_shards, self.args(output_vcf=None))
+    self.assertRaises(ShardPlanError, run_shard, self.args(index=3))
+
+    annotated_vcfs = []
+    def counted_annotated_lines(java_exec, snpeff_exec, vcf_filename, *args, **kwargs):
+      annotated_vcfs.append(vcf_filename)
+      yield from fake_annotated_lines(java_exec, snpeff_exec, vcf_filename, *args, **kwargs)
+    with patch('snpEffWrapper.wrapper._snpeff_annotated_lines', counted_annotated_lines):
+      for index in [0, 1, 2, 1]:
+        run_shard(self.args(index=index))
+      self.assertEqual(len(annotated_vcfs), 3) # Shard 1 was already done
+      self.assertEqual(build_mock.call_count, 1) # Every shard used the plan's database
+
+      shard_plan = ShardPlan.load(self.work_dir)
+      with open(shard_plan.output_filename(2), 'a') as output_file:
+        output_file.write("CHROM1\t160\t.\tC\tA\t.\t.\t.\tGT\t1\n")
+      self.assertIsNone(shard_plan.done(2))
+      run_shard(self.args(index=2))
+      self.assertEqual(len(annotated_vcfs), 4)
+
+    metrics = merge_shards(self.args(output_vcf=open(output_filename, 'w'),
+                                     summary_file=summary_filename))
+    self.assertEqual(metrics.counts['output_records'], 5)
+    with open(output_filename, 'r') as output_file:
+      lines = output_file.readlines()
+    self.assertEqual(len([line for line in lines if line[0] == '#']), 2)
+    self.assertEqual([line.split('\t')[1] for line in lines if line[0] != '#'],
+                     ['110', '120', '130', '140', '150'])
+    with open(summary_filename, 'r') as summary_file:
+      self.assertEqual(json.load(summary_file)['records'], 5)
+
+  def test_merge_annotation_errors(self, build_mock):
+    vcf_filename = self.write_vcf([110, 160, 170])
+    self.plan(vcf_filename, shard_records=2)
+    for index in range(2):
+      run_shard(self.args(index=index))
+    shard_plan = ShardPlan.load(self.work_dir)
+    self.assertEqual(shard_plan.done(1)['errors'],
+                     {'ERROR_OUT_OF_CHROMOSOME_RANGE': 1})
+    output_filename = os.path.join(self.working_dir, 'output.vcf')
+    with self.assertRaises(AnnotationError):
+      merge_shards(self.args(output_vcf=open(output_filename, 'w')))
+    self.assertEqual(os.path.getsize(output_filename), 0)
+
+if __name__ == '__main__':
+  unittest.main()
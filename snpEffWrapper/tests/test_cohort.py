@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from io import StringIO
+
+from snpEffWrapper.cohort import *
+
+HEADER = ("##fileformat=VCFv4.1\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n")
+
+class TestCohort(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_cohort_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def write(self, name, content):
+    filename = os.path.join(self.working_dir, name)
+    with open(filename, 'w') as output_file:
+      output_file.write(content)
+    return filename
+
+  def test_collect_sites(self):
+    vcf_filenames = [
+      self.write('a.vcf', HEADER +
+                 "PLASMID1\t20\t.\tC\tA\t.\t.\t.\tGT\t1\n"
+                 "CHROM1\t100\t.\tC\tA\t.\t.\t.\tGT\t1\n"),
+      self.write('b.vcf', HEADER +
+                 "CHROM1\t100\t.\tC\tA\t.\t.\tDP=3\tGT\t1\n"
+                 "CHROM1\t100\t.\tC\tT\t.\t.\t.\tGT\t1\n"
+                 "CHROM1\t9\t.\tG\tA,T\t.\t.\t.\tGT\t1\n")
+    ]
+    record_counts = []
+    sites = collect_sites(vcf_filenames, record_counts)
+    self.assertEqual(record_counts, [2, 3])
+    self.assertEqual(list(sites), ['PLASMID1', 'CHROM1'])
+    sites_filename = os.path.join(self.working_dir, 'sites.vcf')
+    self.assertEqual(write_sites_vcf(sites, sites_filename), 4)
+    with open(sites_filename, 'r') as sites_file:
+      self.assertEqual([line.split('\t')[:5] for line in sites_file
+                        if line[0] != '#'],
+                       [['PLASMID1', '20', '.', 'C', 'A'],
+                        ['CHROM1', '9', '.', 'G', 'A,T'],
+                        ['CHROM1', '100', '.', 'C', 'A'],
+                        ['CHROM1', '100', '.', 'C', 'T']])
+
+  def test_joined_vcf_lines(self):
+    annotated_sites_filename = self.write('sites.annotated.vcf',
+      "##fileformat=VCFv4.1\n"
+      "##SnpEffVersion=\"4.1l\"\n"
+      "##INFO=<ID=ANN,Number=.,Type=String,Description=\"Functional annotations\">\n"
+      "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+      "CHROM1\t100\t.\tC\tA\t.\t.\tANN=A|missense_variant\n"
+      "CHROM1\t100\t.\tC\tT\t.\t.\tANN=T|synonymous_variant\n")
+    vcf_file = StringIO(HEADER +
+                        "CHROM1\t100\t.\tC\tT\t.\t.\tDP=3\tGT\t1\n"
+                        "CHROM1\t100\t.\tC\tA\t.\t.\t.\n"
+                        "CHROM1\t200\t.\tC\tA\t.\t.\t.\tGT\t1\n")
+    with SiteAnnotations(annotated_sites_filename) as site_annotations:
+      self.assertEqual(len(site_annotations.offsets), 2)
+      self.assertEqual(''.join(joined_vcf_lines(vcf_file, site_annotations)),
+                       "##fileformat=VCFv4.1\n"
+                       "##SnpEffVersion=\"4.1l\"\n"
+                       "##INFO=<ID=ANN,Number=.,Type=String,Description=\"Functional annotations\">\n"
+                       "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n"
+                       "CHROM1\t100\t.\tC\tT\t.\t.\tDP=3;ANN=T|synonymous_variant\tGT\t1\n"
+                       "CHROM1\t100\t.\tC\tA\t.\t.\tANN=A|missense_variant\n"
+                       "CHROM1\t200\t.\tC\tA\t.\t.\t.\tGT\t1\n")
+
+    self.assertIs(get_site_annotations(annotated_sites_filename),
+                  get_site_annotations(annotated_sites_filename))
+    forget_site_annotations(annotated_sites_filename)
+
+if __name__ == '__main__':
+  unittest.main()
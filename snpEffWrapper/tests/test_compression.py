@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from snpEffWrapper.compression import *
+
+def read_bgzf_blocks(filename):
+  """Splits a BGZF file into (offset, uncompressed data) for each block"""
+  blocks = []
+  with open(filename, 'rb') as input_file:
+    data = input_file.read()
+  offset = 0
+  while offset < len(data):
+    block_size = struct.unpack('<H', data[offset+16:offset+18])[0] + 1
+    blocks.append((offset, zlib.decompress(data[offset+18:offset+block_size-8], -15)))
+    offset += block_size
+  return blocks
+
+class TestCompression(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_compression_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def vcf_lines(self):
+    lines = ["##fileformat=VCFv4.1\n",
+             "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+    for contig in ['CHROM1', 'CHROM2']:
+      for position in range(1, 200000, 7):
+        lines.append("%s\t%s\t.\tCA\tA\t.\t.\tANN=A|%s\n" % (contig, position,
+                                                           'x' * (position % 13)))
+    return lines
+
+  def test_bgzf_writer(self):
+    output_filename = os.path.join(self.working_dir, 'output.vcf.gz')
+    lines = self.vcf_lines()
+    with BgzfWriter(open(output_filename, 'wb'), threads=3) as writer:
+      writer.writelines(lines)
+    with gzip.open(output_filename, 'rt') as output_file:
+      self.assertEqual(output_file.read(), ''.join(lines))
+    blocks = read_bgzf_blocks(output_filename)
+    self.assertGreater(len(blocks), 10)
+    self.assertTrue(all(len(data) == BGZF_BLOCK_SIZE for offset, data in blocks[:-2]))
+    self.assertEqual(blocks[-1][1], b'')
+    self.assertTrue(is_gzipped(output_filename))
+    self.assertEqual(uncompressed_size(output_filename),
+                     len(''.join(lines).encode('utf-8')))
+    with open_text(output_filename) as output_file:
+      self.assertEqual(output_file.readline(), lines[0])
+
+  def test_uncompressed_size(self):
+    plain_filename = os.path.join(self.working_dir, 'plain.vcf')
+    with open(plain_filename, 'w') as plain_file:
+      plain_file.writelines(self.vcf_lines())
+    gzip_filename = os.path.join(self.working_dir, 'plain.vcf.gz')
+    with open(plain_filename, 'rb') as plain_file, \
+         gzip.open(gzip_filename, 'wb') as gzip_file:
+      shutil.copyfileobj(plain_file, gzip_file)
+    self.assertFalse(is_gzipped(plain_filename))
+    self.assertEqual(uncompressed_size(gzip_filename),
+                     os.path.getsize(plain_filename))
+    copy_filename = os.path.join(self.working_dir, 'copy.vcf')
+    copy_decompressed(gzip_filename, copy_filename)
+    with open(copy_filename, 'r') as copy_file, open(plain_filename, 'r') as plain_file:
+      self.assertEqual(copy_file.read(), plain_file.read())
+
+    with open(gzip_filename, 'r') as text_file:
+      with reopen_text(text_file) as reopened_file:
+        self.assertEqual(reopened_file.readline(), "##fileformat=VCFv4.1\n")
+      self.assertTrue(text_file.closed)
+
+  def test_filenames(self):
+    self.assertTrue(is_compressed_filename('foo.vcf.gz'))
+    self.assertTrue(is_compressed_filename('foo.vcf.bgz'))
+    self.assertFalse(is_compressed_filename('foo.vcf'))
+    self.assertEqual(strip_compression_extension('foo.vcf.bgz'), 'foo.vcf')
+    self.assertEqual(strip_compression_extension('foo.vcf'), 'foo.vcf')
+
+  def test_tabix_index(self):
+    output_filename = os.path.join(self.working_dir, 'output.vcf.gz')
+    lines = self.vcf_lines()
+    with BgzfWriter(open(output_filename, 'wb'), threads=2, index=True) as writer:
+      for line in lines:
+        writer.write(line)
+    self.assertTrue(writer.write_index(output_filename + '.tbi'))
+
+    with gzip.open(output_filename + '.tbi', 'rb') as index_file:
+      index = index_file.read()
+    self.assertEqual(index[:4], b'TBI\1')
+    n_ref, preset, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack('<8i', index[4:36])
+    self.assertEqual((n_ref, preset, col_seq, col_beg, col_end, chr(meta)),
+                     (2, 2, 1, 2, 0, '#'))
+    self.assertEqual(index[36:36+l_nm], b'CHROM1\0CHROM2\0')
+
+    # Every interval of the linear index of CHROM1 should point at the first
+    # record which overlaps it
+    blocks = dict(read_bgzf_blocks(output_filename))
+    offset = 36 + l_nm
+    n_bin = struct.unpack('<i', index[offset:offset+4])[0]
+    offset += 4
+    for _ in range(n_bin):
+      bin_number, n_chunk = struct.unpack('<Ii', index[offset:offset+8])
+      offset += 8 + 16 * n_chunk
+    n_intv = struct.unpack('<i', index[offset:offset+4])[0]
+    offsets = struct.unpack('<%sQ' % n_intv, index[offset+4:offset+4+8*n_intv])
+    self.assertEqual(n_intv, (199999 >> 14) + 1)
+    for window, virtual_offset in enumerate(offsets):
+      data = blocks[virtual_offset >> 16][virtual_offset & 0xffff:]
+      record = data.split(b'\n', 1)[0].split(b'\t')
+      self.assertEqual(record[0], b'CHROM1')
+      position = int(record[1])
+      self.assertGreaterEqual(position + 1, window << 14)
+      self.assertLess(position - 7, window << 14)
+
+  def test_unsorted_vcf(self):
+    output_filename = os.path.join(self.working_dir, 'output.vcf.gz')
+    with BgzfWriter(open(output_filename, 'wb'), index=True) as writer:
+      writer.write("CHROM1\t20\t.\tC\tA\t.\t.\t.\n")
+      writer.write("CHROM1\t10\t.\tC\tA\t.\t.\t.\n")
+    self.assertFalse(writer.write_index(output_filename + '.tbi'))
+    self.assertFalse(os.path.exists(output_filename + '.tbi'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import Counter
+from unittest.mock import patch
+
+from snpEffWrapper.contigs import *
+
+class TestContigs(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_contigs_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def test_read_contig_aliases(self):
+    alias_filename = os.path.join(self.working_dir, 'aliases.tsv')
+    with open(alias_filename, 'w') as alias_file:
+      alias_file.write("# VCF\tGFF\n1\tNC_000001.11\n\nMT  NC_012920.1\n")
+    self.assertEqual(read_contig_aliases(alias_filename),
+                     {'1': 'NC_000001.11', 'MT': 'NC_012920.1'})
+    with open(alias_filename, 'a') as alias_file:
+      alias_file.write("2\n")
+    self.assertRaises(ContigAliasError, read_contig_aliases, alias_filename)
+
+  def test_parse_alias_rules(self):
+    self.assertEqual(parse_alias_rules(None), [])
+    self.assertEqual(parse_alias_rules('chr, version'), ['chr', 'version'])
+    self.assertEqual(parse_alias_rules(['version']), ['version'])
+    self.assertRaises(ContigAliasError, parse_alias_rules, 'chr,prefix')
+
+  @patch('snpEffWrapper.contigs.logger')
+  def test_reconcile_contigs(self, logger_mock):
+    gff_contigs = ['1', '2', 'NC_012920.1', 'scaffold_9']
+    vcf_contigs = ['1', 'chr1', 'chr2', 'MT', 'NC_012920', 'chrX']
+    aliases = ContigAliases({'MT': 'NC_012920.1'}, ['chr', 'version'])
+    reconciliation = ContigReconciliation(vcf_contigs, gff_contigs, aliases,
+                                          Counter({'1': 3, 'chr2': 1}))
+    self.assertEqual(dict(reconciliation.gff_names),
+                     {'1': '1', 'chr2': '2', 'MT': 'NC_012920.1'})
+    # chr1 and NC_012920 would use GFF contigs which are already used
+    self.assertEqual(reconciliation.missing, ['chr1', 'NC_012920', 'chrX'])
+    self.assertEqual(logger_mock.warn.call_count, 2)
+    self.assertEqual(reconciliation.unused, ['scaffold_9'])
+    self.assertEqual(reconciliation.renames, {'2': 'chr2', 'NC_012920.1': 'MT'})
+
+    report_filename = os.path.join(self.working_dir, 'report.tsv')
+    reconciliation.write(report_filename)
+    with open(report_filename, 'r') as report_file:
+      self.assertEqual(report_file.read(),
+                       REPORT_HEADER +
+                       "1\t1\tmatched\t3\n"
+                       "chr1\t\tmissing\t0\n"
+                       "chr2\t2\taliased\t1\n"
+                       "MT\tNC_012920.1\taliased\t0\n"
+                       "NC_012920\t\tmissing\t0\n"
+                       "chrX\t\tmissing\t0\n"
+                       "\tscaffold_9\tunused\t\n")
+
+    # Without rules, only exact names and the explicit aliases match
+    reconciliation = ContigReconciliation(vcf_contigs, gff_contigs,
+                                          ContigAliases({'MT': 'NC_012920.1'}))
+    self.assertEqual(list(reconciliation.gff_names), ['1', 'MT'])
+
+  def test_ambiguous_rules(self):
+    aliases = ContigAliases(rules=['version'])
+    reconciliation = ContigReconciliation(['NC_1'], ['NC_1.1', 'NC_1.2'], aliases)
+    self.assertEqual(reconciliation.missing, ['NC_1'])
+
+if __name__ == '__main__':
+  unittest.main()
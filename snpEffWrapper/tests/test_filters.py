@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.filters import *
+
+MISSENSE = 'A|missense_variant|MODERATE|fooA|GENE_0001|transcript|T1|protein_coding'
+STOP = 'A|stop_gained&splice_region_variant|HIGH|fooB|GENE_0002|transcript|T2|protein_coding'
+UPSTREAM = 'A|upstream_gene_variant|MODIFIER|fooC|GENE_0003|transcript|T3|protein_coding'
+
+def record(*annotations, samples=True):
+  info = 'DP=10;ANN=%s' % ','.join(annotations) if annotations else 'DP=10'
+  if samples:
+    return "CHROM1\t100\t.\tC\tA\t.\t.\t%s\tGT\t1\n" % info
+  return "CHROM1\t100\t.\tC\tA\t.\t.\t%s\n" % info
+
+class TestFilters(unittest.TestCase):
+  def test_parse_impacts(self):
+    self.assertEqual(parse_impacts('high, Moderate'), ['HIGH', 'MODERATE'])
+    self.assertEqual(parse_impacts(['LOW']), ['LOW'])
+    self.assertIsNone(parse_impacts(None))
+    self.assertRaises(FilterError, parse_impacts, 'HIGH,SEVERE')
+    self.assertRaises(FilterError, parse_impacts, ',')
+    self.assertEqual(parse_effect_terms('missense_variant,stop_gained'),
+                     ['missense_variant', 'stop_gained'])
+    self.assertRaises(FilterError, parse_effect_terms, '')
+
+  def test_filter_line(self):
+    record_filter = AnnotationFilter(impacts='HIGH,MODERATE')
+    self.assertEqual(record_filter.filter_line("##fileformat=VCFv4.1\n"),
+                     "##fileformat=VCFv4.1\n")
+    self.assertEqual(record_filter.filter_line("#CHROM\tPOS\n"),
+                     '##snpEffWrapperFilter="impacts=HIGH,MODERATE"\n#CHROM\tPOS\n')
+    line = record(UPSTREAM, MISSENSE)
+    self.assertEqual(record_filter.filter_line(line), line)
+    self.assertIsNone(record_filter.filter_line(record(UPSTREAM)))
+    self.assertIsNone(record_filter.filter_line(record()))
+    self.assertEqual((record_filter.kept, record_filter.removed), (1, 2))
+
+    record_filter = AnnotationFilter(effects=['stop_gained'])
+    self.assertIsNotNone(record_filter.filter_line(record(STOP)))
+    self.assertIsNone(record_filter.filter_line(record(MISSENSE, UPSTREAM)))
+
+    record_filter = AnnotationFilter(impacts=['MODERATE'], genes=['GENE_0002', 'fooA'])
+    self.assertIsNotNone(record_filter.filter_line(record(MISSENSE)))
+    self.assertIsNone(record_filter.filter_line(record(STOP, UPSTREAM)))
+
+  def test_only_matching_annotations(self):
+    record_filter = AnnotationFilter(impacts=['HIGH', 'MODERATE'], prune=True)
+    self.assertEqual(record_filter.filter_line(record(UPSTREAM, MISSENSE, STOP)),
+                     record(MISSENSE, STOP))
+    self.assertEqual(record_filter.filter_line(record(STOP, UPSTREAM, samples=False)),
+                     record(STOP, samples=False))
+    line = "CHROM1\t100\t.\tC\tA\t.\t.\tANN=%s,%s;DP=10\n" % (UPSTREAM, MISSENSE)
+    self.assertEqual(record_filter.filter_line(line),
+                     "CHROM1\t100\t.\tC\tA\t.\t.\tANN=%s;DP=10\n" % MISSENSE)
+    self.assertEqual(record_filter.header_line(),
+                     '##snpEffWrapperFilter="impacts=HIGH,MODERATE;only_matching_annotations"\n')
+
+  def test_get_annotation_filter(self):
+    self.assertIsNone(get_annotation_filter())
+    self.assertRaises(FilterError, get_annotation_filter, prune=True)
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_filters_',
+                                   dir=os.getcwd())
+    try:
+      gene_filename = os.path.join(working_dir, 'genes.txt')
+      with open(gene_filename, 'w') as gene_file:
+        gene_file.write("# Genes of interest\nfooA\n\nGENE_0003\n")
+      record_filter = get_annotation_filter(gene_filename=gene_filename)
+      self.assertEqual(record_filter.genes, {'fooA', 'GENE_0003'})
+      self.assertEqual(record_filter.describe(), 'genes=2')
+      with open(gene_filename, 'w') as gene_file:
+        gene_file.write("# Nothing\n")
+      self.assertRaises(FilterError, read_gene_list, gene_filename)
+    finally:
+      shutil.rmtree(working_dir)
+
+if __name__ == '__main__':
+  unittest.main()
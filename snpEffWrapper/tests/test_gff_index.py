@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+from snpEffWrapper.gff_index import *
+from snpEffWrapper.gff_index import _index_fasta
+
+GFF_CONTENT = """\
+##gff-version 3
+##sequence-region CHROM1 1 100
+CHROM1\tEMBL\tdatabank_entry\t1\t100\t.\t+\t.\tID=CHROM1.1
+CHROM1\tEMBL\tCDS\t10\t30\t.\t+\t0\tID=CHROM1.2
+PLASMID1\tEMBL\tCDS\t5\t20\t.\t+\t0\tID=PLASMID1.1
+##FASTA
+>CHROM1 the chromosome
+ACGTACGTAC
+GTACGTACGT
+ACG
+>PLASMID1
+TTTTTTTT
+TTTT
+>NO_FEATURES
+GGGGGGGGGG
+"""
+
+class TestGFFIndex(unittest.TestCase):
+  def check_index(self, index, content):
+    self.assertEqual(list(index.feature_counts.items()),
+                     [('CHROM1', 2), ('PLASMID1', 1)])
+    self.assertEqual(index.feature_contigs, ['CHROM1', 'PLASMID1'])
+    self.assertEqual([(record.name, record.length, record.line_bases,
+                       record.line_width)
+                      for record in index.sequences.values()],
+                     [('CHROM1', 23, 10, 11),
+                      ('PLASMID1', 12, 8, 9),
+                      ('NO_FEATURES', 10, 10, 11)])
+    for record, first_bases in zip(index.sequences.values(),
+                                   [b'ACGTACGTAC', b'TTTTTTTT', b'GGGGGGGGGG']):
+      self.assertEqual(content[record.offset:record.offset+record.line_bases],
+                       first_bases)
+
+  def test_build_gff_index(self):
+    content = GFF_CONTENT.encode('utf-8')
+    index = build_gff_index(BytesIO(content))
+    self.check_index(index, content)
+    self.assertEqual(content[index.fasta_offset:index.fasta_offset+7],
+                     b'>CHROM1')
+
+  @patch('snpEffWrapper.gff_index._index_fasta')
+  def test_build_gff_index_small_blocks(self, index_fasta_mock):
+    index_fasta_mock.side_effect = lambda gff_file, start, sequences: _index_fasta(gff_file, start, sequences, block_size=4)
+    content = GFF_CONTENT.encode('utf-8')
+    self.check_index(build_gff_index(BytesIO(content)), content)
+
+  def test_irregular_line_widths(self):
+    content = (b"##FASTA\n"
+               b">REGULAR\nACGT\r\nACGT\r\nAC\r\n"
+               b">LONG_LAST_LINE\nACGT\nACGTA\n"
+               b">SHORT_MIDDLE_LINE\nACGT\nAC\nACGT\n"
+               b">SAME_TOTAL\nACG\nACGTA\nACGT\n"
+               b">BLANK_FIRST_LINE\n\nACGT\n"
+               b">NO_NEWLINE\nACGT\nAC")
+    for block_size in [4, 1024]:
+      sequences = OrderedDict()
+      _index_fasta(BytesIO(content), 0, sequences, block_size=block_size)
+      self.assertEqual([(record.name, record.length, record.line_bases,
+                         record.line_width)
+                        for record in sequences.values()],
+                       [('REGULAR', 10, 4, 6),
+                        ('LONG_LAST_LINE', 9, None, None),
+                        ('SHORT_MIDDLE_LINE', 10, None, None),
+                        ('SAME_TOTAL', 12, None, None),
+                        ('BLANK_FIRST_LINE', 4, None, None),
+                        ('NO_NEWLINE', 6, 4, 5)])
+      self.assertEqual([read_sequence(BytesIO(content), record)
+                        for record in sequences.values()],
+                       [b'ACGTACGTAC', b'ACGTACGTA', b'ACGTACACGT',
+                        b'ACGACGTAACGT', b'ACGT', b'ACGTAC'])
+
+  def test_build_gff_index_without_fasta(self):
+    content = GFF_CONTENT.split('##FASTA')[0].encode('utf-8')
+    index = build_gff_index(BytesIO(content))
+    self.assertEqual(index.feature_contigs, ['CHROM1', 'PLASMID1'])
+    self.assertEqual(len(index.sequences), 0)
+    self.assertEqual(index.fasta_offset, None)
+
+  def test_get_gff_index(self):
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_index_',
+                                   dir=os.getcwd())
+    try:
+      gff_filename = os.path.join(working_dir, 'test.gff')
+      with open(gff_filename, 'w') as gff_file:
+        gff_file.write(GFF_CONTENT)
+      content = GFF_CONTENT.encode('utf-8')
+      with open(gff_filename, 'r') as gff_file:
+        self.check_index(get_gff_index(gff_file), content)
+      self.assertTrue(os.path.isfile(gff_filename + '.index.json'))
+      with patch('snpEffWrapper.gff_index.build_gff_index') as build_mock:
+        with open(gff_filename, 'r') as gff_file:
+          self.check_index(get_gff_index(gff_file), content)
+        build_mock.assert_not_called()
+
+      self.check_index(get_gff_index(StringIO(GFF_CONTENT)), content)
+    finally:
+      shutil.rmtree(working_dir)
+
+if __name__ == '__main__':
+  unittest.main()
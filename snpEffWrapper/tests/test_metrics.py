@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from io import StringIO
+from unittest.mock import patch
+
+from snpEffWrapper.metrics import *
+from snpEffWrapper.wrapper import stream_annotated_vcf
+
+class TestMetrics(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_metrics_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def test_run_metrics(self):
+    metrics = RunMetrics()
+    for i in range(2):
+      with metrics.stage('get_vcf_contigs'):
+        pass
+    with self.assertRaises(ValueError):
+      with metrics.stage('check_contigs'):
+        raise ValueError("No common contigs")
+    metrics.add_process('annotate', ProcessUsage(0, 100.5, 1.25, 0.5), 2.0,
+                        'input.vcf')
+    metrics.add_processes([{'stage': 'annotate', 'name': 'shard_1.vcf'}])
+    metrics.count('input_records', 10)
+    metrics.count('input_records', 5)
+    metrics.finish('failed', ValueError("No common contigs"))
+
+    metrics_dict = metrics.to_dict()
+    self.assertEqual(list(metrics_dict['stages']), ['get_vcf_contigs',
+                                                    'check_contigs'])
+    self.assertEqual(metrics_dict['stages']['get_vcf_contigs']['calls'], 2)
+    self.assertEqual(metrics_dict['stages']['check_contigs']['calls'], 1)
+    self.assertEqual(metrics_dict['processes'][0],
+                     {'stage': 'annotate', 'name': 'input.vcf', 'returncode': 0,
+                      'wall_seconds': 2.0, 'peak_rss_mb': 100.5,
+                      'user_seconds': 1.25, 'system_seconds': 0.5})
+    self.assertEqual(len(metrics_dict['processes']), 2)
+    self.assertEqual(metrics_dict['counts'], {'input_records': 15})
+    self.assertEqual(metrics_dict['status'], 'failed')
+    self.assertEqual(metrics_dict['error'], 'ValueError: No common contigs')
+
+    metrics_filename = os.path.join(self.working_dir, 'metrics.json')
+    metrics.write(metrics_filename)
+    self.assertEqual(os.listdir(self.working_dir), ['metrics.json'])
+    with open(metrics_filename, 'r') as metrics_file:
+      self.assertEqual(json.load(metrics_file)['counts'], {'input_records': 15})
+
+  @patch('snpEffWrapper.metrics.logger.info')
+  def test_log(self, info_mock):
+    metrics = RunMetrics()
+    metrics.count('input_records', 3)
+    metrics.log()
+    (message,), _ = info_mock.call_args
+    prefix, metrics_json = message.split(' ', 1)
+    self.assertEqual(prefix, METRICS_LOG_PREFIX)
+    self.assertNotIn('\n', metrics_json)
+    self.assertEqual(json.loads(metrics_json)['counts'], {'input_records': 3})
+
+  def test_wait_for_process(self):
+    process = subprocess.Popen(['sh', '-c', 'exit 3'])
+    usage = wait_for_process(process)
+    self.assertEqual(usage.returncode, 3)
+    self.assertEqual(process.wait(), 3)
+    self.assertGreater(usage.peak_rss_mb, 0)
+    self.assertGreaterEqual(usage.user_seconds, 0)
+
+  def test_progress_reporter(self):
+    progress = ProgressReporter(1000, interval=60, label='input.vcf')
+    progress.records = 250
+    now = progress.start + 10
+    self.assertEqual(progress.describe(now),
+                     "Annotated 250 of 1000 records of input.vcf (25%, 25 records/s, about 30s left)")
+    progress.records = 100
+    self.assertEqual(progress.describe(progress.start + 100),
+                     "Annotated 100 of 1000 records of input.vcf (10%, 1 records/s, about 15m00s left)")
+    progress = ProgressReporter(None, interval=60, label='shard_1.vcf')
+    progress.records = 50
+    self.assertEqual(progress.describe(progress.start + 10),
+                     "Annotated 50 records of shard_1.vcf (5 records/s)")
+
+  @patch('snpEffWrapper.metrics.logger.info')
+  def test_progress_reported_while_streaming(self, info_mock):
+    annotated_vcf = StringIO("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" +
+                             "CHROM1\t110\t.\tC\tA\t.\t.\tANN=A|foo|\n" * 25000)
+    progress = ProgressReporter(25000, interval=60)
+    progress.start -= 120
+    progress.last_report -= 120
+    stream_annotated_vcf(annotated_vcf, StringIO(), progress)
+    self.assertEqual(progress.records, 25000)
+    self.assertEqual(info_mock.call_count, 1) # Only once in each interval
+
+    progress = ProgressReporter(25000, interval=0)
+    progress.start -= 120
+    progress.last_report -= 120
+    annotated_vcf.seek(0)
+    stream_annotated_vcf(annotated_vcf, StringIO(), progress)
+    self.assertEqual(progress.records, 25000)
+    self.assertEqual(info_mock.call_count, 1)
+
+if __name__ == '__main__':
+  unittest.main()
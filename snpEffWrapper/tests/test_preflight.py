@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import Counter
+from io import StringIO
+
+from snpEffWrapper.gff_index import get_gff_index
+from snpEffWrapper.preflight import *
+
+GFF_CONTENT = """\
+##gff-version 3
+CHROM1\tEMBL\tCDS\t10\t30\t.\t+\t0\tID=CHROM1.1
+PLASMID1\tEMBL\tCDS\t5\t20\t.\t+\t0\tID=PLASMID1.1
+NO_SEQUENCE\tEMBL\tCDS\t5\t20\t.\t+\t0\tID=NO_SEQUENCE.1
+##FASTA
+>CHROM1 the chromosome
+ACGTACGTAC
+GTACGTACGT
+ACN
+>PLASMID1
+ttttgggg\r
+cccc\r
+>IRREGULAR lines of different widths
+ACGTACG
+TACGT
+ACGTACGT
+ACG
+"""
+
+class TestPreflight(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_preflight_',
+                                        dir=os.getcwd())
+    self.gff_filename = os.path.join(self.working_dir, 'reference.gff')
+    with open(self.gff_filename, 'w', newline='') as gff_file:
+      gff_file.write(GFF_CONTENT)
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def reference(self, gff_filename):
+    with open(gff_filename, 'r') as gff_file:
+      return ReferenceSequences(gff_filename, get_gff_index(gff_file))
+
+  def check_fetch(self, reference):
+    self.assertEqual(reference.length('CHROM1'), 23)
+    self.assertIsNone(reference.length('NO_SEQUENCE'))
+    self.assertEqual(reference.fetch('CHROM1', 0, 4), 'ACGT')
+    self.assertEqual(reference.fetch('CHROM1', 8, 12), 'ACGT') # Across a line
+    self.assertEqual(reference.fetch('CHROM1', 19, 30), 'TACN')
+    self.assertEqual(reference.fetch('PLASMID1', 6, 10), 'GGCC')
+    self.assertEqual(reference.fetch('PLASMID1', 12, 14), '')
+    self.assertEqual(reference.length('IRREGULAR'), 23)
+    self.assertEqual(reference.fetch('IRREGULAR', 5, 14), 'CGTACGTAC')
+    self.assertEqual(reference.fetch('IRREGULAR', 20, 30), 'ACG')
+
+  def test_fetch(self):
+    with self.reference(self.gff_filename) as reference:
+      self.check_fetch(reference)
+
+  def test_fetch_compressed(self):
+    gzipped_filename = self.gff_filename + '.gz'
+    with open(self.gff_filename, 'rb') as gff_file, gzip.open(gzipped_filename, 'wb') as gzipped_file:
+      gzipped_file.write(gff_file.read())
+    with self.reference(gzipped_filename) as reference:
+      self.check_fetch(reference)
+
+  def test_preflight_errors(self):
+    vcf = StringIO("##fileformat=VCFv4.1\n"
+                   "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                   "CHROM1\t1\t.\tA\tC\t.\t.\t.\n"
+                   "CHROM1\t9\t.\tacgt\tC\t.\t.\t.\n"
+                   "CHROM1\t23\t.\tG\tC\t.\t.\t.\n" # N matches anything
+                   "CHROM1\t2\t.\tG\tC\t.\t.\t.\n"
+                   "CHROM1\t23\t.\tNA\tC\t.\t.\t.\n" # Runs past the end
+                   "CHROM1\t24\t.\tA\tC\t.\t.\t.\n"
+                   "CHROM1\t100\t.\tA\tC\t.\t.\t.\n"
+                   "IRREGULAR\t6\t.\tCGTACG\tC\t.\t.\t.\n"
+                   "plasmid\t5\t.\tG\tC\t.\t.\t.\n"
+                   "NO_SEQUENCE\t5\t.\tG\tC\t.\t.\t.\n"
+                   "UNKNOWN\t5\t.\tG\tC\t.\t.\t.\n")
+    gff_names = {'CHROM1': 'CHROM1', 'plasmid': 'PLASMID1',
+                 'NO_SEQUENCE': 'NO_SEQUENCE', 'IRREGULAR': 'IRREGULAR'}
+    with self.reference(self.gff_filename) as reference:
+      self.assertEqual(preflight_errors(vcf, reference, gff_names),
+                       Counter({'WARNING_REF_DOES_NOT_MATCH_GENOME': 2,
+                                'ERROR_OUT_OF_CHROMOSOME_RANGE': 2,
+                                'WARNING_SEQUENCE_NOT_AVAILABLE': 1}))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import MagicMock
+
+from snpEffWrapper.probes import *
+
+class TestProbeCache(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_probes_',
+                                        dir=os.getcwd())
+    self.executable = os.path.join(self.working_dir, 'java')
+    with open(self.executable, 'w') as executable:
+      print("#!/bin/sh", file=executable)
+      print('echo \'openjdk version "11.0.2" 2019-01-15\' >&2', file=executable)
+    os.chmod(self.executable, 0o755)
+    self.cache_filename = os.path.join(self.working_dir, 'cache', 'probes.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def test_get(self):
+    probe_cache = ProbeCache(self.cache_filename)
+    probe = MagicMock(return_value='1.7.0_21')
+    self.assertEqual(probe_cache.get(self.executable, 'java_version', probe),
+                     '1.7.0_21')
+    self.assertEqual(probe_cache.get(self.executable, 'java_version', probe),
+                     '1.7.0_21')
+    self.assertEqual(ProbeCache(self.cache_filename).get(self.executable,
+                                                         'java_version', probe),
+                     '1.7.0_21')
+    self.assertEqual(probe.call_count, 1)
+
+    other_probe = MagicMock(return_value='4.1l')
+    self.assertEqual(probe_cache.get(self.executable, 'snpeff_version',
+                                     other_probe), '4.1l')
+    self.assertEqual(other_probe.call_count, 1)
+
+    with open(self.executable, 'a') as executable:
+      print("# Upgraded", file=executable)
+    probe.return_value = '1.8.0_212'
+    self.assertEqual(probe_cache.get(self.executable, 'java_version', probe),
+                     '1.8.0_212')
+    self.assertEqual(probe.call_count, 2)
+
+  def test_uncached(self):
+    probe = MagicMock(return_value='1.7.0_21')
+    probe_cache = ProbeCache('')
+    probe_cache.get(self.executable, 'java_version', probe)
+    probe_cache.get(self.executable, 'java_version', probe)
+    self.assertEqual(probe.call_count, 2)
+
+    probe_cache = ProbeCache(self.cache_filename)
+    probe_cache.get('/does/not/exist', 'java_version', probe)
+    self.assertEqual(probe.call_count, 3)
+    self.assertFalse(os.path.exists(self.cache_filename))
+
+  def test_failed_probe_retried(self):
+    probe_cache = ProbeCache(self.cache_filename)
+    probe = MagicMock(return_value=None)
+    self.assertIsNone(probe_cache.get(self.executable, 'java_version', probe))
+    probe.return_value = '1.7.0_21'
+    self.assertEqual(probe_cache.get(self.executable, 'java_version', probe),
+                     '1.7.0_21')
+    self.assertEqual(probe_cache.get(self.executable, 'java_version', probe),
+                     '1.7.0_21')
+    self.assertEqual(probe.call_count, 2)
+
+  def test_java_version(self):
+    probe_cache = ProbeCache(self.cache_filename)
+    self.assertEqual(java_version(self.executable, probe_cache), '11.0.2')
+    self.assertIsNone(java_version('/does/not/exist', probe_cache))
+
+if __name__ == '__main__':
+  unittest.main()
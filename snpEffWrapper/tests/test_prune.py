@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.prune import *
+
+GFF_CONTENT = """\
+##gff-version 3
+##sequence-region CHROM1 1 100000
+##sequence-region PLASMID1 1 23
+CHROM1\tEMBL\tregion\t1\t100000\t.\t+\t.\tID=CHROM1.1
+CHROM1\tEMBL\tgene\t1000\t2000\t.\t+\t.\tID=gene1
+CHROM1\tEMBL\tmRNA\t1000\t2000\t.\t+\t.\tID=mRNA1;Parent=gene1
+CHROM1\tEMBL\tCDS\t1000\t2000\t.\t+\t0\tID=cds1;Parent=mRNA1
+CHROM1\tEMBL\tgene\t30000\t31000\t.\t+\t.\tID=gene2
+CHROM1\tEMBL\tCDS\t30000\t31000\t.\t+\t0\tID=cds2;Parent=gene2
+CHROM1\tEMBL\tgene\t60000\t61000\t.\t+\t.\tID=gene3
+CHROM1\tEMBL\tCDS\t60000\t61000\t.\t+\t0\tID=cds3;Parent=gene3
+CHROM1\tEMBL\tgene\t90000\t91000\t.\t+\t.\tID=gene4
+PLASMID1\tEMBL\tCDS\t5\t20\t.\t+\t0\tID=PLASMID1.1
+##FASTA
+>CHROM1 the chromosome
+ACGTACGTAC
+GTACGTACGT
+ACG
+>PLASMID1
+TTTTTTTT
+TTTTTTTT
+TTTTTTT
+"""
+
+class TestPrune(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_prune_',
+                                        dir=os.getcwd())
+    self.gff_filename = os.path.join(self.working_dir, 'genes.gff')
+    with open(self.gff_filename, 'w') as gff_file:
+      gff_file.write(GFF_CONTENT)
+    self.output_filename = os.path.join(self.working_dir, 'pruned.gff')
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def prune(self, gff_filename, *args, **kwargs):
+    with open(gff_filename, 'r') as gff_file:
+      index = prune_gff(gff_file, self.output_filename, *args, **kwargs)
+    with open(self.output_filename, 'r') as output_file:
+      return index, output_file.read()
+
+  def test_prune_contigs(self):
+    index, pruned = self.prune(self.gff_filename, ['PLASMID1', 'NOT_IN_GFF'])
+    self.assertEqual(pruned,
+                     "##gff-version 3\n"
+                     "##sequence-region PLASMID1 1 23\n"
+                     "PLASMID1\tEMBL\tCDS\t5\t20\t.\t+\t0\tID=PLASMID1.1\n"
+                     "##FASTA\n"
+                     ">PLASMID1\n"
+                     "TTTTTTTT\nTTTTTTTT\nTTTTTTT\n")
+    self.assertEqual(list(index.feature_counts.items()), [('PLASMID1', 1)])
+    self.assertEqual(list(index.sequences), ['PLASMID1'])
+
+    index, pruned = self.prune(self.gff_filename, ['CHROM1', 'PLASMID1'])
+    self.assertEqual(pruned, GFF_CONTENT.replace('>CHROM1 the chromosome',
+                                                 '>CHROM1'))
+
+  def test_prune_gzipped(self):
+    gzipped_filename = "%s.gz" % self.gff_filename
+    with gzip.open(gzipped_filename, 'wt') as gzipped_file:
+      gzipped_file.write(GFF_CONTENT)
+    index, pruned = self.prune(gzipped_filename, ['CHROM1'])
+    self.assertEqual(sum(index.feature_counts.values()), 9)
+    self.assertTrue(pruned.endswith("##FASTA\n>CHROM1\nACGTACGTAC\nGTACGTACGT\nACG\n"))
+
+  def test_prune_irregular_line_widths(self):
+    irregular_fasta = (">CHROM1 the chromosome\nACGTACG\nTACGT\nACGTACGT\nACG\n"
+                       ">PLASMID1\nTTTTTTTT\nTTTTTTTT\nTTTTTTT\n")
+    with open(self.gff_filename, 'w') as gff_file:
+      gff_file.write(GFF_CONTENT.split('>CHROM1')[0] + irregular_fasta)
+    for gff_filename in [self.gff_filename, "%s.gz" % self.gff_filename]:
+      if gff_filename.endswith('.gz'):
+        with open(self.gff_filename, 'rb') as gff_file, gzip.open(gff_filename, 'wb') as gzipped_file:
+          gzipped_file.write(gff_file.read())
+      index, pruned = self.prune(gff_filename, ['CHROM1', 'PLASMID1'])
+      self.assertTrue(pruned.endswith("##FASTA\n>CHROM1\nACGTACG\nTACGT\nACGTACGT\nACG\n"
+                                      ">PLASMID1\nTTTTTTTT\nTTTTTTTT\nTTTTTTT\n"))
+      index, renamed = self.prune(gff_filename, None, renames={'CHROM1': 'chr1'})
+      self.assertTrue(renamed.endswith("##FASTA\n>chr1\nACGTACG\nTACGT\nACGTACGT\nACG\n"
+                                       ">PLASMID1\nTTTTTTTT\nTTTTTTTT\nTTTTTTT\n"))
+
+  def test_prune_distance(self):
+    index, pruned = self.prune(self.gff_filename, ['CHROM1'],
+                               {'CHROM1': [1500, 45000]}, distance=5000)
+    features = [line.split('\t')[8] for line in pruned.splitlines()
+                if line.startswith('CHROM1\t')]
+    # gene1 is near a variant, gene2 and gene3 are either side of the
+    # intergenic variant and gene4 is too far from both
+    self.assertEqual(features, ['ID=CHROM1.1', 'ID=gene1', 'ID=mRNA1;Parent=gene1',
+                                'ID=cds1;Parent=mRNA1',
+                                'ID=gene2', 'ID=cds2;Parent=gene2',
+                                'ID=gene3', 'ID=cds3;Parent=gene3'])
+    self.assertEqual(index.feature_counts['CHROM1'], 8)
+
+    index, pruned = self.prune(self.gff_filename, ['CHROM1'],
+                               {'CHROM1': [1500]}, distance=5000)
+    self.assertNotIn('gene3', pruned)
+    self.assertIn('ID=gene2', pruned) # The next gene downstream
+    self.assertRaises(PruneError, self.prune, self.gff_filename, ['CHROM1'],
+                      {'CHROM1': [1500]}, distance=100)
+
+  def test_rename_contigs(self):
+    index, renamed = self.prune(self.gff_filename, None,
+                                renames={'PLASMID1': 'plasmid_1'})
+    self.assertEqual(renamed, GFF_CONTENT.replace('>CHROM1 the chromosome', '>CHROM1')
+                                         .replace('PLASMID1', 'plasmid_1')
+                                         .replace('ID=plasmid_1.1', 'ID=PLASMID1.1'))
+    self.assertEqual(list(index.feature_counts), ['CHROM1', 'plasmid_1'])
+    self.assertEqual(index.sequences['plasmid_1'].name, 'plasmid_1')
+
+if __name__ == '__main__':
+  unittest.main()
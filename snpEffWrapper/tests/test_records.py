@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from snpEffWrapper.records import *
+
+class TestRecords(unittest.TestCase):
+  def test_parse_effects(self):
+    ann = ("A|missense_variant&splice_region_variant|MODERATE|baz_gene|CHROM1.2|transcript|CHROM1.2|protein_coding|1/1|c.14C>A|p.Pro5His|14/36|14/36|5/11||," +
+           "A|upstream_gene_variant|MODIFIER|qux_gene|CHROM1.3|transcript|CHROM1.3|protein_coding||c.-50C>A|||||50|WARNING_TRANSCRIPT_INCOMPLETE")
+    missense, upstream = parse_effects(ann)
+    self.assertEqual(missense.allele, 'A')
+    self.assertEqual(missense.terms, ['missense_variant', 'splice_region_variant'])
+    self.assertEqual(missense.impact, 'MODERATE')
+    self.assertEqual(missense.gene_name, 'baz_gene')
+    self.assertEqual(missense.hgvs_p, 'p.Pro5His')
+    self.assertEqual(missense.protein_position, '5/11')
+    self.assertEqual(missense.messages, '')
+    self.assertEqual(upstream.distance, '50')
+    self.assertEqual(upstream.messages, 'WARNING_TRANSCRIPT_INCOMPLETE')
+    self.assertFalse(hasattr(missense, '__dict__'))
+
+    (short,) = parse_effects('A|foo|')
+    self.assertEqual(short.terms, ['foo'])
+    self.assertEqual(short.impact, '')
+    self.assertEqual(short.messages, '')
+    self.assertEqual(parse_effects(''), [])
+
+  def test_get_info_value(self):
+    self.assertEqual(get_info_value('DP=10;ANN=A|foo|;AF=0.5', 'ANN'), 'A|foo|')
+    self.assertEqual(get_info_value('ANN=A|foo|', 'ANN'), 'A|foo|')
+    self.assertEqual(get_info_value('DP=10;ANNOTATED=1', 'ANN'), None)
+    self.assertEqual(get_info_value('DB;DP=10', 'DB'), True)
+    self.assertEqual(get_info_value('.', 'ANN'), None)
+
+  def test_annotated_record(self):
+    line = "CHROM1\t110\trs1\tC\tA,T\t50\tPASS\tDP=3;ANN=A|missense_variant|MODERATE|baz_gene\tGT\t1\n"
+    record = AnnotatedRecord(line)
+    self.assertEqual(record.chrom, 'CHROM1')
+    self.assertEqual(record.pos, 110)
+    self.assertEqual(record.id, 'rs1')
+    self.assertEqual(record.alt, ['A', 'T'])
+    self.assertEqual(record.info, 'DP=3;ANN=A|missense_variant|MODERATE|baz_gene')
+    self.assertEqual(record.line, line)
+    (effect,) = record.effects
+    self.assertEqual(effect.gene_name, 'baz_gene')
+    self.assertIs(record.effects[0], effect) # Only parsed once
+
+    self.assertEqual(AnnotatedRecord("CHROM1\t110\t.\tC\tA\t.\t.\t.\n").effects, [])
+    self.assertRaises(ValueError, AnnotatedRecord, "CHROM1\t110\n")
+
+if __name__ == '__main__':
+  unittest.main()
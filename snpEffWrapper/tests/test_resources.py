@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import OrderedDict
+from unittest.mock import patch
+
+from snpEffWrapper.gff_index import FastaRecord, GFFIndex
+from snpEffWrapper.resources import *
+
+class TestResources(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_resources_',
+                                        dir=os.getcwd())
+    self.history_filename = os.path.join(self.working_dir, 'history.jsonl')
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def gff_index(self, features, bases):
+    return GFFIndex(OrderedDict([('CHROM1', features)]),
+                    OrderedDict([('CHROM1', FastaRecord('CHROM1', bases, 100,
+                                                        60, 61))]),
+                    90)
+
+  def test_parse_heap_size(self):
+    self.assertEqual(parse_heap_size('512m'), 512)
+    self.assertEqual(parse_heap_size('512'), 512)
+    self.assertEqual(parse_heap_size('4g'), 4096)
+    self.assertEqual(parse_heap_size('1.5G'), 1536)
+    self.assertRaises(ResourcePlanError, parse_heap_size, 'lots')
+
+  def test_plan_resources(self):
+    bacterium = plan_resources(self.gff_index(5000, 5 * 1024**2),
+                               6 * 1024**2, 1024**2)
+    self.assertEqual(bacterium.build.heap_mb, MIN_HEAP_MB)
+    self.assertEqual(bacterium.annotate.heap_mb, MIN_HEAP_MB)
+    self.assertEqual(bacterium.build.gc, 'serial')
+    self.assertEqual(bacterium.annotate.options(),
+                     ['-Xmx512m', '-XX:-UsePerfData', '-XX:+UseSerialGC'])
+    self.assertEqual(bacterium.annotate.inputs,
+                     {'gff_bytes': 6 * 1024**2, 'features': 5000,
+                      'bases': 5 * 1024**2, 'vcf_bytes': 1024**2})
+
+    with patch('snpEffWrapper.resources.multiprocessing.cpu_count',
+               return_value=16):
+      eukaryote = plan_resources(self.gff_index(2000000, 3000 * 1024**2),
+                                 4000 * 1024**2, 1024**3, concurrent_jvms=4)
+    self.assertGreater(eukaryote.build.heap_mb, 4096)
+    self.assertGreater(eukaryote.build.heap_mb, eukaryote.annotate.heap_mb)
+    self.assertEqual(eukaryote.peak_heap_mb(), eukaryote.build.heap_mb)
+    self.assertEqual(eukaryote.build.gc_threads, 8)
+    self.assertEqual(eukaryote.annotate.gc_threads, 4)
+    self.assertIn('-XX:+UseParallelGC', eukaryote.annotate.options())
+    self.assertIn('-XX:ParallelGCThreads=4', eukaryote.annotate.options())
+
+    overridden = plan_resources(self.gff_index(5000, 5 * 1024**2),
+                                6 * 1024**2, 1024**2, build_heap_mb=3000,
+                                gc='g1', java_options='-Dfoo=bar -XX:+Baz')
+    self.assertEqual(overridden.build.heap_mb, 3000)
+    self.assertEqual(overridden.annotate.heap_mb, MIN_HEAP_MB)
+    self.assertEqual(overridden.build.options()[-2:], ['-Dfoo=bar', '-XX:+Baz'])
+    self.assertIn('-XX:+UseG1GC', overridden.annotate.options())
+
+  def test_history(self):
+    gff_index = self.gff_index(500000, 1000 * 1024**2)
+    plan = plan_resources(gff_index, 1100 * 1024**2, 1024**2,
+                          history_filename=self.history_filename)
+    planned_heap_mb = plan.annotate.heap_mb
+    plan.annotate.record(planned_heap_mb / 10.0, 12.5, 0)
+    plan.build.record(plan.build.heap_mb, 60, 1)
+    with open(self.history_filename, 'r') as history_file:
+      runs = [json.loads(line) for line in history_file]
+    self.assertEqual([run['stage'] for run in runs], ['annotate', 'build'])
+    self.assertEqual(runs[0]['seconds'], 12.5)
+    self.assertEqual(runs[0]['inputs']['features'], 500000)
+
+    replanned = plan_resources(gff_index, 1100 * 1024**2, 1024**2,
+                               history_filename=self.history_filename)
+    self.assertLess(replanned.annotate.heap_mb, planned_heap_mb)
+    self.assertGreaterEqual(replanned.build.heap_mb, 2 * plan.build.heap_mb)
+
+  def test_trim_history(self):
+    with open(self.history_filename, 'w') as history_file:
+      for i in range(MAX_HISTORY_LINES + 1):
+        print(json.dumps({'stage': 'build', 'run': i}), file=history_file)
+      print('{"stage": "bui', file=history_file)
+    runs = load_history(self.history_filename)
+    self.assertEqual(len(runs), MAX_HISTORY_LINES // 2 - 1)
+    self.assertEqual(runs[-1]['run'], MAX_HISTORY_LINES)
+    self.assertEqual(len(load_history(self.history_filename)), len(runs))
+    self.assertEqual(load_history(''), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from snpEffWrapper.scratch import *
+
+class TestScratch(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_scratch_',
+                                        dir=os.getcwd())
+    self.source = os.path.join(self.working_dir, 'source.gff')
+    with open(self.source, 'w') as source_file:
+      source_file.write("##gff-version 3\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def staged_content(self, destination):
+    with open(destination, 'r') as staged_file:
+      return staged_file.read()
+
+  def test_stage_file(self):
+    destination = os.path.join(self.working_dir, 'hardlinked.gff')
+    self.assertEqual(stage_file(self.source, destination), 'hardlink')
+    self.assertEqual(os.stat(destination).st_ino, os.stat(self.source).st_ino)
+
+    destination = os.path.join(self.working_dir, 'symlinked.gff')
+    with patch('snpEffWrapper.scratch.os.link', side_effect=OSError("EXDEV")):
+      self.assertEqual(stage_file(self.source, destination), 'symlink')
+    self.assertTrue(os.path.islink(destination))
+    self.assertEqual(self.staged_content(destination), "##gff-version 3\n")
+
+    destination = os.path.join(self.working_dir, 'copied.gff')
+    with patch('snpEffWrapper.scratch.os.link', side_effect=OSError("EXDEV")), \
+         patch('snpEffWrapper.scratch.os.symlink', side_effect=OSError("EPERM")):
+      self.assertEqual(stage_file(self.source, destination), 'copy')
+    self.assertFalse(os.path.islink(destination))
+    self.assertEqual(self.staged_content(destination), "##gff-version 3\n")
+
+    compressed_source = os.path.join(self.working_dir, 'source.gff.gz')
+    with gzip.open(compressed_source, 'wt') as compressed_file:
+      compressed_file.write("##gff-version 3\n")
+    destination = os.path.join(self.working_dir, 'decompressed.gff')
+    self.assertEqual(stage_file(compressed_source, destination), 'decompressed')
+    self.assertEqual(self.staged_content(destination), "##gff-version 3\n")
+
+  def test_sweep_stale_temp_dirs(self):
+    scratch_dir = os.path.join(self.working_dir, 'scratch')
+    ours = make_temp_dir(scratch_dir)
+    with open(os.path.join(ours, OWNER_FILENAME), 'r') as owner_file:
+      self.assertEqual(json.load(owner_file)['pid'], os.getpid())
+
+    finished = subprocess.Popen(['true'])
+    finished.wait()
+    with patch('snpEffWrapper.scratch.os.getpid', return_value=finished.pid):
+      abandoned = make_temp_dir(scratch_dir)
+      kept = make_temp_dir(scratch_dir)
+    keep_temp_dir(kept)
+    not_ours = os.path.join(scratch_dir, TEMP_DIR_PREFIX + 'old')
+    os.makedirs(not_ours)
+
+    sweep_stale_temp_dirs(scratch_dir)
+    self.assertTrue(os.path.isdir(ours))
+    self.assertFalse(os.path.exists(abandoned))
+    self.assertTrue(os.path.isdir(kept))
+    self.assertTrue(os.path.isdir(not_ours))
+
+if __name__ == '__main__':
+  unittest.main()
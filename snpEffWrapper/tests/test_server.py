@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import patch
+
+from snpEffWrapper.server import *
+
+class TestJobScheduler(unittest.TestCase):
+  def blocking_jobs(self):
+    started = []
+    release = threading.Event()
+    def run_job(spec):
+      started.append(spec['vcf_file'])
+      release.wait(5)
+      if spec['vcf_file'] == '/bad.vcf':
+        raise ValueError("Broken VCF")
+    return run_job, started, release
+
+  def job(self, name):
+    return {'gff_file': '/ref.gff', 'vcf_file': name, 'output_vcf': '/out.vcf'}
+
+  def test_memory_budget(self):
+    run_job, started, release = self.blocking_jobs()
+    scheduler = JobScheduler(run_job, memory_budget=8, job_memory=4)
+    job_ids = [scheduler.submit(self.job('/%s.vcf' % i)) for i in range(3)]
+    while len(started) < 2:
+      threading.Event().wait(0.01)
+    stats = scheduler.stats()
+    self.assertEqual(stats['running'], 2)
+    self.assertEqual(stats['queue_depth'], 1)
+    self.assertEqual(stats['memory_in_use'], 8)
+    self.assertEqual(scheduler.status(job_ids[2])['state'], 'queued')
+
+    release.set()
+    for job_id in job_ids:
+      self.assertEqual(scheduler.wait(job_id)['state'], 'succeeded')
+    stats = scheduler.stats()
+    self.assertEqual(stats['succeeded'], 3)
+    self.assertEqual(stats['memory_in_use'], 0)
+    self.assertEqual(started, ['/0.vcf', '/1.vcf', '/2.vcf'])
+    scheduler.stop()
+
+  def test_job_bigger_than_budget(self):
+    run_job, started, release = self.blocking_jobs()
+    release.set()
+    scheduler = JobScheduler(run_job, memory_budget=2, job_memory=4)
+    job_id = scheduler.submit(self.job('/0.vcf'))
+    self.assertEqual(scheduler.wait(job_id)['state'], 'succeeded')
+    scheduler.stop()
+
+  def test_job_memory(self):
+    run_job, started, release = self.blocking_jobs()
+    scheduler = JobScheduler(run_job, memory_budget=8, job_memory=4)
+    job_ids = [scheduler.submit(self.job('/0.vcf'), memory=6),
+               scheduler.submit(self.job('/1.vcf'), memory=2),
+               scheduler.submit(self.job('/2.vcf'), memory=1)]
+    while len(started) < 2:
+      threading.Event().wait(0.01)
+    stats = scheduler.stats()
+    self.assertEqual(stats['memory_in_use'], 8)
+    self.assertEqual(stats['queue_depth'], 1)
+    release.set()
+    for job_id in job_ids:
+      self.assertEqual(scheduler.wait(job_id)['state'], 'succeeded')
+    scheduler.stop()
+
+  def test_failed_job(self):
+    run_job, started, release = self.blocking_jobs()
+    release.set()
+    scheduler = JobScheduler(run_job, memory_budget=8, job_memory=4)
+    job_id = scheduler.submit(self.job('/bad.vcf'))
+    status = scheduler.wait(job_id)
+    self.assertEqual(status['state'], 'failed')
+    self.assertEqual(status['error'], 'ValueError: Broken VCF')
+    self.assertRaises(ServerError, scheduler.status, job_id + 1)
+    scheduler.stop()
+
+class TestAnnotationServer(unittest.TestCase):
+  def setUp(self):
+    # Unix socket paths have to be short
+    self.socket_dir = tempfile.mkdtemp(prefix='snpEffWrapper_server_')
+    self.socket_path = os.path.join(self.socket_dir, 'server.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.socket_dir)
+
+  def start_server(self):
+    server_args = argparse.Namespace(java_exec='java', snpeff_exec='snpEff.jar',
+                                     cache_dir=self.socket_dir,
+                                     cache_max_size=None, build_heap=None,
+                                     annotate_heap=1024, java_gc=None,
+                                     java_options=None, debug=False,
+                                     keep=False, progress_interval=0)
+    server = AnnotationServer(self.socket_path, server_args, 8 * 1024**3)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+  def stop_server(self, server):
+    server.shutdown()
+    server.server_close()
+
+  @patch.dict('os.environ', {'SNPEFF_WRAPPER_RESOURCE_HISTORY': ''})
+  @patch('snpEffWrapper.server.annotate_vcf')
+  def test_submit_and_wait(self, annotate_mock):
+    def fake_annotate(args):
+      self.assertEqual(args.coding_table, 'default: Standard')
+      self.assertEqual(args.cache_dir, self.socket_dir)
+      self.assertEqual(args.threads, 1)
+      with args.output_vcf as output_file:
+        output_file.write(args.vcf_file.read())
+    annotate_mock.side_effect = fake_annotate
+
+    self.assertFalse(server_running(self.socket_path))
+    server = self.start_server()
+    try:
+      self.assertTrue(server_running(self.socket_path))
+      self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+      self.assertRaises(ServerError, AnnotationServer, self.socket_path,
+                        server.server_args, 1)
+      vcf_filename = os.path.join(self.socket_dir, 'input.vcf')
+      with open(vcf_filename, 'w') as vcf_file:
+        vcf_file.write("##fileformat=VCFv4.1\n")
+      output_filename = os.path.join(self.socket_dir, 'output.vcf')
+      status = submit_and_wait(self.socket_path, vcf_filename, vcf_filename,
+                               output_filename, 'default: Standard')
+      self.assertEqual(status['state'], 'succeeded')
+      with open(output_filename, 'r') as output_file:
+        self.assertEqual(output_file.read(), "##fileformat=VCFv4.1\n")
+
+      self.assertEqual(status['memory'], 1024**3)
+      stats = send_request(self.socket_path, {'command': 'stats'})
+      self.assertEqual(stats['queue_depth'], 0)
+      self.assertEqual(stats['succeeded'], 1)
+
+      self.assertRaises(ServerError, send_request, self.socket_path,
+                        {'command': 'explode'})
+      self.assertRaises(ServerError, send_request, self.socket_path,
+                        {'command': 'submit', 'job': ['not', 'a', 'job']})
+      self.assertTrue(server_running(self.socket_path))
+      self.assertRaises(ServerError, send_request, self.socket_path,
+                        {'command': 'submit',
+                         'job': {'gff_file': 'relative.gff',
+                                 'vcf_file': vcf_filename,
+                                 'output_vcf': output_filename}})
+      self.assertRaises(ServerError, submit_and_wait, self.socket_path,
+                        vcf_filename, os.path.join(self.socket_dir, 'missing.vcf'),
+                        output_filename, 'default: Standard')
+    finally:
+      self.stop_server(server)
+    self.assertFalse(os.path.exists(self.socket_path))
+
+  def test_stale_socket(self):
+    with open(self.socket_path, 'w'):
+      pass
+    server = self.start_server()
+    try:
+      self.assertTrue(server_running(self.socket_path))
+    finally:
+      self.stop_server(server)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.shards import *
+
+class TestShards(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_shards_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def write_vcf(self, records):
+    vcf_filename = os.path.join(self.working_dir, 'input.vcf')
+    with open(vcf_filename, 'w') as vcf_file:
+      vcf_file.write("##fileformat=VCFv4.1\n")
+      vcf_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+      for contig, position in records:
+        vcf_file.write("%s\t%s\t.\tC\tA\t.\t.\t.\n" % (contig, position))
+    return open(vcf_filename, 'r')
+
+  def records(self, vcf_filename):
+    with open(vcf_filename, 'r') as vcf_file:
+      return [line for line in vcf_file if line[0] != '#']
+
+  def test_split_vcf_between_contigs(self):
+    vcf_file = self.write_vcf([('CHROM1', i) for i in range(10, 20)] +
+                              [('PLASMID1', i) for i in range(10, 20)])
+    shard_filenames = split_vcf(vcf_file, self.working_dir, 2)
+    vcf_file.close()
+    self.assertEqual(len(shard_filenames), 2)
+    self.assertEqual({line.split('\t')[0] for line in self.records(shard_filenames[0])},
+                     {'CHROM1'})
+    self.assertEqual({line.split('\t')[0] for line in self.records(shard_filenames[1])},
+                     {'PLASMID1'})
+
+  def test_split_vcf_within_contig(self):
+    vcf_file = self.write_vcf([('CHROM1', i) for i in range(100, 200)])
+    shard_filenames = split_vcf(vcf_file, self.working_dir, 4)
+    vcf_file.close()
+    self.assertEqual(len(shard_filenames), 4)
+    for shard_filename in shard_filenames:
+      self.assertGreater(len(self.records(shard_filename)), 10)
+
+  def test_split_vcf_without_records(self):
+    vcf_file = self.write_vcf([])
+    shard_filenames = split_vcf(vcf_file, self.working_dir, 4)
+    vcf_file.close()
+    self.assertEqual(len(shard_filenames), 1)
+    with open(shard_filenames[0], 'r') as shard_file:
+      self.assertEqual(len(shard_file.readlines()), 2)
+
+  def test_split_vcf_records(self):
+    vcf_file = self.write_vcf([('CHROM1', i) for i in range(10, 20)] +
+                              [('PLASMID1', i) for i in range(10, 15)])
+    shard_filenames = split_vcf_records(vcf_file, self.working_dir, 4)
+    vcf_file.seek(0)
+    expected = vcf_file.read()
+    vcf_file.close()
+    self.assertEqual([len(self.records(shard_filename))
+                      for shard_filename in shard_filenames], [4, 4, 4, 3])
+    self.assertMultiLineEqual("".join(merged_vcf_lines(shard_filenames)),
+                              expected)
+
+  def test_split_and_merge(self):
+    vcf_file = self.write_vcf([('CHROM1', i) for i in range(100, 200)] +
+                              [('PLASMID1', i) for i in range(10, 20)] +
+                              [('PLASMID2', i) for i in range(10, 50)])
+    shard_filenames = split_vcf(vcf_file, self.working_dir, 3)
+    vcf_file.seek(0)
+    expected = vcf_file.read()
+    vcf_file.close()
+    self.assertMultiLineEqual("".join(merged_vcf_lines(shard_filenames)),
+                              expected)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import Counter
+from io import StringIO
+
+from snpEffWrapper.streaming import *
+
+class TestStreaming(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_streaming_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def vcf(self, records, contigs=()):
+    lines = ["##fileformat=VCFv4.1\n"]
+    lines += ["##contig=<ID=%s,length=1000>\n" % contig for contig in contigs]
+    lines.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+    lines += ["%s\t%s\t.\tC\tA\t.\t.\t.\n" % record for record in records]
+    return "".join(lines)
+
+  def test_contigs_from_header(self):
+    vcf = self.vcf([('CHROM1', 10), ('PLASMID1', 20), ('CHROM2', 30)],
+                   contigs=['PLASMID1', 'CHROM1'])
+    record_counts = Counter()
+    with StreamedVCF(StringIO(vcf), self.working_dir) as streamed_vcf:
+      self.assertEqual(len(streamed_vcf.header), 4)
+      self.assertEqual(streamed_vcf.contigs(record_counts), ['CHROM1', 'PLASMID1'])
+      self.assertIsNone(streamed_vcf.records)
+      self.assertEqual(record_counts, Counter())
+      self.assertEqual(streamed_vcf.read(10), vcf.encode('utf-8')[:len("##fileformat=VCFv4.1\n")])
+      self.assertEqual(streamed_vcf.read(), vcf.encode('utf-8')[len("##fileformat=VCFv4.1\n"):])
+      self.assertEqual(streamed_vcf.read(), b'')
+      self.assertEqual(streamed_vcf.undeclared_contigs, Counter({'CHROM2': 1}))
+      self.assertEqual(streamed_vcf.record_contigs,
+                       Counter({'CHROM1': 1, 'PLASMID1': 1, 'CHROM2': 1}))
+      self.assertTrue(streamed_vcf.from_header())
+    self.assertEqual(os.listdir(self.working_dir), [])
+
+  def test_contigs_from_records(self):
+    records = [('CHROM1', i) for i in range(10, 20)] + [('PLASMID1', 30)]
+    vcf = self.vcf(records)
+    record_counts = Counter()
+    with StreamedVCF(StringIO(vcf), self.working_dir, spool_size=100) as streamed_vcf:
+      self.assertEqual(streamed_vcf.contigs(record_counts), ['CHROM1', 'PLASMID1'])
+      self.assertEqual(streamed_vcf.records, 11)
+      self.assertEqual(record_counts, Counter({'CHROM1': 10, 'PLASMID1': 1}))
+      self.assertEqual("".join(streamed_vcf.lines()), vcf)
+      self.assertEqual(streamed_vcf.undeclared_contigs, Counter())
+      self.assertFalse(streamed_vcf.from_header())
+
+    with StreamedVCF(StringIO(self.vcf([])), self.working_dir) as streamed_vcf:
+      self.assertEqual(streamed_vcf.contigs(), [])
+      self.assertEqual(streamed_vcf.read(), self.vcf([]).encode('utf-8'))
+
+  def test_compressed_stream(self):
+    vcf = self.vcf([('CHROM1', 10), ('CHROM1', 20)], contigs=['CHROM1'])
+    vcf_stream = io.TextIOWrapper(io.BufferedReader(io.BytesIO(gzip.compress(vcf.encode('utf-8')))))
+    with StreamedVCF(vcf_stream, self.working_dir) as streamed_vcf:
+      self.assertEqual(streamed_vcf.contigs(), ['CHROM1'])
+      self.assertEqual(streamed_vcf.read(), vcf.encode('utf-8'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.summary import *
+
+class TestSummary(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_summary_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def test_add_line(self):
+    summary = AnnotationSummary()
+    summary.add_line("CHROM1\t110\t.\tC\tA,T\t.\t.\tDP=3;ANN=" +
+                     "A|missense_variant&splice_region_variant|MODERATE|baz_gene|CHROM1.2|transcript," +
+                     "T|missense_variant|MODERATE|baz_gene|CHROM1.2|transcript," +
+                     "A|upstream_gene_variant|MODIFIER|qux_gene|CHROM1.3|transcript;AF=0.5\tGT\t1\n")
+    summary.add_line("CHROM1\t120\t.\tC\tA\t.\t.\tANN=A|missense_variant|MODERATE||CHROM1.2|transcript\n")
+    summary.add_line("CHROM2\t10\t.\tC\tA\t.\t.\t.\n")
+    self.assertEqual(summary.records, 3)
+    self.assertEqual(summary.annotated_records, 2)
+    self.assertEqual(summary.rows(), [
+      ['CHROM1', 'CHROM1.2', 'missense_variant', 'MODERATE', 1, 1],
+      ['CHROM1', 'baz_gene', 'missense_variant', 'MODERATE', 1, 2],
+      ['CHROM1', 'baz_gene', 'splice_region_variant', 'MODERATE', 1, 1],
+      ['CHROM1', 'qux_gene', 'upstream_gene_variant', 'MODIFIER', 1, 1]
+    ])
+
+  def test_merge(self):
+    first, second = AnnotationSummary(), AnnotationSummary()
+    first.add_record('CHROM1', 'A|missense_variant|MODERATE|baz_gene|CHROM1.2')
+    second.add_record('CHROM1', 'A|missense_variant|MODERATE|baz_gene|CHROM1.2')
+    second.add_record('CHROM2', 'A|synonymous_variant|LOW|qux_gene|CHROM2.1')
+    first.merge(second)
+    self.assertEqual(first.records, 3)
+    self.assertEqual(first.rows(), [
+      ['CHROM1', 'baz_gene', 'missense_variant', 'MODERATE', 2, 2],
+      ['CHROM2', 'qux_gene', 'synonymous_variant', 'LOW', 1, 1]
+    ])
+    self.assertEqual(second.records, 2)
+
+  def test_write_and_read(self):
+    summary = AnnotationSummary()
+    summary.add_record('CHROM1', 'A|missense_variant|MODERATE|baz_gene|CHROM1.2')
+    summary.add_record('CHROM1', None)
+    tsv_filename = os.path.join(self.working_dir, 'summary.tsv')
+    json_filename = os.path.join(self.working_dir, 'summary.json')
+    summary.write(tsv_filename)
+    summary.write(json_filename)
+    with open(tsv_filename, 'r') as tsv_file:
+      self.assertEqual(tsv_file.read(),
+                       "## records=2\n"
+                       "## annotated_records=1\n"
+                       "contig\tgene\teffect\timpact\tvariants\talleles\n"
+                       "CHROM1\tbaz_gene\tmissense_variant\tMODERATE\t1\t1\n")
+    with open(json_filename, 'r') as json_file:
+      self.assertEqual(json.load(json_file)['columns'], SUMMARY_COLUMNS)
+    for filename in [tsv_filename, json_filename]:
+      read_summary = AnnotationSummary.read(filename)
+      self.assertEqual(read_summary.records, 2)
+      self.assertEqual(read_summary.annotated_records, 1)
+      self.assertEqual(read_summary.rows(), summary.rows())
+
+    merged_filename = os.path.join(self.working_dir, 'merged.tsv')
+    merged = merge_summaries([tsv_filename, json_filename], merged_filename)
+    self.assertEqual(merged.rows(),
+                     [['CHROM1', 'baz_gene', 'missense_variant', 'MODERATE', 2, 2]])
+    self.assertEqual(AnnotationSummary.read(merged_filename).records, 4)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from snpEffWrapper.table import *
+
+MISSENSE = 'A|missense_variant|MODERATE|fooA|GENE_0001|transcript|T1|protein_coding|1/1|c.12C>A|p.Pro4Thr|12/900|12/900|4/299||'
+UPSTREAM = 'T|upstream_gene_variant|MODIFIER|fooB|GENE_0002|transcript|T2|protein_coding||c.-20C>T|||||20|WARNING_TRANSCRIPT_INCOMPLETE'
+
+RECORD = "CHROM1\t12\trs1\tC\tA,T\t50\tPASS\tDP=10;ANN=%s,%s\tGT\t1\n" % (MISSENSE, UPSTREAM)
+UNANNOTATED = "CHROM1\t20\t.\tC\tA\t50\tPASS\tDP=10\n"
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+class TestTable(unittest.TestCase):
+  def setUp(self):
+    self.working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_table_',
+                                        dir=os.getcwd())
+
+  def tearDown(self):
+    shutil.rmtree(self.working_dir)
+
+  def test_effect_rows(self):
+    rows = effect_rows(RECORD)
+    self.assertEqual(len(rows), 2)
+    self.assertEqual(rows[0][:8], ['CHROM1', '12', 'rs1', 'C', 'A,T', 'PASS', 'A', 'missense_variant'])
+    self.assertEqual(dict(zip(TABLE_COLUMNS, rows[1]))['distance'], '20')
+    self.assertEqual(dict(zip(TABLE_COLUMNS, rows[1]))['messages'], 'WARNING_TRANSCRIPT_INCOMPLETE')
+    self.assertEqual(effect_rows(UNANNOTATED), [])
+    self.assertEqual(len(effect_rows("CHROM1\t12\t.\tC\tA\t.\t.\tANN=A|intergenic_region|MODIFIER\n")[0]),
+                     len(TABLE_COLUMNS))
+
+  def test_write_tsv(self):
+    for table_filename in ['effects.tsv', 'effects.tsv.gz']:
+      table_filename = os.path.join(self.working_dir, table_filename)
+      with EffectsTable(table_filename, batch_rows=1) as table:
+        table.add_line(RECORD)
+        table.add_line(UNANNOTATED)
+        self.assertFalse(os.path.exists(table_filename))
+      self.assertEqual(table.rows, 2)
+      opener = gzip.open if table_filename.endswith('.gz') else open
+      with opener(table_filename, 'rt') as table_file:
+        lines = table_file.readlines()
+      self.assertEqual(lines[0], "\t".join(TABLE_COLUMNS) + "\n")
+      self.assertEqual(lines[1], "\t".join(effect_rows(RECORD)[0]) + "\n")
+      self.assertEqual(len(lines), 3)
+
+    table_filename = os.path.join(self.working_dir, 'aborted.tsv')
+    with self.assertRaises(RuntimeError):
+      with EffectsTable(table_filename) as table:
+        table.add_line(RECORD)
+        raise RuntimeError("The annotation failed")
+    self.assertEqual(sorted(os.listdir(self.working_dir)),
+                     ['effects.tsv', 'effects.tsv.gz'])
+
+  def test_write_arrow(self):
+    self.assertEqual(table_format('effects.parquet'), 'parquet')
+    self.assertEqual(table_format('effects.feather'), 'arrow')
+    self.assertEqual(table_format('effects.txt'), 'tsv')
+    table_filename = os.path.join(self.working_dir, 'effects.parquet')
+    if pyarrow is None:
+      self.assertRaises(EffectsTableError, check_effects_table, table_filename)
+      return
+    with EffectsTable(table_filename, batch_rows=2) as table:
+      for i in range(3):
+        table.add_line(RECORD)
+    parquet_file = pyarrow.parquet.ParquetFile(table_filename)
+    self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+    columns = parquet_file.read().to_pydict()
+    self.assertEqual(columns['pos'], [12] * 6)
+    self.assertEqual(columns['distance'], [None, 20] * 3)
+    self.assertEqual(columns['gene_id'], ['GENE_0001', 'GENE_0002'] * 3)
+
+if __name__ == '__main__':
+  unittest.main()
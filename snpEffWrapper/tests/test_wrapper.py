@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
+import gzip
+import json
 import tempfile
 import unittest
 import pkg_resources
 import vcf
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+from snpEffWrapper.summary import AnnotationSummary
 from snpEffWrapper.wrapper import *
-from snpEffWrapper.wrapper import _java_version_ok, _choose_java
+from snpEffWrapper.wrapper import _java_version_ok, _choose_java, _snpeff_annotate
 
 class TestSnpEffWrapper(unittest.TestCase):
   def setUp(self):
@@ -99,6 +104,18 @@ PLASMID1	50	.	G	T	.	.	.	GT	1	0
     actual_contigs = get_vcf_contigs(fake_vcf)
     self.assertEqual(actual_contigs, expected_contigs)
 
+    record_counts = Counter()
+    actual_contigs = get_vcf_contigs(fake_vcf, record_counts)
+    self.assertEqual(actual_contigs, expected_contigs)
+    self.assertEqual(record_counts, {'CHROM1': 2, 'PLASMID1': 1})
+
+    positions = {}
+    get_vcf_contigs(StringIO("CHROM1\t100\t.\tGCC\tA\t.\t.\t.\n"
+                             "CHROM1\t200\t.\tG\tA\t.\t.\t.\n"), None, positions)
+    self.assertEqual({contig: list(contig_positions)
+                      for contig, contig_positions in positions.items()},
+                     {'CHROM1': [100, 102, 200]})
+
   @patch('snpEffWrapper.wrapper.logger.warn')
   def test_check_contigs(self, warn_mock):
     vcf_contigs = ['CHROM1']
@@ -233,7 +250,7 @@ PLASMID1	50	.	G	T	.	.	.	GT	1	0
   @patch('snpEffWrapper.wrapper._java_version_ok')
   def test_choose_java(self, java_ok_mock, which_mock):
     which_mock.return_value = '/foo/bar/java'
-    java_ok_mock.side_effect = lambda java: java in list_of_ok_javas
+    java_ok_mock.side_effect = lambda java, java_versions: java in list_of_ok_javas
 
     list_of_ok_javas = [
       '/foo/bar/java'
@@ -255,6 +272,31 @@ PLASMID1	50	.	G	T	.	.	.	GT	1	0
     list_of_ok_javas = []
     self.assertRaises(WrongJavaError, _choose_java)
 
+  def test_parse_java_versions(self):
+    self.assertEqual(parse_java_versions('7'), (7, 7))
+    self.assertEqual(parse_java_versions('7-8'), (7, 8))
+    self.assertEqual(parse_java_versions('8+'), (8, None))
+    self.assertRaises(ValueError, parse_java_versions, '8-7')
+    self.assertRaises(ValueError, parse_java_versions, '1.7')
+
+  @patch('snpEffWrapper.wrapper.java_version')
+  def test_java_version_ok(self, java_version_mock):
+    versions = {
+      '/java7': '1.7.0_21',
+      '/java8': '1.8.0_212',
+      '/java11': '11.0.2',
+      '/broken': None
+    }
+    java_version_mock.side_effect = lambda java: versions[java]
+    self.assertTrue(_java_version_ok('/java7'))
+    self.assertFalse(_java_version_ok('/java8'))
+    self.assertFalse(_java_version_ok('/broken'))
+    self.assertFalse(_java_version_ok(None))
+    self.assertTrue(_java_version_ok('/java8', (7, 8)))
+    self.assertFalse(_java_version_ok('/java11', (7, 8)))
+    self.assertTrue(_java_version_ok('/java11', (8, None)))
+    self.assertFalse(_java_version_ok('/java7', (8, None)))
+
   @patch('snpEffWrapper.wrapper.logger.warn')
   def test_check_annotations(self, warn_mock):
     fake_vcf = StringIO("""\
@@ -286,19 +328,297 @@ CHROM1	400	.	G	A	.	.	ANN=A|foo|bar|ERROR_CHROMOSOME_NOT_FOUND	GT	0	1
     expected_warning = "1 instances of 'ERROR_CHROMOSOME_NOT_FOUND': A contig in your VCF could not be found in your GFF. Are you sure that contigs use consitent names between your input data and the reference?"
     warn_mock.assert_called_once_with(expected_warning)
 
+  def test_count_annotation_errors(self):
+    fake_vcf = StringIO("""\
+##fileformat=VCFv4.1
+##INFO=<ID=ANN,Number=.,Type=String,Description="ERROR_CHROMOSOME_NOT_FOUND">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	sample_1	sample_2
+CHROM1	400	.	G	A	.	.	ANN=A|foo|bar|	GT	0	1
+CHROM1	401	.	G	A	.	.	.	GT	0	1
+CHROM1	402	.	G	A	.	.	DP=4;ANN=A|foo|bar|WARNING_REF_DOES_NOT_MATCH_GENOME;AC=1	GT	0	1
+CHROM1	403	.	G	A,T	.	.	ANN=A|foo|ERROR_CHROMOSOME_NOT_FOUND,T|foo|ERROR_CHROMOSOME_NOT_FOUND	GT	0	1
+CHROM1	404	.	G	A	.	.	NOTE=ERROR_OUT_OF_CHROMOSOME_RANGE;ANN=A|foo|bar|	GT	ERROR_OUT_OF_CHROMOSOME_RANGE	1
+CHROM1	405	.	G	A	.	.	ANN=A|foo|ERROR_CHROMOSOME_NOT_FOUND&WARNING_REF_DOES_NOT_MATCH_GENOME	GT	0	1
+""")
+    self.assertEqual(count_annotation_errors(fake_vcf),
+                     {'ERROR_CHROMOSOME_NOT_FOUND': 2,
+                      'WARNING_REF_DOES_NOT_MATCH_GENOME': 2})
+
+  def test_get_batch_output_filename(self):
+    self.assertEqual(get_batch_output_filename('out', '/data/foo.vcf'),
+                     'out/foo.annotated.vcf')
+    self.assertEqual(get_batch_output_filename('out', 'foo.bar'),
+                     'out/foo.bar.annotated.vcf')
+    self.assertEqual(get_batch_output_filename('out', 'foo.vcf.gz'),
+                     'out/foo.annotated.vcf')
+    self.assertEqual(get_batch_output_filename('out', 'foo.vcf.bgz', True),
+                     'out/foo.annotated.vcf.gz')
+
+  @patch('snpEffWrapper.wrapper.ProcessPoolExecutor', ThreadPoolExecutor)
+  @patch('snpEffWrapper.wrapper.parse_coding_table',
+         return_value={'default': 'Bacterial_and_Plant_Plastid'})
+  @patch('snpEffWrapper.wrapper._snpeff_annotate')
+  @patch('snpEffWrapper.wrapper._snpeff_build_database')
+  @patch('snpEffWrapper.wrapper.logger.warn')
+  def test_annotate_vcfs(self, warn_mock, build_mock, annotate_mock,
+                         coding_table_mock):
+    def fake_annotate(java_exec, snpeff_exec, vcf_filename, config_filename,
+                      output_file, stderr, annotation_stats_file,
+                      jvm_plan=None, metrics=None, progress=None,
+                      summary=None, record_filter=None):
+      annotation = 'ERROR_CHROMOSOME_NOT_FOUND' if 'bad' in vcf_filename else ''
+      annotated_vcf = StringIO("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                               "CHROM1\t110\t.\tC\tA\t.\t.\tANN=A|foo|%s\n" %
+                               annotation)
+      return stream_annotated_vcf(annotated_vcf, output_file, progress, summary)
+    annotate_mock.side_effect = fake_annotate
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_tmp_', dir=os.getcwd())
+    try:
+      tests_dir = pkg_resources.resource_filename('snpEffWrapper', 'tests')
+      minimal_vcf_filename = os.path.join(tests_dir, 'data', 'minimal.vcf')
+      vcf_filenames = []
+      for name in ['good.vcf', 'bad.vcf', 'also_good.vcf']:
+        vcf_filenames.append(os.path.join(working_dir, name))
+        shutil.copy(minimal_vcf_filename, vcf_filenames[-1])
+
+      fake_args = MagicMock()
+      fake_args.coding_table = 'default: Bacterial_and_Plant_Plastid'
+      gff_filename = os.path.join(working_dir, 'minimal.gff')
+      shutil.copy(os.path.join(tests_dir, 'data', 'minimal.gff'), gff_filename)
+      fake_args.gff_file = open(gff_filename, 'r')
+      fake_args.vcf_filenames = vcf_filenames
+      fake_args.output_dir = os.path.join(working_dir, 'output')
+      fake_args.jobs = 2
+      fake_args.debug = False
+      fake_args.keep = False
+      fake_args.cache_dir = None
+      fake_args.build_heap = None
+      fake_args.annotate_heap = None
+      fake_args.java_gc = None
+      fake_args.java_options = None
+      fake_args.bgzip = False
+      fake_args.tabix = False
+      fake_args.compression_threads = 1
+      fake_args.scratch_dir = None
+      fake_args.metrics_file = os.path.join(working_dir, 'metrics.json')
+      fake_args.progress_interval = 0
+      fake_args.summary_file = os.path.join(working_dir, 'summary.json')
+      fake_args.prune = False
+      fake_args.prune_distance = None
+      fake_args.resume_dir = None
+      fake_args.deduplicate = False
+      fake_args.contig_aliases = None
+      fake_args.contig_alias_rules = []
+      fake_args.contig_report = None
+      fake_args.preflight = False
+      fake_args.impacts = None
+      fake_args.effects = None
+      fake_args.genes = None
+      fake_args.only_matching_annotations = False
+      fake_args.effects_table = None
+      with patch('snpEffWrapper.wrapper.os.getcwd', return_value=working_dir):
+        self.assertRaises(AnnotationError, annotate_vcfs, fake_args)
+      fake_args.gff_file.close()
+      with open(fake_args.metrics_file, 'r') as metrics_file:
+        metrics = json.load(metrics_file)
+      self.assertEqual(metrics['status'], 'failed')
+      self.assertEqual(metrics['counts']['input_records'], 3)
+      self.assertEqual(metrics['counts']['failed_vcfs'], 1)
+      self.assertEqual(metrics['stages']['build_database']['calls'], 1)
+      os.remove(fake_args.metrics_file)
+      summary = AnnotationSummary.read(fake_args.summary_file)
+      self.assertEqual(summary.records, 2) # Only the VCFs which were written
+      self.assertEqual(summary.rows(), [['CHROM1', '', 'foo', '', 2, 2]])
+      os.remove(fake_args.summary_file)
+
+      self.assertEqual(build_mock.call_count, 1)
+      self.assertEqual(annotate_mock.call_count, 3)
+      self.assertEqual(sorted(os.listdir(fake_args.output_dir)),
+                       ['also_good.annotated.vcf', 'good.annotated.vcf'])
+      self.assertEqual(sorted(os.listdir(working_dir)),
+                       ['also_good.vcf', 'bad.vcf', 'good.vcf',
+                        'minimal.gff', 'minimal.gff.index.json', 'output'])
+      warn_mock.assert_any_call("Could not annotate %s: There were problems during the annotation, please review the warnings for details" % vcf_filenames[1])
+    finally:
+      shutil.rmtree(working_dir)
+
+  @patch('snpEffWrapper.wrapper.ProcessPoolExecutor', ThreadPoolExecutor)
+  @patch('snpEffWrapper.wrapper.parse_coding_table',
+         return_value={'default': 'Bacterial_and_Plant_Plastid'})
+  @patch('snpEffWrapper.wrapper._snpeff_annotate')
+  @patch('snpEffWrapper.wrapper._snpeff_build_database')
+  def test_annotate_sharded(self, build_mock, annotate_mock, coding_table_mock):
+    def fake_annotate(java_exec, snpeff_exec, vcf_filename, config_filename,
+                      output_file, stderr, annotation_stats_file,
+                      jvm_plan=None, metrics=None, progress=None,
+                      summary=None, record_filter=None):
+      annotated_vcf = StringIO()
+      with open(vcf_filename, 'r') as vcf_file:
+        for line in vcf_file:
+          if line[0] != '#':
+            position = int(line.split('\t')[1])
+            annotation = 'ERROR_OUT_OF_CHROMOSOME_RANGE' if position > 150 else ''
+            line = line.replace('\t.\n', '\tANN=A|foo|%s\n' % annotation)
+          annotated_vcf.write(line)
+      annotated_vcf.seek(0)
+      return stream_annotated_vcf(annotated_vcf, output_file, progress, summary)
+    annotate_mock.side_effect = fake_annotate
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_tmp_', dir=os.getcwd())
+    try:
+      tests_dir = pkg_resources.resource_filename('snpEffWrapper', 'tests')
+      gff_filename = os.path.join(working_dir, 'minimal.gff')
+      shutil.copy(os.path.join(tests_dir, 'data', 'minimal.gff'), gff_filename)
+      vcf_filename = os.path.join(working_dir, 'input.vcf')
+      with open(vcf_filename, 'w') as vcf_file:
+        print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO", file=vcf_file)
+        for position in range(100, 200):
+          print("CHROM1\t%s\t.\tC\tA\t.\t.\t." % position, file=vcf_file)
+
+      fake_args = MagicMock()
+      fake_args.snpeff_exec = 'snpEff.jar'
+      fake_args.java_exec = 'java'
+      fake_args.coding_table = 'default: Bacterial_and_Plant_Plastid'
+      fake_args.gff_file = open(gff_filename, 'r')
+      fake_args.vcf_file = open(vcf_filename, 'r')
+      fake_args.threads = 4
+      fake_args.debug = False
+      fake_args.keep = False
+      fake_args.cache_dir = None
+      fake_args.build_heap = None
+      fake_args.annotate_heap = None
+      fake_args.java_gc = None
+      fake_args.java_options = None
+      fake_args.scratch_dir = None
+      fake_args.progress_interval = 0
+      fake_args.summary_file = None
+      fake_args.prune = False
+      fake_args.prune_distance = None
+      fake_args.resume_dir = None
+      fake_args.contig_aliases = None
+      fake_args.contig_alias_rules = []
+      fake_args.contig_report = None
+      fake_args.preflight = False
+      fake_args.impacts = None
+      fake_args.effects = None
+      fake_args.genes = None
+      fake_args.only_matching_annotations = False
+      fake_args.effects_table = None
+      metrics = RunMetrics()
+      with patch('snpEffWrapper.wrapper.os.getcwd', return_value=working_dir):
+        lines = list(annotated_vcf_lines(fake_args, metrics, check=False))
+      fake_args.gff_file.close()
+      fake_args.vcf_file.close()
+      self.assertEqual(annotate_mock.call_count, 4)
+      self.assertEqual(metrics.counts['annotation_errors'], 49)
+      self.assertEqual(metrics.stages['merge_vcfs']['calls'], 1)
+      positions = [int(line.split('\t')[1]) for line in lines
+                   if line[0] != '#']
+      self.assertEqual(positions, list(range(100, 200)))
+      self.assertEqual(sorted(os.listdir(working_dir)),
+                       ['input.vcf', 'minimal.gff', 'minimal.gff.index.json'])
+    finally:
+      shutil.rmtree(working_dir)
+
+  def test_snpeff_annotate(self):
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_tmp_', dir=os.getcwd())
+    try:
+      fake_java = os.path.join(working_dir, 'fake_java')
+      with open(fake_java, 'w') as fake_java_file:
+        print("""#!/bin/sh
+for last; do true; done
+sed -e 's/\\t\\.$/\\tANN=A|foo|WARNING_SEQUENCE_NOT_AVAILABLE/' "$last"
+echo "Annotated $last" >&2
+exit $FAKE_JAVA_EXIT_CODE""", file=fake_java_file)
+      os.chmod(fake_java, 0o755)
+      vcf_filename = os.path.join(working_dir, 'input.vcf')
+      with open(vcf_filename, 'w') as vcf_file:
+        print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO", file=vcf_file)
+        for position in range(10):
+          print("CHROM1\t%s\t.\tC\tA\t.\t.\t." % position, file=vcf_file)
+      output_filename = os.path.join(working_dir, 'output.vcf')
+      stderr_filename = os.path.join(working_dir, 'stderr')
+
+      with open(output_filename, 'w') as output_file, open(stderr_filename, 'w') as stderr:
+        with patch.dict('os.environ', {'FAKE_JAVA_EXIT_CODE': '0'}):
+          error_counter = _snpeff_annotate(fake_java, 'snpEff.jar',
+                                           vcf_filename, 'config', output_file,
+                                           stderr, 'stats.html')
+      self.assertEqual(error_counter, {'WARNING_SEQUENCE_NOT_AVAILABLE': 10})
+      with open(output_filename, 'r') as output_file:
+        self.assertEqual(len([line for line in output_file
+                              if line.endswith('WARNING_SEQUENCE_NOT_AVAILABLE\n')]),
+                         10)
+      with open(stderr_filename, 'r') as stderr:
+        self.assertEqual(stderr.read(), "Annotated %s\n" % vcf_filename)
+
+      compressed_vcf_filename = os.path.join(working_dir, 'input.vcf.gz')
+      with open(vcf_filename, 'rb') as vcf_file, \
+           gzip.open(compressed_vcf_filename, 'wb') as compressed_vcf_file:
+        shutil.copyfileobj(vcf_file, compressed_vcf_file)
+      with open(output_filename, 'w') as output_file, open(stderr_filename, 'w') as stderr:
+        with patch.dict('os.environ', {'FAKE_JAVA_EXIT_CODE': '0'}):
+          error_counter = _snpeff_annotate(fake_java, 'snpEff.jar',
+                                           compressed_vcf_filename, 'config',
+                                           output_file, stderr, 'stats.html')
+      self.assertEqual(error_counter, {'WARNING_SEQUENCE_NOT_AVAILABLE': 10})
+      with open(stderr_filename, 'r') as stderr:
+        self.assertEqual(stderr.read(), "Annotated -\n")
+
+      with open(output_filename, 'w') as output_file, open(stderr_filename, 'w') as stderr:
+        with patch.dict('os.environ', {'FAKE_JAVA_EXIT_CODE': '1'}):
+          self.assertRaises(AnnotationError, _snpeff_annotate, fake_java,
+                            'snpEff.jar', vcf_filename, 'config', output_file,
+                            stderr, 'stats.html')
+    finally:
+      shutil.rmtree(working_dir)
+
+  def test_annotated_vcf_output(self):
+    working_dir = tempfile.mkdtemp(prefix='snpEffWrapper_tmp_', dir=os.getcwd())
+    try:
+      output_filename = os.path.join(working_dir, 'output.vcf')
+      with annotated_vcf_output(open(output_filename, 'w')) as output_file:
+        output_file.write("Some output\n")
+        self.assertEqual(os.path.getsize(output_filename), 0)
+      self.assertEqual(os.listdir(working_dir), ['output.vcf'])
+      with open(output_filename, 'r') as output_file:
+        self.assertEqual(output_file.read(), "Some output\n")
+
+      with self.assertRaises(AnnotationError):
+        with annotated_vcf_output(open(output_filename, 'w')) as output_file:
+          output_file.write("Some partial output\n")
+          raise AnnotationError("Problem annotating")
+      self.assertEqual(os.listdir(working_dir), [])
+
+      fake_stdout = StringIO()
+      with patch('snpEffWrapper.wrapper.sys.stdout', fake_stdout):
+        with annotated_vcf_output(fake_stdout) as output_file:
+          output_file.write("Some output\n")
+      self.assertEqual(fake_stdout.getvalue(), "Some output\n")
+
+      output_filename = os.path.join(working_dir, 'output.vcf.gz')
+      output_options = OutputOptions(bgzip=True, threads=2, tabix=True)
+      with annotated_vcf_output(open(output_filename, 'w'),
+                                output_options=output_options) as output_file:
+        output_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        output_file.write("CHROM1\t10\t.\tC\tA\t.\t.\t.\n")
+      self.assertEqual(sorted(os.listdir(working_dir)),
+                       ['output.vcf.gz', 'output.vcf.gz.tbi'])
+      with gzip.open(output_filename, 'rt') as output_file:
+        self.assertEqual(output_file.read(),
+                         "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                         "CHROM1\t10\t.\tC\tA\t.\t.\t.\n")
+    finally:
+      shutil.rmtree(working_dir)
+
   @patch('snpEffWrapper.wrapper.delete_temp_database')
   @patch('snpEffWrapper.wrapper._get_snpeff_output_files')
   def test_happy_case(self, output_mock, delete_database_mock):
     delete_database_mock.side_effect = shutil.rmtree
-    temp_annotated_vcf = tempfile.NamedTemporaryFile(mode='w', delete=False,
-                                                     dir=os.getcwd(),
-                                                     prefix='temp_annotated_',
-                                                     suffix='.vcf')
     other_temp_files = [tempfile.NamedTemporaryFile(mode='w', delete=False,
                                                     dir=os.getcwd(),
                                                     prefix='temp_output_')
                         for i in range(3)]
-    output_mock.return_value = [temp_annotated_vcf] + other_temp_files
+    output_mock.return_value = other_temp_files
 
     fake_args = MagicMock()
     snpeff_exec = os.environ.get('SNPEFF_EXEC', 'snpEff.jar')
@@ -325,6 +645,33 @@ CHROM1	400	.	G	A	.	.	ANN=A|foo|bar|ERROR_CHROMOSOME_NOT_FOUND	GT	0	1
     fake_args.output_vcf = output_annotated_vcf
     fake_args.debug = False
     fake_args.keep = False
+    fake_args.cache_dir = None
+    fake_args.cache_max_size = None
+    fake_args.threads = 1
+    fake_args.build_heap = None
+    fake_args.annotate_heap = None
+    fake_args.java_gc = None
+    fake_args.java_options = None
+    fake_args.bgzip = False
+    fake_args.tabix = False
+    fake_args.compression_threads = 1
+    fake_args.scratch_dir = None
+    fake_args.metrics_file = None
+    fake_args.summary_file = None
+    fake_args.prune = False
+    fake_args.prune_distance = None
+    fake_args.resume_dir = None
+    fake_args.deduplicate = False
+    fake_args.contig_aliases = None
+    fake_args.contig_alias_rules = []
+    fake_args.contig_report = None
+    fake_args.preflight = False
+    fake_args.impacts = None
+    fake_args.effects = None
+    fake_args.genes = None
+    fake_args.only_matching_annotations = False
+    fake_args.effects_table = None
+    fake_args.progress_interval = 0
 
     annotate_vcf(fake_args)
 
@@ -1,3 +1,4 @@
+import io
 import logging
 import os
 import re
@@ -5,13 +6,37 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
-import vcf
 import yaml
 
+from array import array
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from jinja2 import Environment, PackageLoader
-from subprocess import CalledProcessError
+
+from .cache import DatabaseCache, database_cache_key
+from .checkpoint import Checkpoint, checkpoint_key
+from .cohort import (collect_sites, forget_site_annotations, get_site_annotations, joined_vcf_lines,
+                     write_sites_vcf)
+from .contigs import ContigAliases, ContigReconciliation, read_contig_aliases
+from .compression import (BgzfWriter, OutputOptions, is_gzipped, open_binary, open_text, reopen_text,
+                          strip_compression_extension, uncompressed_size)
+from .filters import get_annotation_filter
+from .gff_index import get_gff_index
+from .metrics import (DEFAULT_PROGRESS_INTERVAL, PROGRESS_CHECK_RECORDS, ProgressReporter, RunMetrics,
+                      wait_for_process)
+from .preflight import ReferenceSequences, preflight_errors
+from .probes import java_version
+from .prune import prune_gff
+from .resources import default_history_filename, plan_resources
+from .scratch import keep_temp_dir, make_temp_dir, stage_file
+from .shards import merged_vcf_lines, split_vcf, split_vcf_records
+from .streaming import StreamedVCF
+from .summary import AnnotationSummary
+from .table import EffectsTable
 
 logger = logging.getLogger(__name__)
 
@@ -36,35 +61,76 @@ class BuildDatabaseError(ValueError):
 class AnnotationError(ValueError):
   pass
 
-def _java_version_ok(java):
+class PreflightError(AnnotationError):
+  pass
+
+DEFAULT_JVM_OPTIONS = ["-Xmx4g"]
+
+DEFAULT_JAVA_VERSIONS = (7, 7)
+
+def parse_java_versions(versions_str):
+  """Parses a range of major Java versions e.g. '7', '7-8' or '8+'
+
+  Returns a tuple of the lowest and highest versions allowed; the highest is
+  None if there is no upper limit"""
+  match = re.match('^\s*(\d+)\s*(?:(\+)|-\s*(\d+))?\s*$', versions_str)
+  if match is None:
+    raise ValueError("Could not parse Java versions '%s'" % versions_str)
+  lowest = int(match.group(1))
+  if match.group(2) is not None:
+    return (lowest, None)
+  highest = int(match.group(3)) if match.group(3) is not None else lowest
+  if highest < lowest:
+    raise ValueError("Could not parse Java versions '%s'" % versions_str)
+  return (lowest, highest)
+
+def _describe_java_versions(java_versions):
+  lowest, highest = java_versions
+  if highest is None:
+    return "%s or later" % lowest
+  elif highest == lowest:
+    return "%s" % lowest
+  return "%s to %s" % (lowest, highest)
+
+def _java_major_version(version):
+  """Major version from the version string e.g. 7 from 1.7.0_21 or 11 from 11.0.2"""
+  match = re.match('^1\.(\d+)', version) or re.match('^(\d+)', version)
+  return int(match.group(1)) if match is not None else None
+
+def _java_version_ok(java, java_versions=DEFAULT_JAVA_VERSIONS):
   if java is None:
     return False
-  try:
-    output = subprocess.check_output([java, '-Xmx10m', '-version'], stderr=subprocess.STDOUT)
-    first_line = output.decode("utf-8").splitlines()[0]
-    match = re.match('^java version "1\.7\.[^"]+"$', first_line)
-    return match is not None
-  except CalledProcessError: # Probably this java doesn't exist
+  version = java_version(java)
+  if version is None: # Probably this java doesn't exist
     return False
-  except IndexError: # Didn't return any output
+  major_version = _java_major_version(version)
+  if major_version is None:
     return False
+  lowest, highest = java_versions
+  return lowest <= major_version and (highest is None or major_version <= highest)
 
-def _choose_java():
+def _choose_java(java_versions=DEFAULT_JAVA_VERSIONS):
   possible_javas = [
     shutil.which('java'),
     '/software/bin/java',
     '/software/pathogen/external/apps/usr/local/jdk1.7.0_21/bin/java'
   ]
   for java in possible_javas:
-    if _java_version_ok(java):
+    if _java_version_ok(java, java_versions):
       logger.debug("Using '%s'", java)
       return java
-  raise WrongJavaError("Could not find a suitable version of Java (1.7)")
+  raise WrongJavaError("Could not find a suitable version of Java (%s)" %
+                       _describe_java_versions(java_versions))
 
 def check_and_amend_executables(args):
-  """Sets default executables and checks that they are suitable"""
+  """Sets default executables and checks that they are suitable
+
+  The version of Java is remembered in the probe cache (see
+  probes.ProbeCache) so repeated runs don't have to start a JVM to check it;
+  SnpEff isn't run at all.
+  The executables can be given as paths or as files opened by argparse."""
   if not args.snpeff_exec is None:
-    args.snpeff_exec = args.snpeff_exec.name
+    args.snpeff_exec = getattr(args.snpeff_exec, 'name', args.snpeff_exec)
   elif os.path.isfile('snpEff.jar'):
     args.snpeff_exec = 'snpEff.jar'
   elif not shutil.which('snpEff.jar') is None:
@@ -76,71 +142,136 @@ def check_and_amend_executables(args):
     raise MissingSNPEffError("Could not find '%s'" % args.snpeff_exec)
 
   if args.java_exec is None:
-    args.java_exec = _choose_java()
+    args.java_exec = _choose_java(args.java_versions)
   else:
-    args.java_exec = args.java_exec.name
-  if not _java_version_ok(args.java_exec):
-    raise WrongJavaError("Needs Java 1.7, %s isn't or couldn't be found" % args.java_exec)
+    args.java_exec = getattr(args.java_exec, 'name', args.java_exec)
+    if not _java_version_ok(args.java_exec, args.java_versions):
+      raise WrongJavaError("Needs Java %s, %s isn't or couldn't be found" %
+                           (_describe_java_versions(args.java_versions),
+                            args.java_exec))
 
   return args
 
 def parse_coding_table(coding_table_str):
   logger.debug('Parsing the coding table')
+  if isinstance(coding_table_str, dict):
+    return dict(coding_table_str) # Already parsed e.g. given to the API
   return yaml.load(coding_table_str)
 
 def get_gff_contigs(gff_file):
-  """Hacky gff parser to get contigs
+  """Gets the contigs which have features in the GFF
 
-  Just looks for the contigs, assumes they're the first column
-  of a tab delimited file where the line doesn't start with '#'"""
+  Uses the GFF's index (see gff_index.get_gff_index) so the sequences in
+  the ##FASTA section aren't split into lines"""
   logger.debug('Getting the contigs from the GFF')
-  gff_file.seek(0)
-  contigs = set()
-  for line in gff_file:
-    if line[0] == '#':
-      continue
-    contig = line.split('\t')[0].strip()
-    contigs.add(contig)
-  return sorted(contigs)
+  return get_gff_index(gff_file).feature_contigs
 
-def get_vcf_contigs(vcf_file):
+def get_vcf_contigs(vcf_file, record_counts=None, positions=None):
   """Hacky vcf parser to get contigs
 
   Just looks for the contigs, assumes they're the first column
-  of a tab delimited file where the line doesn't start with '#'"""
+  of a tab delimited file where the line doesn't start with '#'.
+  If record_counts is a Counter it is updated with the number of records
+  on each contig.  If positions is a dict the first and (for longer REFs)
+  last position of each record are added to an array for its contig."""
   vcf_file.seek(0)
-  contigs = set()
+  contig_counts = Counter()
   for line in vcf_file:
     if line[0] == '#':
       continue
-    contig = line.split('\t')[0].strip()
-    contigs.add(contig)
-  return sorted(contigs)
+    if positions is not None:
+      contig, position, _, ref = line.split('\t', 4)[:4]
+      contig = contig.strip()
+      contig_positions = positions.get(contig)
+      if contig_positions is None:
+        contig_positions = positions[contig] = array('l')
+      contig_positions.append(int(position))
+      if len(ref) > 1:
+        contig_positions.append(int(position) + len(ref) - 1)
+      contig_counts[contig] += 1
+      continue
+    contig_counts[line.split('\t')[0].strip()] += 1
+  if record_counts is not None:
+    record_counts.update(contig_counts)
+  return sorted(contig_counts)
+
+def get_contig_aliases(args):
+  """The ContigAliases from args.contig_aliases and args.contig_alias_rules"""
+  aliases = {}
+  if args.contig_aliases is not None:
+    aliases = read_contig_aliases(args.contig_aliases)
+  return ContigAliases(aliases, args.contig_alias_rules)
+
+def reconcile_contigs(args, vcf_contigs, gff_contigs, record_counts=None):
+  """Matches the VCF contigs to the GFF contigs, by name or alias
 
-def check_contigs(vcf_contigs, gff_contigs, coding_table):
+  See contigs.ContigReconciliation.  The reconciliation is written to
+  args.contig_report, if it's set."""
+  reconciliation = ContigReconciliation(vcf_contigs, gff_contigs,
+                                        get_contig_aliases(args), record_counts)
+  reconciliation.log()
+  if args.contig_report is not None:
+    reconciliation.write(args.contig_report)
+  return reconciliation
+
+def preflight_check(args, vcf_filenames, gff_names, metrics=None):
+  """Checks the records of VCFs against the reference sequences in args.gff_file
+
+  Every record's POS and REF is looked up in the ##FASTA section of the GFF
+  using its index (see preflight.preflight_errors), so the problems SnpEff
+  would report are found before the database is built.  gff_names maps the
+  VCF contigs to their names in the GFF.  Raises PreflightError if there
+  are any, otherwise returns their (empty) Counter."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  logger.info("Checking the VCF against the reference in the GFF")
+  error_counter = Counter()
+  with metrics.stage('preflight'):
+    with ReferenceSequences(args.gff_file.name, get_gff_index(args.gff_file)) as reference:
+      for vcf_filename in vcf_filenames:
+        with open_text(vcf_filename) as vcf_file:
+          error_counter.update(preflight_errors(vcf_file, reference, gff_names))
+  metrics.count('preflight_errors', sum(error_counter.values()))
+  log_annotation_errors(error_counter)
+  if len(error_counter) > 0:
+    raise PreflightError("The VCF doesn't match the reference in the GFF, please review the warnings for details")
+  return error_counter
+
+def _missing_coding_tables(contigs, coding_table):
+  if 'default' in coding_table:
+    return []
+  return [contig for contig in contigs if contig not in coding_table]
+
+def check_contigs(vcf_contigs, gff_contigs, coding_table, declared_only=False):
   """Check that contigs are consistent
 
   If any contig in the VCF isn't in the coding table, fail.
   If not all of the VCF contigs are in the GFF, raise warnings.
-  If none of the VCF contigs are in the GFF, fail"""
+  If none of the VCF contigs are in the GFF, fail
+
+  If declared_only is set, vcf_contigs are only declared in the VCF's
+  header (see streaming.StreamedVCF.from_header) and might not have any
+  records, so they aren't failed for not having a coding table; see
+  check_streamed_contigs."""
   logger.info("Checking that the VCF and GFF contigs are consistent")
 
   # Check the VCF contigs are consistent with the coding table
-  missing_coding_tables = []
-  if 'default' not in coding_table:
-    missing_coding_tables = [table for table in vcf_contigs
-                             if table not in coding_table]
+  missing_coding_tables = _missing_coding_tables(vcf_contigs, coding_table)
+  if declared_only:
+    for table in missing_coding_tables:
+      logger.debug("No coding table set for '%s', checking that it has no records" % table)
+    missing_coding_tables = []
   for table in missing_coding_tables:
     logger.warn("Cannot annotate VCF, no coding table set for '%s'" % table)
 
   # Check the VCF contigs are consistent with the GFF contigs
+  gff_contigs = set(gff_contigs)
   missing_contigs = [contig for contig in vcf_contigs
                      if contig not in gff_contigs]
   for contig in missing_contigs:
     logger.warn("Could not annotate contig '%s', no annotation data" % contig)
 
   # Check the coding_table has known encodings
-  known_encodings = [
+  known_encodings = set([
     'Alternative_Flatworm_Mitochondrial',
     'Alternative_Yeast_Nuclear',
     'Ascidian_Mitochondrial',
@@ -166,7 +297,7 @@ def check_contigs(vcf_contigs, gff_contigs, coding_table):
     'Trematode_Mitochondrial',
     'Vertebrate_Mitochondrial',
     'Yeast_Mitochondrial'
-  ]
+  ])
   unknown_encodings = [enc for enc in coding_table.values()
                        if enc not in known_encodings]
   for encoding in unknown_encodings:
@@ -181,23 +312,104 @@ def check_contigs(vcf_contigs, gff_contigs, coding_table):
   if len(unknown_encodings) > 0:
     raise UnknownCodingTableError("Could not find coding table, see warnings for details")
 
-def create_temp_database(gff_file):
-  database_dir = tempfile.mkdtemp(prefix='snpeff_data_dir_', dir=os.getcwd())
+def check_streamed_contigs(vcf_file, coding_table):
+  """Fails, as check_contigs would have, if any records of a StreamedVCF were on contigs without a coding table
+
+  Called once all of the records have been read, if its contigs were
+  taken from its header."""
+  missing_coding_tables = _missing_coding_tables(sorted(vcf_file.record_contigs),
+                                                 coding_table)
+  for table in missing_coding_tables:
+    logger.warn("Cannot annotate VCF, no coding table set for '%s'" % table)
+  if len(missing_coding_tables) > 0:
+    raise MissingCodonTableError("Could not find coding tables for all contigs, see warnings for details")
+
+def create_temp_database(gff_file, scratch_dir=None, stage_gff=True):
+  """Creates a directory for SnpEff's database in scratch_dir
+
+  The GFF is linked into it rather than copied where possible.  If
+  stage_gff is False it is left for prune_reference to write."""
+  database_dir = make_temp_dir(scratch_dir)
   logger.debug("Creating directory %s for temporary database" % database_dir)
   data_dir = os.path.join(database_dir, 'data')
   logger.debug("data_dir: %s" % data_dir)
   os.makedirs(data_dir, mode=0o755)
-  shutil.copy(gff_file.name, os.path.join(data_dir,'genes.gff'))
+  if stage_gff:
+    staged_by = stage_file(gff_file.name, os.path.join(data_dir,'genes.gff'))
+    logger.debug("Staged %s into %s (%s)" % (gff_file.name, data_dir, staged_by))
   return database_dir
 
+def _pruning(args):
+  return args.prune or args.prune_distance is not None
+
+def _rewriting_reference(args, reconciliation):
+  return _pruning(args) or len(reconciliation.renames) > 0
+
+def can_stream_vcf(args):
+  """Can args.vcf_file be annotated as it's read from a stream (see streaming.StreamedVCF)?
+
+  Splitting it into shards or chunks, pruning the reference to the
+  positions of its variants or checking it against the reference first
+  (see preflight_check) needs the whole VCF on disk."""
+  return (args.threads == 1 and args.resume_dir is None and
+          _prune_distance(args) is None and not args.preflight)
+
+def _prune_distance(args):
+  """The distance to prune features at, if they can be pruned by distance
+
+  A database built from features near this run's variants couldn't be
+  reused for another VCF, so features aren't pruned by distance if
+  databases are cached; only the contigs are."""
+  if args.cache_dir is not None:
+    return None
+  return args.prune_distance
+
+def prune_reference(args, temp_database_dir, vcf_contigs, vcf_positions=None,
+                    metrics=None, reconciliation=None):
+  """Writes the GFF, pruned to vcf_contigs, into the temporary database
+
+  See prune.prune_gff.  If reconciliation is given, the GFF contigs which
+  the VCF calls something else are renamed to match it, so the VCF can be
+  annotated as it is; if args doesn't ask for pruning, that's all which is
+  done.  Returns the GFF's GFFIndex and size to plan the Java heaps with."""
+  pruned_filename = os.path.join(temp_database_dir, 'data', 'genes.gff')
+  gff_names = reconciliation.gff_names if reconciliation is not None else {}
+  renames = reconciliation.renames if reconciliation is not None else {}
+  if not _pruning(args):
+    gff_index = prune_gff(args.gff_file, pruned_filename, None, renames=renames)
+    return gff_index, os.path.getsize(pruned_filename)
+  distance = _prune_distance(args)
+  if distance is None and args.prune_distance is not None:
+    logger.info("Not pruning features far from the variants as databases are being cached")
+  if vcf_positions is not None:
+    vcf_positions = {gff_names.get(contig, contig): positions
+                     for contig, positions in vcf_positions.items()}
+  gff_index = prune_gff(args.gff_file, pruned_filename,
+                        [gff_names.get(contig, contig) for contig in vcf_contigs],
+                        vcf_positions, distance, renames)
+  if metrics is not None:
+    metrics.count('pruned_contigs', len(gff_index.feature_counts))
+    metrics.count('pruned_features', sum(gff_index.feature_counts.values()))
+  return gff_index, os.path.getsize(pruned_filename)
+
+def _snpeff_version(snpeff_exec):
+  """Identifies the snpEff jar without starting a JVM"""
+  snpeff_stat = os.stat(snpeff_exec)
+  return "%s:%s:%s" % (os.path.realpath(snpeff_exec), snpeff_stat.st_size,
+                       snpeff_stat.st_mtime)
+
+def _codon_tables(contigs, coding_table):
+  return {contig: coding_table.get(contig, coding_table.get('default'))
+          for contig in contigs}
+
 def get_genome_name(gff_file):
-  return re.sub('\.gff(\.gz)?$', '', gff_file.name)
+  return re.sub('\.gff(\.b?gz)?$', '', gff_file.name)
 
 def create_config_file(temp_database_dir, genome_name, vcf_contigs,
-                       coding_table):
+                       coding_table, config_name='config'):
   env = Environment(loader=PackageLoader('snpEffWrapper', 'data'))
   template = env.get_template('config.template')
-  output_filename = os.path.join(temp_database_dir, 'config')
+  output_filename = os.path.join(temp_database_dir, config_name)
   config_content = template.render(
     temp_database_dir=temp_database_dir,
     genome_name=genome_name,
@@ -209,141 +421,1191 @@ def create_config_file(temp_database_dir, genome_name, vcf_contigs,
     print(config_content, file=output_file, flush=True)
   return output_filename
 
+def _jvm_options(jvm_plan):
+  return jvm_plan.options() if jvm_plan is not None else DEFAULT_JVM_OPTIONS
+
 def _snpeff_build_database(java_exec, snpeff_exec, config_filename, stdout,
-                           stderr):
-  command = [java_exec, "-Xmx4g", "-jar",
+                           stderr, jvm_plan=None, metrics=None, processes=None):
+  """Runs `snpEff build`; the process is appended to processes, if given, so it can be killed"""
+  command = [java_exec] + _jvm_options(jvm_plan) + ["-jar",
              snpeff_exec, "build",
              "-gff3", "-verbose",
              "data",
              "-c", config_filename]
   logger.info("Building snpeff database")
   logger.debug("Using the following command: '%s'", " ".join([str(c) for c in command]))
+  start = time.time()
+  process = subprocess.Popen(command, stdout=stdout, stderr=stderr)
+  if processes is not None:
+    processes.append(process)
   try:
-    subprocess.check_call(command, stdout=stdout, stderr=stderr)
-  except CalledProcessError:
+    usage = wait_for_process(process)
+  except:
+    process.kill()
+    process.wait()
+    raise
+  _record_usage('build_database', usage, time.time() - start, jvm_plan,
+                metrics)
+  if usage.returncode != 0:
     raise BuildDatabaseError("Problem building the database from your GFF")
 
-def _snpeff_annotate(java_exec, snpeff_exec, vcf_filename, config_filename,
-                     output_file, stderr, annotation_stats_file):
-  command = [java_exec, "-Xmx4g", "-jar",
+def _record_usage(stage, usage, seconds, jvm_plan=None, metrics=None,
+                  name=None):
+  if jvm_plan is not None:
+    jvm_plan.record(usage.peak_rss_mb, seconds, usage.returncode)
+  if metrics is not None:
+    metrics.add_process(stage, usage, seconds, name)
+
+def _feed_stdin(process, input_file):
+  """Copies input_file to a process's stdin in a thread"""
+  def feed():
+    try:
+      shutil.copyfileobj(input_file, process.stdin, 1024*1024)
+    except BrokenPipeError:
+      pass # The process has died, its exit code will say why
+    finally:
+      input_file.close()
+      try:
+        process.stdin.close()
+      except BrokenPipeError:
+        pass
+  feeder = threading.Thread(target=feed, daemon=True)
+  feeder.start()
+  return feeder
+
+def _snpeff_annotated_lines(java_exec, snpeff_exec, vcf_filename,
+                            config_filename, stderr, annotation_stats_file,
+                            jvm_plan=None, metrics=None, vcf_input=None):
+  """Runs SnpEff, yielding the lines of the annotated VCF as it writes them
+
+  SnpEff's output is read through a pipe.  jvm_plan sets the heap and
+  garbage collector (default: a 4GB heap).  Gzipped VCFs are decompressed
+  on the fly into SnpEff's stdin, as is vcf_input (e.g. a StreamedVCF) if
+  it's given instead of a file.  SnpEff's peak memory and CPU time are
+  added to metrics once it exits; it is killed if the generator is closed
+  before the last line."""
+  if vcf_input is None and is_gzipped(vcf_filename):
+    vcf_input = open_binary(vcf_filename)
+  piped = vcf_input is not None
+  command = [java_exec] + _jvm_options(jvm_plan) + ["-jar",
              snpeff_exec, "ann",
              "-nodownload", "-verbose",
              "-stats", annotation_stats_file,
              "-c", config_filename,
              "data",
-             vcf_filename]
+             "-" if piped else vcf_filename]
   logger.info("Annotating %s" % vcf_filename)
   logger.debug("Using the following command: '%s'", " ".join(command))
-  logger.debug("writing output to %s" % output_file.name)
+  start = time.time()
+  process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr,
+                             stdin=subprocess.PIPE if piped else None)
+  feeder = _feed_stdin(process, vcf_input) if piped else None
   try:
-    subprocess.check_call(command, stdout=output_file, stderr=stderr)
-  except CalledProcessError:
+    with io.TextIOWrapper(process.stdout, encoding='utf-8') as annotated_vcf:
+      for line in annotated_vcf:
+        yield line
+  except:
+    process.kill()
+    process.wait()
+    raise
+  finally:
+    if feeder is not None:
+      feeder.join()
+  usage = wait_for_process(process)
+  _record_usage('annotate', usage, time.time() - start, jvm_plan, metrics,
+                vcf_filename)
+  if usage.returncode != 0:
     raise AnnotationError("Problem annotating %s" % vcf_filename)
 
+def _snpeff_annotate(java_exec, snpeff_exec, vcf_filename, config_filename,
+                     output_file, stderr, annotation_stats_file, jvm_plan=None,
+                     metrics=None, progress=None, summary=None,
+                     record_filter=None):
+  """Runs SnpEff, streaming its output to output_file
+
+  The annotation errors are counted as the lines go past; returns the counts.
+  progress (a ProgressReporter) is updated as records are annotated,
+  summary (an AnnotationSummary) counts their effects and record_filter
+  (an AnnotationFilter) picks the ones which are written."""
+  logger.debug("writing output to %s" % output_file.name)
+  annotated_lines = _snpeff_annotated_lines(java_exec, snpeff_exec,
+                                            vcf_filename, config_filename,
+                                            stderr, annotation_stats_file,
+                                            jvm_plan, metrics)
+  return stream_annotated_vcf(annotated_lines, output_file, progress, summary,
+                              record_filter)
+
+def _get_build_output_files(temp_database_dir, debug):
+  if debug:
+    return sys.stdout, sys.stderr
+  build_stdout = tempfile.NamedTemporaryFile(mode='w',
+                                             delete=False,
+                                             dir=temp_database_dir,
+                                             prefix='snpeff_build_db_',
+                                             suffix='.o')
+  build_stderr = tempfile.NamedTemporaryFile(mode='w',
+                                             delete=False,
+                                             dir=temp_database_dir,
+                                             prefix='snpeff_build_db_',
+                                             suffix='.e')
+  return build_stdout, build_stderr
+
 def _get_snpeff_output_files(temp_database_dir, debug):
-  temp_output_file = tempfile.NamedTemporaryFile(mode='w', delete=False,
-                                                 dir=temp_database_dir,
-                                                 prefix='snpeff_output_',
-                                                 suffix='.vcf')
+  build_stdout, build_stderr = _get_build_output_files(temp_database_dir,
+                                                       debug)
   if debug:
-    build_stdout, build_stderr = sys.stdout, sys.stderr
     annotate_stderr = sys.stderr
   else:
-    build_stdout = tempfile.NamedTemporaryFile(mode='w',
-                                                  delete=False,
-                                                  dir=temp_database_dir,
-                                                  prefix='snpeff_build_db_',
-                                                  suffix='.o')
-    build_stderr = tempfile.NamedTemporaryFile(mode='w',
-                                                  delete=False,
-                                                  dir=temp_database_dir,
-                                                  prefix='snpeff_build_db_',
-                                                  suffix='.e')
     annotate_stderr = tempfile.NamedTemporaryFile(mode='w',
                                                   delete=False,
                                                   dir=temp_database_dir,
                                                   prefix='snpeff_annotate_',
                                                   suffix='.e')
 
-  return temp_output_file, build_stdout, build_stderr, annotate_stderr
+  return build_stdout, build_stderr, annotate_stderr
+
+def _link_cached_database(temp_database_dir, cache_data_dir):
+  """Replaces the temporary database's data directory with a cached one"""
+  data_dir = os.path.join(temp_database_dir, 'data')
+  if os.path.isdir(data_dir):
+    shutil.rmtree(data_dir)
+  logger.debug("Linking %s to cached database %s" % (data_dir, cache_data_dir))
+  os.symlink(cache_data_dir, data_dir)
+
+@contextmanager
+def built_database(temp_database_dir, java_exec, snpeff_exec, config_filename,
+                   build_stdout, build_stderr, database_cache=None,
+                   cache_key=None, jvm_plan=None, metrics=None,
+                   processes=None):
+  """Builds the database, or links it from the cache, for use in the context
+
+  A cached database cannot be evicted until the context exits"""
+  metrics = metrics if metrics is not None else RunMetrics()
+  def build_database(cache_data_dir=None):
+    with metrics.stage('build_database'):
+      _snpeff_build_database(java_exec, snpeff_exec, config_filename,
+                             build_stdout, build_stderr, jvm_plan, metrics,
+                             processes)
+    if cache_data_dir is not None:
+      shutil.move(os.path.join(temp_database_dir, 'data'), cache_data_dir)
+
+  if database_cache is None:
+    build_database()
+    yield
+  else:
+    with database_cache.database(cache_key, build_database) as cache_data_dir:
+      _link_cached_database(temp_database_dir, cache_data_dir)
+      yield
+
+class BackgroundDatabaseBuild(object):
+  """Builds the database (see built_database) in a thread while other stages run
+
+  It can be used in place of built_database: entering it waits for the
+  build to finish, raising BuildDatabaseError (or whatever else stopped it)
+  if it failed.  The database, and its cache entry if it has one, is held
+  until close(), which kills the build if it's still running."""
+  def __init__(self, temp_database_dir, java_exec, snpeff_exec,
+               config_filename, build_stdout, build_stderr,
+               database_cache=None, cache_key=None, jvm_plan=None,
+               metrics=None):
+    self._processes = []
+    self._database = built_database(temp_database_dir, java_exec, snpeff_exec,
+                                    config_filename, build_stdout,
+                                    build_stderr, database_cache, cache_key,
+                                    jvm_plan, metrics, self._processes)
+    self._executor = ThreadPoolExecutor(max_workers=1)
+    self._build = self._executor.submit(self._database.__enter__)
+    self._closed = False
+
+  def __enter__(self):
+    self._build.result()
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    pass # Held until close()
 
-def run_snpeff(temp_database_dir, java_exec, snpeff_exec, vcf_file,
-               config_filename, debug):
-  temp_output_file, build_stdout, build_stderr, annotate_stderr = _get_snpeff_output_files(temp_database_dir, debug)
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    while not self._build.done():
+      logger.debug("Stopping the database build")
+      for process in self._processes:
+        if process.poll() is None:
+          process.kill()
+      # Still starting, or waiting for another job building the same cached database
+      wait([self._build], timeout=0.1)
+    self._executor.shutdown()
+    if self._build.exception() is None:
+      self._database.__exit__(None, None, None)
+
+def snpeff_annotated_lines(temp_database_dir, java_exec, snpeff_exec,
+                           vcf_file, config_filename, debug, error_counter,
+                           database_cache=None, cache_key=None,
+                           resource_plan=None, metrics=None, progress=None,
+                           summary=None, database=None, record_filter=None,
+                           effects_table=None):
+  """Builds the database and yields the lines of the annotated VCF
+
+  error_counter (a Counter) is updated with the annotation errors as the
+  lines go past and summary (an AnnotationSummary) with their effects.
+  Only the lines kept by record_filter (an AnnotationFilter) are yielded;
+  their annotations are added to effects_table (an EffectsTable).
+  database, if given, is used instead of built_database e.g. a
+  BackgroundDatabaseBuild.  vcf_file can be a StreamedVCF, which is
+  piped to SnpEff as it's read."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  build_plan, annotate_plan = _stage_plans(resource_plan)
+  build_stdout, build_stderr, annotate_stderr = _get_snpeff_output_files(temp_database_dir, debug)
   vcf_filename = vcf_file.name
-  _snpeff_build_database(java_exec, snpeff_exec, config_filename, build_stdout,
-                        build_stderr)
-  logger.debug("Outputting temporary VCF to %s" % vcf_filename)
+  vcf_input = vcf_file if isinstance(vcf_file, StreamedVCF) else None
   annotation_stats_file = os.path.join(temp_database_dir, 'snpEff_summary.html')
-  _snpeff_annotate(java_exec, snpeff_exec, vcf_filename, config_filename,
-                   temp_output_file, annotate_stderr, annotation_stats_file)
-  temp_output_file.close()
-  temp_output_file = open(temp_output_file.name, 'r')
-  return temp_output_file
+  if database is None:
+    database = built_database(temp_database_dir, java_exec, snpeff_exec,
+                              config_filename, build_stdout, build_stderr,
+                              database_cache, cache_key, build_plan, metrics)
+  with database:
+    with metrics.stage('annotate'):
+      annotated_lines = _snpeff_annotated_lines(java_exec, snpeff_exec,
+                                                vcf_filename, config_filename,
+                                                annotate_stderr,
+                                                annotation_stats_file,
+                                                annotate_plan, metrics,
+                                                vcf_input=vcf_input)
+      yield from scan_annotated_lines(annotated_lines, error_counter, progress,
+                                      summary, record_filter, effects_table)
 
-def _remove_headers(annotated_vcf):
-  """Removes all headers from a VCF before parsing
+def _stage_plans(resource_plan):
+  if resource_plan is None:
+    return None, None
+  return resource_plan.build, resource_plan.annotate
 
-  Some VCF headers (including INFO and FILTER headers) cannot be parsed
-  by the current version of PyVCF.  In this case we are not interested
-  in what they are so this removes them"""
-  header_regex = re.compile("^##.*$")
-  return (line for line in annotated_vcf if not header_regex.match(line))
+def _annotation_job_files(temp_database_dir, name, debug):
+  """Filenames for the output, stderr and stats of one of many annotations"""
+  output_filename = os.path.join(temp_database_dir, "snpeff_output_%s.vcf" % name)
+  stderr_filename = None
+  if not debug:
+    stderr_filename = os.path.join(temp_database_dir,
+                                   "snpeff_annotate_%s.e" % name)
+  annotation_stats_file = os.path.join(temp_database_dir,
+                                       "snpEff_summary_%s.html" % name)
+  return output_filename, stderr_filename, annotation_stats_file
 
-def check_annotations(annotated_vcf):
-  logger.info("Checking the annotated VCF for common issues")
-  error_map = {
-    'WARNING_REF_DOES_NOT_MATCH_GENOME': "The reference base in your VCF didn't match the base in the GFF. Are you sure you have the right reference?",
-    'WARNING_SEQUENCE_NOT_AVAILABLE': "A reference sequence was not available in your GFF. Please check that a reference sequence is available for every contig in your VCF",
-    'ERROR_CHROMOSOME_NOT_FOUND': "A contig in your VCF could not be found in your GFF. Are you sure that contigs use consitent names between your input data and the reference?",
-    'ERROR_OUT_OF_CHROMOSOME_RANGE': "One of your variants appears to be in a position beyond the end of the reference sequence. That's really weird, please check that you reference sequence matches your input data"
-  }
+@contextmanager
+def _vcf_output_file(output_filename, output_options=None):
+  """Opens output_filename for a VCF, bgzipping it if output_options says to
+
+  A tabix index is written to output_filename.tbi once the VCF is complete"""
+  if output_options is None or not output_options.bgzip:
+    with open(output_filename, 'w') as output_file:
+      yield output_file
+    return
+  with BgzfWriter(open(output_filename, 'wb'), output_options.threads,
+                  index=output_options.tabix) as output_file:
+    yield output_file
+  if output_options.tabix:
+    output_file.write_index("%s.tbi" % output_filename)
+
+def _annotate_vcf_file(java_exec, snpeff_exec, vcf_filename, config_filename,
+                       output_filename, stderr_filename, annotation_stats_file,
+                       jvm_plan=None, output_options=None, expected_records=None,
+                       progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                       summarise=False, record_filter=None):
+  """Annotates a VCF against an already built database
+
+  Runs in a worker process; returns the counts of annotation errors, the
+  resources used by SnpEff (see RunMetrics.processes) and an
+  AnnotationSummary if summarise is set (otherwise None).  Only the records
+  kept by record_filter (an AnnotationFilter) are written."""
+  metrics = RunMetrics()
+  progress = ProgressReporter(expected_records, progress_interval,
+                              os.path.basename(vcf_filename))
+  summary = AnnotationSummary() if summarise else None
+  with _vcf_output_file(output_filename, output_options) as output_file:
+    if stderr_filename is None:
+      error_counter = _snpeff_annotate(java_exec, snpeff_exec, vcf_filename,
+                                       config_filename, output_file, sys.stderr,
+                                       annotation_stats_file, jvm_plan, metrics,
+                                       progress, summary, record_filter)
+    else:
+      with open(stderr_filename, 'w') as stderr:
+        error_counter = _snpeff_annotate(java_exec, snpeff_exec, vcf_filename,
+                                         config_filename, output_file, stderr,
+                                         annotation_stats_file, jvm_plan,
+                                         metrics, progress, summary,
+                                         record_filter)
+  return error_counter, metrics.processes, summary
+
+def _join_vcf_file(vcf_filename, annotated_sites_filename, output_filename,
+                   output_options=None, expected_records=None,
+                   progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                   summarise=False, record_filter=None):
+  """Adds the annotations of a batch's unique sites to one of its VCFs
+
+  Runs in a worker process like _annotate_vcf_file and returns the same:
+  the counts of this VCF's annotation errors, the resources used by SnpEff
+  (none, it isn't run) and an AnnotationSummary if summarise is set.  Only
+  the records kept by record_filter are written."""
+  progress = ProgressReporter(expected_records, progress_interval,
+                              os.path.basename(vcf_filename))
+  summary = AnnotationSummary() if summarise else None
+  site_annotations = get_site_annotations(annotated_sites_filename)
+  with open_text(vcf_filename) as vcf_file, \
+       _vcf_output_file(output_filename, output_options) as output_file:
+    error_counter = stream_annotated_vcf(joined_vcf_lines(vcf_file,
+                                                          site_annotations),
+                                         output_file, progress, summary,
+                                         record_filter)
+  return error_counter, [], summary
+
+def sharded_annotated_lines(temp_database_dir, java_exec, snpeff_exec,
+                            vcf_file, config_filename, debug, threads,
+                            error_counter, database_cache=None, cache_key=None,
+                            resource_plan=None, metrics=None,
+                            progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                            summary=None, database=None, record_filter=None,
+                            effects_table=None):
+  """Annotates shards of the VCF in parallel and yields their lines in order
+
+  The lines are only yielded once every shard has been annotated.
+  error_counter (a Counter) is updated with the annotation errors across
+  all of the shards and summary (an AnnotationSummary) with their effects.
+  database and record_filter are as for snpeff_annotated_lines; each shard
+  is filtered as it's annotated.  The annotations are added to
+  effects_table (an EffectsTable) as the shards are merged."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  build_plan, annotate_plan = _stage_plans(resource_plan)
+  build_stdout, build_stderr = _get_build_output_files(temp_database_dir, debug)
+  shard_dir = os.path.join(temp_database_dir, 'shards')
+  os.makedirs(shard_dir)
+  with metrics.stage('split_vcf'):
+    shard_filenames = split_vcf(vcf_file, shard_dir, threads)
+  output_filenames = []
+  if database is None:
+    database = built_database(temp_database_dir, java_exec, snpeff_exec,
+                              config_filename, build_stdout, build_stderr,
+                              database_cache, cache_key, build_plan, metrics)
+  with database:
+    logger.info("Annotating %s in %s shards" % (vcf_file.name,
+                                                len(shard_filenames)))
+    with metrics.stage('annotate'), \
+         ProcessPoolExecutor(max_workers=threads) as executor:
+      jobs = []
+      for i, shard_filename in enumerate(shard_filenames):
+        output_filename, stderr_filename, annotation_stats_file = _annotation_job_files(temp_database_dir, "shard_%s" % i, debug)
+        jobs.append(executor.submit(_annotate_vcf_file, java_exec, snpeff_exec,
+                                    shard_filename, config_filename,
+                                    output_filename, stderr_filename,
+                                    annotation_stats_file, annotate_plan,
+                                    progress_interval=progress_interval,
+                                    summarise=summary is not None,
+                                    record_filter=record_filter))
+        output_filenames.append(output_filename)
+      for job in jobs:
+        shard_errors, processes, shard_summary = job.result()
+        error_counter.update(shard_errors)
+        metrics.add_processes(processes)
+        if summary is not None:
+          summary.merge(shard_summary)
+  logger.debug("Merging %s shards" % len(output_filenames))
+  with metrics.stage('merge_vcfs'):
+    yield from tabulated_lines(merged_vcf_lines(output_filenames),
+                               effects_table)
+
+def checkpointed_annotated_lines(temp_database_dir, java_exec, snpeff_exec,
+                                 vcf_file, config_filename, debug, threads,
+                                 error_counter, checkpoint, chunk_records,
+                                 database_cache=None, cache_key=None,
+                                 resource_plan=None, metrics=None,
+                                 progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                                 summary=None, database=None,
+                                 record_filter=None, effects_table=None):
+  """Annotates the VCF in chunks, recording each one in checkpoint as it finishes
+
+  The VCF is split into chunks of chunk_records records unless an earlier
+  run with the same checkpoint already split it, in which case the chunks
+  it finished are skipped.  Up to threads chunks are annotated at a time.  The lines
+  are yielded once every chunk has been annotated.  error_counter (a
+  Counter) is updated with the annotation errors across all of the chunks
+  and summary (an AnnotationSummary) with their effects.  database,
+  record_filter and effects_table are as for sharded_annotated_lines."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  build_plan, annotate_plan = _stage_plans(resource_plan)
+  build_stdout, build_stderr = _get_build_output_files(temp_database_dir, debug)
+  if checkpoint.chunks is None:
+    os.makedirs(checkpoint.chunk_dir, exist_ok=True)
+    with metrics.stage('split_vcf'):
+      checkpoint.set_chunks(split_vcf_records(vcf_file, checkpoint.chunk_dir,
+                                              chunk_records))
+  pending_chunks = [i for i in range(len(checkpoint.chunks))
+                    if not checkpoint.is_complete(i)]
+  metrics.count('chunks', len(checkpoint.chunks))
+  metrics.count('resumed_chunks', len(checkpoint.chunks) - len(pending_chunks))
+  if len(pending_chunks) > 0:
+    if database is None:
+      database = built_database(temp_database_dir, java_exec, snpeff_exec,
+                                config_filename, build_stdout, build_stderr,
+                                database_cache, cache_key, build_plan, metrics)
+    with database:
+      logger.info("Annotating %s of the %s chunks of %s" %
+                  (len(pending_chunks), len(checkpoint.chunks), vcf_file.name))
+      with metrics.stage('annotate'), \
+           ProcessPoolExecutor(max_workers=threads) as executor:
+        jobs = {}
+        for i in pending_chunks:
+          _, stderr_filename, annotation_stats_file = _annotation_job_files(temp_database_dir, "chunk_%s" % i, debug)
+          temp_output_filename = "%s.tmp" % checkpoint.output_filename(i)
+          job = executor.submit(_annotate_vcf_file, java_exec, snpeff_exec,
+                                checkpoint.input_filename(i), config_filename,
+                                temp_output_filename, stderr_filename,
+                                annotation_stats_file, annotate_plan,
+                                progress_interval=progress_interval,
+                                summarise=summary is not None,
+                                record_filter=record_filter)
+          jobs[job] = (i, temp_output_filename)
+        failure = None
+        for job in as_completed(jobs):
+          i, temp_output_filename = jobs[job]
+          try:
+            chunk_errors, processes, chunk_summary = job.result()
+          except Exception as e:
+            # Keep checkpointing the chunks which are still running
+            logger.warn("Could not annotate chunk %s: %s" % (i, e))
+            failure = failure or e
+            continue
+          metrics.add_processes(processes)
+          checkpoint.complete(i, temp_output_filename, chunk_errors,
+                              chunk_summary)
+        if failure is not None:
+          raise failure
+  for i in range(len(checkpoint.chunks)):
+    error_counter.update(checkpoint.errors(i))
+    if summary is not None:
+      summary.merge(checkpoint.summary(i))
+  logger.debug("Merging %s chunks" % len(checkpoint.chunks))
+  with metrics.stage('merge_vcfs'):
+    yield from tabulated_lines(merged_vcf_lines(checkpoint.output_filenames()),
+                               effects_table)
+
+annotation_error_map = {
+  'WARNING_REF_DOES_NOT_MATCH_GENOME': "The reference base in your VCF didn't match the base in the GFF. Are you sure you have the right reference?",
+  'WARNING_SEQUENCE_NOT_AVAILABLE': "A reference sequence was not available in your GFF. Please check that a reference sequence is available for every contig in your VCF",
+  'ERROR_CHROMOSOME_NOT_FOUND': "A contig in your VCF could not be found in your GFF. Are you sure that contigs use consitent names between your input data and the reference?",
+  'ERROR_OUT_OF_CHROMOSOME_RANGE': "One of your variants appears to be in a position beyond the end of the reference sequence. That's really weird, please check that you reference sequence matches your input data"
+}
+
+def _get_annotations(line):
+  """Gets the value of the ANN field from a VCF record without parsing it"""
+  info = line.split('\t', 8)[7]
+  if info.startswith('ANN='):
+    start = 4
+  else:
+    start = info.find(';ANN=')
+    if start == -1:
+      return ''
+    start += 5
+  end = info.find(';', start)
+  return info[start:] if end == -1 else info[start:end]
+
+def annotation_errors(line):
+  """Lists the errors from annotation_error_map in a VCF record's ANN field
+
+  Headers and the vast majority of records, which don't mention any errors
+  or warnings at all, are skipped with a substring search."""
+  if line[0] == '#' or ('ERROR_' not in line and 'WARNING_' not in line):
+    return []
+  annotations = _get_annotations(line)
+  return [error for error in annotation_error_map if error in annotations]
+
+def count_annotation_errors(annotated_vcf):
+  """Counts the records with each of the errors in annotation_error_map
+
+  Scans the lines of the VCF rather than parsing them with PyVCF; only the
+  ANN field of records which mention an error is looked at"""
   error_counter = Counter()
   annotated_vcf.seek(0)
-  modified_vcf = _remove_headers(annotated_vcf) # FIXME: A future version of PyVCF may be able to parse nasty headers
-  vcf_reader = vcf.Reader(modified_vcf)
-  for record in vcf_reader:
-    annotations = ','.join(record.INFO['ANN'])
-    counter_update = {error: 1 for error in error_map
-                      if error in annotations}
-    error_counter.update(counter_update)
+  for line in annotated_vcf:
+    errors = annotation_errors(line)
+    if errors:
+      error_counter.update(errors)
+  return error_counter
+
+def scan_annotated_lines(annotated_vcf, error_counter, progress=None,
+                         summary=None, record_filter=None, effects_table=None):
+  """Yields the lines of an annotated VCF, counting annotation errors
+
+  error_counter (a Counter) is updated with the errors from
+  annotation_error_map as the lines go past.  progress (a ProgressReporter)
+  is told how many records have been seen every PROGRESS_CHECK_RECORDS
+  records.  If summary (an AnnotationSummary) is given each record's
+  effects are counted in the same pass.  If record_filter (a
+  filters.AnnotationFilter) is given only the lines it keeps are yielded
+  and summarised; the errors of every record are still counted.  The
+  annotations of the records which are yielded are added to effects_table
+  (a table.EffectsTable) if it's given."""
+  records = 0
+  for line in annotated_vcf:
+    errors = annotation_errors(line)
+    if errors:
+      error_counter.update(errors)
+    if record_filter is not None:
+      line = record_filter.filter_line(line)
+    if line is not None:
+      yield line
+      if summary is not None and line[0] != '#':
+        summary.add_line(line)
+      if effects_table is not None and line[0] != '#':
+        effects_table.add_line(line)
+    if progress is not None and (line is None or line[0] != '#'):
+      records += 1
+      if records % PROGRESS_CHECK_RECORDS == 0:
+        progress.update(records)
+  if progress is not None:
+    progress.update(records)
+
+def tabulated_lines(annotated_vcf, effects_table=None):
+  """Yields the lines of an annotated VCF, adding each record's annotations to effects_table if it's given"""
+  if effects_table is None:
+    yield from annotated_vcf
+    return
+  for line in annotated_vcf:
+    if line[0] != '#':
+      effects_table.add_line(line)
+    yield line
+
+def stream_annotated_vcf(annotated_vcf, output_file, progress=None,
+                         summary=None, record_filter=None):
+  """Copies an annotated VCF to output_file, counting annotation errors
+
+  Only the lines kept by record_filter, if given, are written.  Returns the
+  counts of each error in annotation_error_map"""
+  error_counter = Counter()
+  output_file.writelines(scan_annotated_lines(annotated_vcf, error_counter,
+                                              progress, summary, record_filter))
+  return error_counter
+
+def log_annotation_errors(error_counter):
   for error, count in error_counter.items():
     logger.warn("%s instances of '%s': %s" % (count, error,
-                                               error_map[error]))
+                                               annotation_error_map[error]))
+
+def report_annotation_errors(error_counter):
+  log_annotation_errors(error_counter)
   if len(error_counter) > 0:
     raise AnnotationError("There were problems during the annotation, please review the warnings for details")
 
-def move_annotated_vcf(annotated_vcf, output_vcf):
+def check_annotations(annotated_vcf):
+  logger.info("Checking the annotated VCF for common issues")
+  report_annotation_errors(count_annotation_errors(annotated_vcf))
+
+@contextmanager
+def annotated_vcf_output(output_vcf, buffer_size=1024*1024, output_options=None,
+                         metrics=None):
+  """Yields a file to write the annotated VCF to
+
+  Files are written next to output_vcf and only renamed over it if the
+  context exits cleanly, so a failed run never leaves a partial output;
+  stdout is written to directly.  If output_options.bgzip is set the VCF is
+  bgzipped, and indexed if output_options.tabix is set."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  bgzip = output_options is not None and output_options.bgzip
   if output_vcf is sys.stdout:
-    annotated_vcf.seek(0)
     logger.info("Writing output to stdout")
-    print(annotated_vcf.read(), file=output_vcf)
-    annotated_vcf.close()
-  else:
-    annotated_vcf.close()
-    output_vcf.close()
-    logger.info("Moving annotated VCF from %s to %s" % (annotated_vcf.name,
+    if not bgzip:
+      yield output_vcf
+      output_vcf.flush()
+      return
+    with BgzfWriter(output_vcf.buffer, output_options.threads,
+                    close_file=False) as output_file:
+      yield output_file
+    return
+  output_vcf.close()
+  output_dir = os.path.dirname(os.path.abspath(output_vcf.name))
+  temp_output_file = tempfile.NamedTemporaryFile(mode='wb' if bgzip else 'w',
+                                                 delete=False,
+                                                 dir=output_dir,
+                                                 prefix='.snpeff_output_',
+                                                 suffix='.vcf.gz' if bgzip else '.vcf',
+                                                 buffering=buffer_size)
+  output_file = temp_output_file
+  if bgzip:
+    output_file = BgzfWriter(temp_output_file, output_options.threads,
+                             index=output_options.tabix)
+  def discard_output():
+    if bgzip:
+      output_file.abort()
+    temp_output_file.close()
+    os.remove(temp_output_file.name)
+    if os.path.isfile(output_vcf.name) and os.path.getsize(output_vcf.name) == 0:
+      os.remove(output_vcf.name) # Created empty when the arguments were parsed
+  try:
+    yield output_file
+  except:
+    discard_output()
+    raise
+  with metrics.stage('finish_output'):
+    try:
+      output_file.close()
+    except:
+      discard_output()
+      raise
+    logger.info("Moving annotated VCF from %s to %s" % (temp_output_file.name,
                                                         output_vcf.name))
-    shutil.move(annotated_vcf.name, output_vcf.name)
+    os.replace(temp_output_file.name, output_vcf.name)
+    if bgzip and output_options.tabix:
+      output_file.write_index("%s.tbi" % output_vcf.name)
 
 def delete_temp_database(temp_database_dir):
   logger.debug("Deleting temporary files from %s" % temp_database_dir)
   shutil.rmtree(temp_database_dir)
 
-def annotate_vcf(args):
-  coding_table = parse_coding_table(args.coding_table)
-  gff_contigs = get_gff_contigs(args.gff_file)
-  vcf_contigs = get_vcf_contigs(args.vcf_file)
-  check_contigs(vcf_contigs, gff_contigs, coding_table)
-  temp_database_dir = create_temp_database(args.gff_file)
-  genome_name = get_genome_name(args.gff_file)
-  config_filename = create_config_file(temp_database_dir, genome_name,
-                                   vcf_contigs, coding_table)
-  annotated_vcf = run_snpeff(temp_database_dir, args.java_exec, args.snpeff_exec,
-                             args.vcf_file, config_filename, args.debug)
-  check_annotations(annotated_vcf)
-  move_annotated_vcf(annotated_vcf, args.output_vcf)
-  if args.keep:
+def _clean_up_temp_database(temp_database_dir, keep):
+  if keep:
+    keep_temp_dir(temp_database_dir)
     logging.info("You can find temporary files in '%s'", temp_database_dir)
   else:
     delete_temp_database(temp_database_dir)
+
+def _get_database_cache(args, gff_contigs, coding_table, pruned_contigs=None,
+                        checkpoint=None, renamed_contigs=None):
+  """The DatabaseCache for args.cache_dir, or the checkpoint's database_dir"""
+  cache_dir = args.cache_dir
+  if cache_dir is None and checkpoint is not None:
+    cache_dir = checkpoint.database_dir
+  if cache_dir is None:
+    return None, None
+  max_size = None
+  if args.cache_max_size is not None:
+    max_size = int(args.cache_max_size * 1024**3)
+  database_cache = DatabaseCache(cache_dir, max_size)
+  cache_key = database_cache_key(args.gff_file.name,
+                                 _codon_tables(gff_contigs, coding_table),
+                                 _snpeff_version(args.snpeff_exec),
+                                 pruned_contigs, renamed_contigs)
+  return database_cache, cache_key
+
+def get_checkpoint(args, coding_table):
+  """The Checkpoint of a resumable run in args.resume_dir
+
+  It can only be resumed by a run with the same GFF and VCF (by path, size
+  and modification time), coding table, SnpEff, chunk size, pruning,
+  contig aliases and filter, as the chunks are filtered when they're
+  annotated."""
+  inputs = []
+  for input_file in [args.gff_file, args.vcf_file]:
+    input_stat = os.stat(input_file.name)
+    inputs.append([os.path.realpath(input_file.name), input_stat.st_size,
+                   input_stat.st_mtime])
+  aliases = get_contig_aliases(args)
+  run_key = checkpoint_key(inputs, coding_table, _snpeff_version(args.snpeff_exec),
+                           args.chunk_records, args.prune, args.prune_distance,
+                           sorted(aliases.aliases.items()), aliases.rules,
+                           _describe_filter(args))
+  return Checkpoint(args.resume_dir, run_key)
+
+def _file_size(input_file):
+  try:
+    return uncompressed_size(input_file.name)
+  except (AttributeError, OSError, TypeError):
+    return 0 # Not a file on disk e.g. stdin
+
+def plan_annotation_resources(args, vcf_bytes, concurrent_jvms,
+                              pruned_reference=None):
+  """Plans the Java heaps for args.gff_file, honouring any overrides in args
+
+  pruned_reference is the GFFIndex and size from prune_reference if the
+  database is built from a pruned GFF."""
+  if pruned_reference is None:
+    pruned_reference = (get_gff_index(args.gff_file), _file_size(args.gff_file))
+  gff_index, gff_bytes = pruned_reference
+  return plan_resources(gff_index, gff_bytes, vcf_bytes, concurrent_jvms,
+                        build_heap_mb=args.build_heap,
+                        annotate_heap_mb=args.annotate_heap,
+                        gc=args.java_gc, java_options=args.java_options,
+                        history_filename=default_history_filename())
+
+def _reference_needs_vcf(args):
+  """Does the database depend on the VCF?
+
+  It does if the GFF is pruned to the VCF's contigs or its contigs might be
+  renamed to match the VCF's; otherwise it can be built before the VCF is
+  read (see start_database_build)."""
+  return (_pruning(args) or args.contig_aliases is not None or
+          len(args.contig_alias_rules or []) > 0)
+
+def start_database_build(args, temp_database_dir, gff_contigs, coding_table,
+                         resource_plan, checkpoint=None, metrics=None):
+  """Starts building the database from args.gff_file in the background
+
+  The build gets its own config with the coding tables of the GFF's
+  contigs, as it doesn't need the VCF's.  Returns the
+  BackgroundDatabaseBuild, which must be closed."""
+  metrics = metrics if metrics is not None else RunMetrics()
+  with metrics.stage('create_config_file'):
+    build_contigs = [contig for contig in gff_contigs
+                     if contig in coding_table or 'default' in coding_table]
+    config_filename = create_config_file(temp_database_dir,
+                                         get_genome_name(args.gff_file),
+                                         build_contigs, coding_table,
+                                         'build.config')
+  with metrics.stage('database_cache_key'):
+    database_cache, cache_key = _get_database_cache(args, gff_contigs,
+                                                    coding_table,
+                                                    checkpoint=checkpoint)
+  build_stdout, build_stderr = _get_build_output_files(temp_database_dir,
+                                                       args.debug)
+  logger.debug("Building the database while the VCF is read")
+  return BackgroundDatabaseBuild(temp_database_dir, args.java_exec,
+                                 args.snpeff_exec, config_filename,
+                                 build_stdout, build_stderr, database_cache,
+                                 cache_key, resource_plan.build, metrics)
+
+def get_output_options(args):
+  return OutputOptions(args.bgzip, args.compression_threads, args.tabix)
+
+def get_record_filter(args):
+  """The AnnotationFilter for args.impacts, args.effects and args.genes, or None"""
+  return get_annotation_filter(args.impacts, args.effects, args.genes,
+                               args.only_matching_annotations)
+
+def _describe_filter(args):
+  record_filter = get_record_filter(args)
+  return None if record_filter is None else record_filter.describe()
+
+@contextmanager
+def run_metrics(args):
+  """Yields a RunMetrics for a run, logging it and writing it to args.metrics_file when the run ends"""
+  metrics = RunMetrics()
+  try:
+    yield metrics
+  except GeneratorExit:
+    metrics.finish('stopped') # The caller stopped reading an AnnotatedVCF
+    raise
+  except BaseException as e:
+    metrics.finish('failed', e)
+    raise
+  else:
+    metrics.finish('succeeded')
+  finally:
+    metrics.log()
+    if args.metrics_file is not None:
+      try:
+        metrics.write(args.metrics_file)
+      except OSError as e:
+        logger.warn("Could not write metrics to %s: %s" % (args.metrics_file, e))
+
+def preflight_vcf(args):
+  """Checks args.vcf_file against the reference in args.gff_file without annotating it
+
+  Its contigs are checked as they would be for an annotation and then its
+  records (see preflight_check); no database is built.  Raises
+  PreflightError if there are problems.  Returns the RunMetrics of the run."""
+  with run_metrics(args) as metrics:
+    with metrics.stage('parse_coding_table'):
+      coding_table = parse_coding_table(args.coding_table)
+    with metrics.stage('get_gff_contigs'):
+      gff_contigs = get_gff_contigs(args.gff_file)
+    record_counts = Counter()
+    with metrics.stage('get_vcf_contigs'):
+      args.vcf_file = reopen_text(args.vcf_file)
+      vcf_contigs = get_vcf_contigs(args.vcf_file, record_counts)
+    metrics.count('input_records', sum(record_counts.values()))
+    with metrics.stage('check_contigs'):
+      reconciliation = reconcile_contigs(args, vcf_contigs, gff_contigs,
+                                         record_counts)
+      check_contigs(vcf_contigs, reconciliation.gff_names, coding_table)
+    preflight_check(args, [args.vcf_file.name], reconciliation.gff_names,
+                    metrics)
+    logger.info("%s matches the reference in %s" % (args.vcf_file.name,
+                                                    args.gff_file.name))
+  return metrics
+
+def annotate_vcf(args):
+  """Annotates args.vcf_file, writing it to args.output_vcf
+
+  If args.output_vcf is None only args.effects_table (or args.summary_file)
+  is written.  Returns the RunMetrics of the run"""
+  with run_metrics(args) as metrics:
+    if args.output_vcf is None:
+      for line in annotated_vcf_lines(args, metrics):
+        pass
+      return metrics
+    with annotated_vcf_output(args.output_vcf,
+                              output_options=get_output_options(args),
+                              metrics=metrics) as output_file:
+      output_file.writelines(annotated_vcf_lines(args, metrics))
+  return metrics
+
+def annotated_vcf_lines(args, metrics, check=True):
+  """Annotates args.vcf_file, yielding the lines of the annotated VCF
+
+  The lines are yielded as SnpEff writes them (or once every shard has been
+  annotated if args.threads > 1).  The temporary database is deleted when
+  the last line has been yielded or the generator is closed.  Annotation
+  errors are logged at the end; AnnotationError is raised if there were any
+  and check is set.  If args.summary_file is set the effects are summarised
+  (see summary.AnnotationSummary) as the lines go past and written there
+  at the end.  If args.impacts, args.effects or args.genes are set only the
+  records with matching annotations are yielded (see get_record_filter);
+  they're filtered in the same pass, so the rest are never written.  The
+  summary only counts the records which are yielded.  If args.effects_table
+  is set the annotations of the records are written there, a row each
+  (see table.EffectsTable), as they're yielded; it's only written if the
+  annotation succeeds.  If args.resume_dir is set the VCF is annotated in chunks
+  which are checkpointed there (see checkpointed_annotated_lines); the
+  checkpoint is removed once the last line has been yielded.  args.vcf_file
+  can be a StreamedVCF (see can_stream_vcf), whose contigs are taken from
+  its header if they can be.
+
+  Unless the reference depends on the VCF (see _reference_needs_vcf) the
+  database is built while the VCF is read:
+
+    parse_coding_table -> get_gff_contigs -+-> build_database ---------+-> annotate
+                                           +-> get_vcf_contigs         |
+                                                 -> check_contigs      |
+                                                 (-> preflight)        |
+                                                 -> create_config_file +
+
+  If reading or checking the VCF fails, the build is stopped and that
+  error is raised, as it would have been before the build started."""
+  with metrics.stage('parse_coding_table'):
+    coding_table = parse_coding_table(args.coding_table)
+  record_filter = get_record_filter(args)
+  with metrics.stage('get_gff_contigs'):
+    gff_contigs = get_gff_contigs(args.gff_file)
+  temp_database_dir = None
+  database = None
+  checkpoint = None
+  effects_table = None
+  if not _reference_needs_vcf(args):
+    with metrics.stage('create_temp_database'):
+      temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir)
+  try:
+    if temp_database_dir is not None:
+      if args.resume_dir is not None:
+        with metrics.stage('load_checkpoint'):
+          checkpoint = get_checkpoint(args, coding_table)
+      with metrics.stage('plan_resources'):
+        resource_plan = plan_annotation_resources(args,
+                                                  _file_size(args.vcf_file) // args.threads,
+                                                  args.threads)
+      database = start_database_build(args, temp_database_dir, gff_contigs,
+                                      coding_table, resource_plan, checkpoint,
+                                      metrics)
+    record_counts = Counter()
+    vcf_positions = {} if _prune_distance(args) is not None else None
+    with metrics.stage('get_vcf_contigs'):
+      if isinstance(args.vcf_file, StreamedVCF):
+        vcf_contigs = args.vcf_file.contigs(record_counts)
+        input_records = args.vcf_file.records # Unknown if they weren't read
+      else:
+        args.vcf_file = reopen_text(args.vcf_file)
+        vcf_contigs = get_vcf_contigs(args.vcf_file, record_counts, vcf_positions)
+        input_records = sum(record_counts.values())
+    if input_records is not None:
+      metrics.count('input_records', input_records)
+    with metrics.stage('check_contigs'):
+      reconciliation = reconcile_contigs(args, vcf_contigs, gff_contigs,
+                                         record_counts)
+      metrics.count('aliased_contigs', len(reconciliation.renames))
+      streamed_from_header = (isinstance(args.vcf_file, StreamedVCF) and
+                              args.vcf_file.from_header())
+      check_contigs(vcf_contigs, reconciliation.gff_names, coding_table,
+                    declared_only=streamed_from_header)
+    if args.preflight:
+      preflight_check(args, [args.vcf_file.name], reconciliation.gff_names,
+                      metrics)
+    if temp_database_dir is None:
+      with metrics.stage('create_temp_database'):
+        temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir,
+                                                 stage_gff=not _rewriting_reference(args, reconciliation))
+    pruned_reference = None
+    if _rewriting_reference(args, reconciliation):
+      with metrics.stage('prune_reference' if _pruning(args) else 'rename_contigs'):
+        pruned_reference = prune_reference(args, temp_database_dir,
+                                           vcf_contigs, vcf_positions, metrics,
+                                           reconciliation)
+    with metrics.stage('create_config_file'):
+      genome_name = get_genome_name(args.gff_file)
+      config_filename = create_config_file(temp_database_dir, genome_name,
+                                           vcf_contigs, coding_table)
+    database_cache, cache_key = None, None
+    if database is None:
+      if args.resume_dir is not None:
+        with metrics.stage('load_checkpoint'):
+          checkpoint = get_checkpoint(args, coding_table)
+      with metrics.stage('database_cache_key'):
+        database_cache, cache_key = _get_database_cache(args, gff_contigs,
+                                                        coding_table,
+                                                        vcf_contigs if _pruning(args) else None,
+                                                        checkpoint,
+                                                        reconciliation.renames)
+      with metrics.stage('plan_resources'):
+        resource_plan = plan_annotation_resources(args,
+                                                  _file_size(args.vcf_file) // args.threads,
+                                                  args.threads, pruned_reference)
+    error_counter = Counter()
+    summary = AnnotationSummary() if args.summary_file is not None else None
+    if args.effects_table is not None:
+      effects_table = EffectsTable(args.effects_table)
+    if checkpoint is not None:
+      yield from checkpointed_annotated_lines(temp_database_dir, args.java_exec,
+                                              args.snpeff_exec, args.vcf_file,
+                                              config_filename, args.debug,
+                                              args.threads, error_counter,
+                                              checkpoint, args.chunk_records,
+                                              database_cache, cache_key,
+                                              resource_plan, metrics,
+                                              args.progress_interval, summary,
+                                              database, record_filter,
+                                              effects_table)
+    elif args.threads > 1:
+      yield from sharded_annotated_lines(temp_database_dir, args.java_exec,
+                                         args.snpeff_exec, args.vcf_file,
+                                         config_filename, args.debug,
+                                         args.threads, error_counter,
+                                         database_cache, cache_key,
+                                         resource_plan, metrics,
+                                         args.progress_interval, summary,
+                                         database, record_filter,
+                                         effects_table)
+    else:
+      progress = ProgressReporter(input_records, args.progress_interval,
+                                  args.vcf_file.name)
+      yield from snpeff_annotated_lines(temp_database_dir, args.java_exec,
+                                        args.snpeff_exec, args.vcf_file,
+                                        config_filename, args.debug,
+                                        error_counter, database_cache,
+                                        cache_key, resource_plan, metrics,
+                                        progress, summary, database,
+                                        record_filter, effects_table)
+      if record_filter is not None:
+        metrics.count('filtered_records', record_filter.removed)
+        metrics.count('output_records', record_filter.kept)
+      else:
+        metrics.count('output_records', progress.records)
+      if streamed_from_header:
+        with metrics.stage('check_contigs'):
+          check_streamed_contigs(args.vcf_file, coding_table)
+    metrics.count('annotation_errors', sum(error_counter.values()))
+    logger.info("Checking the annotated VCF for common issues")
+    with metrics.stage('check_annotations'):
+      if check:
+        report_annotation_errors(error_counter)
+      else:
+        log_annotation_errors(error_counter)
+    if effects_table is not None:
+      with metrics.stage('write_effects_table'):
+        effects_table.close()
+      metrics.count('effects_table_rows', effects_table.rows)
+    if summary is not None:
+      with metrics.stage('write_summary'):
+        summary.write(args.summary_file)
+    if checkpoint is not None and not args.keep:
+      checkpoint.remove()
+  finally:
+    if effects_table is not None:
+      effects_table.abort() # Unless it was written
+    if database is not None:
+      database.close()
+    if temp_database_dir is not None:
+      with metrics.stage('clean_up'):
+        _clean_up_temp_database(temp_database_dir, args.keep)
+
+def get_batch_output_filename(output_dir, vcf_filename, bgzip=False):
+  vcf_name = strip_compression_extension(os.path.basename(vcf_filename))
+  vcf_name = re.sub(r'\.vcf$', '', vcf_name)
+  extension = "vcf.gz" if bgzip else "vcf"
+  return os.path.join(output_dir, "%s.annotated.%s" % (vcf_name, extension))
+
+def annotate_vcfs(args):
+  """Annotates a batch of VCFs against one database
+
+  The database is built once, with coding tables for the union of the
+  contigs in all of the VCFs, and then up to args.jobs VCFs are annotated
+  at a time.  If args.deduplicate is set, the unique sites of all of the
+  VCFs are annotated once instead and their annotations added to each VCF
+  (see cohort.joined_vcf_lines).  Each VCF's output is written to
+  args.output_dir unless there were problems with its annotations.  args.summary_file, if set,
+  gets a summary of the effects in all of the VCFs which were written.
+  Each output is filtered as in annotated_vcf_lines; with args.deduplicate
+  the sites keep all of their annotations and each VCF is filtered as
+  they're added.  Returns the RunMetrics of the run."""
+  with run_metrics(args) as metrics:
+    _annotate_vcfs(args, metrics)
+  return metrics
+
+def _annotate_vcfs(args, metrics):
+  with metrics.stage('parse_coding_table'):
+    coding_table = parse_coding_table(args.coding_table)
+  record_filter = get_record_filter(args)
+  with metrics.stage('get_gff_contigs'):
+    gff_contigs = get_gff_contigs(args.gff_file)
+  output_options = get_output_options(args)
+  output_filenames = [get_batch_output_filename(args.output_dir, vcf_filename,
+                                                output_options.bgzip)
+                      for vcf_filename in args.vcf_filenames]
+  if len(set(output_filenames)) < len(output_filenames):
+    raise ValueError("Some of your VCFs have the same name, their outputs would overwrite each other")
+  temp_database_dir = None
+  database = None
+  if not _reference_needs_vcf(args):
+    # Built while the VCFs are read, as in annotated_vcf_lines
+    with metrics.stage('create_temp_database'):
+      temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir)
+  failed_vcfs = []
+  summary = AnnotationSummary() if args.summary_file is not None else None
+  sites_filename = None
+  annotated_sites_filename = None
+  try:
+    max_vcf_size = max(uncompressed_size(vcf_filename)
+                       for vcf_filename in args.vcf_filenames)
+    if temp_database_dir is not None:
+      with metrics.stage('plan_resources'):
+        resource_plan = plan_annotation_resources(args, max_vcf_size,
+                                                  args.jobs)
+      database = start_database_build(args, temp_database_dir, gff_contigs,
+                                      coding_table, resource_plan,
+                                      metrics=metrics)
+    vcf_contigs = set()
+    vcf_records = []
+    total_record_counts = Counter()
+    vcf_positions = {} if _prune_distance(args) is not None else None
+    with metrics.stage('get_vcf_contigs'):
+      for vcf_filename in args.vcf_filenames:
+        record_counts = Counter()
+        with open_text(vcf_filename) as vcf_file:
+          vcf_contigs.update(get_vcf_contigs(vcf_file, record_counts,
+                                             vcf_positions))
+        vcf_records.append(sum(record_counts.values()))
+        total_record_counts.update(record_counts)
+    vcf_contigs = sorted(vcf_contigs)
+    metrics.count('input_vcfs', len(args.vcf_filenames))
+    metrics.count('input_records', sum(vcf_records))
+    with metrics.stage('check_contigs'):
+      reconciliation = reconcile_contigs(args, vcf_contigs, gff_contigs,
+                                         total_record_counts)
+      metrics.count('aliased_contigs', len(reconciliation.renames))
+      check_contigs(vcf_contigs, reconciliation.gff_names, coding_table)
+    if args.preflight:
+      preflight_check(args, args.vcf_filenames, reconciliation.gff_names,
+                      metrics)
+    if temp_database_dir is None:
+      with metrics.stage('create_temp_database'):
+        temp_database_dir = create_temp_database(args.gff_file, args.scratch_dir,
+                                                 stage_gff=not _rewriting_reference(args, reconciliation))
+    pruned_reference = None
+    if _rewriting_reference(args, reconciliation):
+      with metrics.stage('prune_reference' if _pruning(args) else 'rename_contigs'):
+        pruned_reference = prune_reference(args, temp_database_dir,
+                                           vcf_contigs, vcf_positions, metrics,
+                                           reconciliation)
+    with metrics.stage('create_config_file'):
+      genome_name = get_genome_name(args.gff_file)
+      config_filename = create_config_file(temp_database_dir, genome_name,
+                                           vcf_contigs, coding_table)
+    if args.deduplicate:
+      with metrics.stage('collect_sites'):
+        sites_filename = os.path.join(temp_database_dir, 'sites.vcf')
+        unique_sites = write_sites_vcf(collect_sites(args.vcf_filenames),
+                                       sites_filename)
+      logger.info("Found %s unique sites in %s records" % (unique_sites,
+                                                           sum(vcf_records)))
+      metrics.count('unique_sites', unique_sites)
+    with metrics.stage('plan_resources'):
+      if sites_filename is not None:
+        resource_plan = plan_annotation_resources(args,
+                                                  os.path.getsize(sites_filename),
+                                                  1, pruned_reference)
+      elif database is None:
+        resource_plan = plan_annotation_resources(args, max_vcf_size,
+                                                  args.jobs, pruned_reference)
+    built = database
+    if built is None:
+      with metrics.stage('database_cache_key'):
+        database_cache, cache_key = _get_database_cache(args, gff_contigs,
+                                                        coding_table,
+                                                        vcf_contigs if _pruning(args) else None,
+                                                        renamed_contigs=reconciliation.renames)
+      build_stdout, build_stderr = _get_build_output_files(temp_database_dir,
+                                                           args.debug)
+      built = built_database(temp_database_dir, args.java_exec,
+                             args.snpeff_exec, config_filename,
+                             build_stdout, build_stderr, database_cache,
+                             cache_key, resource_plan.build, metrics)
+    with built:
+      os.makedirs(args.output_dir, exist_ok=True)
+      if sites_filename is not None:
+        logger.info("Annotating the unique sites of %s VCFs" %
+                    len(args.vcf_filenames))
+        with metrics.stage('annotate'):
+          annotated_sites_filename, stderr_filename, annotation_stats_file = _annotation_job_files(temp_database_dir, 'sites', args.debug)
+          _, processes, _ = _annotate_vcf_file(args.java_exec, args.snpeff_exec,
+                                               sites_filename, config_filename,
+                                               annotated_sites_filename,
+                                               stderr_filename,
+                                               annotation_stats_file,
+                                               resource_plan.annotate,
+                                               expected_records=unique_sites,
+                                               progress_interval=args.progress_interval)
+          metrics.add_processes(processes)
+      stage = 'annotate' if annotated_sites_filename is None else 'join_annotations'
+      with metrics.stage(stage), \
+           ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        jobs = []
+        for i, (vcf_filename, output_filename) in enumerate(zip(args.vcf_filenames, output_filenames)):
+          temp_output_filename = os.path.join(args.output_dir, ".%s.tmp" %
+                                              os.path.basename(output_filename))
+          if annotated_sites_filename is not None:
+            job = executor.submit(_join_vcf_file, vcf_filename,
+                                  annotated_sites_filename, temp_output_filename,
+                                  output_options, vcf_records[i],
+                                  args.progress_interval, summary is not None,
+                                  record_filter)
+          else:
+            _, stderr_filename, annotation_stats_file = _annotation_job_files(temp_database_dir, i, args.debug)
+            job = executor.submit(_annotate_vcf_file, args.java_exec,
+                                  args.snpeff_exec, vcf_filename, config_filename,
+                                  temp_output_filename, stderr_filename,
+                                  annotation_stats_file, resource_plan.annotate,
+                                  output_options, vcf_records[i],
+                                  args.progress_interval, summary is not None,
+                                  record_filter)
+          jobs.append((vcf_filename, temp_output_filename, job))
+        for (vcf_filename, temp_output_filename, job), output_filename in zip(jobs, output_filenames):
+          logger.info("Checking the annotations of %s for common issues",
+                      vcf_filename)
+          error_counter, processes, vcf_summary = job.result()
+          metrics.add_processes(processes)
+          metrics.count('annotation_errors', sum(error_counter.values()))
+          try:
+            report_annotation_errors(error_counter)
+          except AnnotationError as e:
+            logger.warn("Could not annotate %s: %s" % (vcf_filename, e))
+            failed_vcfs.append(vcf_filename)
+            for filename in [temp_output_filename, "%s.tbi" % temp_output_filename]:
+              if os.path.isfile(filename):
+                os.remove(filename)
+            continue
+          logger.info("Moving annotated VCF from %s to %s" %
+                      (temp_output_filename, output_filename))
+          os.replace(temp_output_filename, output_filename)
+          if os.path.isfile("%s.tbi" % temp_output_filename):
+            os.replace("%s.tbi" % temp_output_filename, "%s.tbi" % output_filename)
+          if summary is not None:
+            summary.merge(vcf_summary)
+  finally:
+    if annotated_sites_filename is not None:
+      forget_site_annotations(annotated_sites_filename)
+    if database is not None:
+      database.close()
+    if temp_database_dir is not None:
+      with metrics.stage('clean_up'):
+        _clean_up_temp_database(temp_database_dir, args.keep)
+  metrics.count('failed_vcfs', len(failed_vcfs))
+  if summary is not None:
+    with metrics.stage('write_summary'):
+      summary.write(args.summary_file)
+  if len(failed_vcfs) > 0:
+    raise AnnotationError("There were problems annotating %s of %s VCFs, please review the warnings for details" %
+                          (len(failed_vcfs), len(args.vcf_filenames)))